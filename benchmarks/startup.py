@@ -0,0 +1,110 @@
+"""
+Measure how long konsave commands take to start and finish.
+
+Every run is a fresh interpreter (``python -m konsave <command>``) against a
+throw-away $HOME holding a couple of small profiles, compared to the time of
+a bare ``python -c pass``.
+
+Usage:
+    python benchmarks/startup.py [-n RUNS] [--target MS] [COMMAND ...]
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+from tempfile import TemporaryDirectory
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_COMMANDS = ["version", "list", "--help"]
+
+CONFIG = """---
+save:
+    configs:
+        location: "$CONFIG_DIR"
+        entries:
+            - kdeglobals
+            - plasmarc
+export:
+    share_folder:
+        location: "$SHARE_DIR"
+        entries:
+...
+"""
+
+
+def make_home(home: str) -> dict:
+    """Create a small $HOME with two saved profiles and return its environment"""
+    config_dir = os.path.join(home, ".config")
+    os.makedirs(os.path.join(config_dir, "konsave"))
+    for name in ("kdeglobals", "plasmarc"):
+        with open(os.path.join(config_dir, name), "w", encoding="utf-8") as rc:
+            rc.write(f"[General]\nname={name}\n")
+    with open(
+        os.path.join(config_dir, "konsave", "conf.yaml"), "w", encoding="utf-8"
+    ) as conf:
+        conf.write(CONFIG)
+
+    env = dict(os.environ, HOME=home)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    for profile in ("first", "second"):
+        run(["-m", "konsave", "save", profile], env)
+    return env
+
+
+def run(argv: list, env: dict) -> float:
+    """Run the interpreter with ``argv`` and return the wall time in ms"""
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, *argv],
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+def measure(argv: list, env: dict, runs: int) -> dict:
+    """Return min/median wall time of ``runs`` runs (after one warm-up run)"""
+    run(argv, env)
+    times = [run(argv, env) for _ in range(runs)]
+    return {"min": min(times), "median": statistics.median(times)}
+
+
+def main():
+    """Measure and print the start-up time of each command"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("-n", "--runs", type=int, default=20)
+    parser.add_argument(
+        "--target",
+        type=float,
+        default=50,
+        help="Fail if 'list' takes longer than this many ms (median)",
+    )
+    parser.add_argument("commands", nargs="*", default=DEFAULT_COMMANDS)
+    args = parser.parse_args()
+
+    with TemporaryDirectory(prefix="konsave-bench") as home:
+        env = make_home(home)
+        baseline = measure(["-c", "pass"], env, args.runs)
+        print(f"{'python -c pass':<24} {baseline['median']:8.1f} ms (baseline)")
+        results = {}
+        for command in args.commands:
+            results[command] = measure(["-m", "konsave", command], env, args.runs)
+            overhead = results[command]["median"] - baseline["median"]
+            print(
+                f"{'konsave ' + command:<24} {results[command]['median']:8.1f} ms "
+                f"(min {results[command]['min']:.1f}, +{overhead:.1f} over python)"
+            )
+
+    if "list" in results and results["list"]["median"] > args.target:
+        print(f"'konsave list' is over the {args.target:.0f} ms target")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
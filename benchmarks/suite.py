@@ -0,0 +1,382 @@
+"""
+Time konsave commands against a reproducible synthetic $HOME.
+
+The generated home has many small rc files in ~/.config, deep icon themes
+with tens of thousands of files and a few large font and wallpaper files in
+~/.local/share. Every command runs in a fresh ``python -m konsave`` with
+$HOME pointing at it, so CONFIG_DIR and SHARE_DIR resolve inside the tree.
+
+For each command, the wall time, throughput (files/s and MB/s) and peak RSS
+are printed and, with ``-o``, written as JSON. ``--compare`` prints the
+change against a previous JSON result, to spot regressions across versions.
+
+Usage:
+    python benchmarks/suite.py [--quick] [--data DIR] [-o OUT.json] [--compare OLD.json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MB = 1024 * 1024
+CHUNK_SIZE = MB
+# Fixed mtime of every generated file, so that trees are identical across runs
+MTIME = 1_600_000_000
+MARKER = ".konsave-bench.json"
+
+PRESETS = {
+    "full": {
+        "rc_files": 2000,
+        "icon_files": 30000,
+        "large_files": 4,
+        "large_mb": 200,
+    },
+    "quick": {
+        "rc_files": 200,
+        "icon_files": 2000,
+        "large_files": 2,
+        "large_mb": 8,
+    },
+}
+
+ICON_SIZES = ("16x16", "22x22", "24x24", "32x32", "48x48", "64x64", "scalable")
+ICON_CATEGORIES = ("actions", "apps", "devices", "mimetypes", "places", "status")
+
+CONFIG = """---
+save:
+    configs:
+        location: "$CONFIG_DIR"
+        entries:
+            - bench
+    share:
+        location: "$SHARE_DIR"
+        entries:
+            - icons
+            - fonts
+            - wallpapers
+export:
+    color_schemes:
+        location: "$SHARE_DIR"
+        entries:
+            - color-schemes
+...
+"""
+
+
+def write_file(path: str, rng: random.Random, size: int, compressible: float = 0):
+    """Write ``size`` bytes of seeded content to ``path``.
+
+    Args:
+        path: the file to create
+        rng: the random generator to draw the content from
+        size: the size of the file in bytes
+        compressible: the fraction of each chunk that is a repeated pattern
+    """
+    with open(path, "wb") as dest:
+        left = size
+        while left > 0:
+            length = min(CHUNK_SIZE, left)
+            pattern = int(length * compressible)
+            dest.write(rng.randbytes(length - pattern))
+            dest.write(b"konsave" * (pattern // 7) + b"k" * (pattern % 7))
+            left -= length
+    os.utime(path, (MTIME, MTIME))
+
+
+def write_rc(path: str, rng: random.Random):
+    """Write a small KDE style rc file"""
+    with open(path, "w", encoding="utf-8") as rc:
+        for group in range(rng.randint(1, 5)):
+            rc.write(f"[Group{group}]\n")
+            for key in range(rng.randint(2, 20)):
+                rc.write(f"Key{key}={rng.getrandbits(64):x}\n")
+    os.utime(path, (MTIME, MTIME))
+
+
+def generate(home: str, params: dict, seed: int) -> dict:
+    """Create the synthetic home tree.
+
+    Args:
+        home: the directory to create the tree in
+        params: the counts and sizes of the preset
+        seed: the seed of the generated content
+
+    Returns:
+        dict: the number of files and bytes per top-level section
+    """
+    rng = random.Random(seed)
+    config_dir = os.path.join(home, ".config")
+    share_dir = os.path.join(home, ".local", "share")
+
+    rc_dir = os.path.join(config_dir, "bench")
+    for i in range(params["rc_files"]):
+        # Nest some of them, like the folders of gtk-3.0, kate, ...
+        parent = os.path.join(rc_dir, f"app{i % 40}") if i % 3 else rc_dir
+        os.makedirs(parent, exist_ok=True)
+        write_rc(os.path.join(parent, f"bench{i}rc"), rng)
+
+    for i in range(params["icon_files"]):
+        theme = f"Theme{i % 4}"
+        size = ICON_SIZES[(i // 4) % len(ICON_SIZES)]
+        category = ICON_CATEGORIES[(i // 28) % len(ICON_CATEGORIES)]
+        parent = os.path.join(share_dir, "icons", theme, size, category)
+        os.makedirs(parent, exist_ok=True)
+        extension = ".svg" if size == "scalable" else ".png"
+        compressible = 0.8 if size == "scalable" else 0
+        write_file(
+            os.path.join(parent, f"icon-{i}{extension}"),
+            rng,
+            rng.randint(200, 8 * 1024),
+            compressible,
+        )
+
+    for i in range(params["large_files"]):
+        if i % 2:
+            parent, name, compressible = "wallpapers", f"wallpaper{i}.jpg", 0
+        else:
+            parent, name, compressible = "fonts", f"font{i}.ttf", 0.5
+        os.makedirs(os.path.join(share_dir, parent), exist_ok=True)
+        path = os.path.join(share_dir, parent, name)
+        write_file(path, rng, params["large_mb"] * MB, compressible)
+
+    schemes = os.path.join(share_dir, "color-schemes")
+    os.makedirs(schemes, exist_ok=True)
+    for i in range(20):
+        write_rc(os.path.join(schemes, f"Scheme{i}.colors"), rng)
+
+    os.makedirs(os.path.join(config_dir, "konsave"), exist_ok=True)
+    return {
+        "save": tree_size([rc_dir, *share_paths(share_dir)]),
+        "export": tree_size([schemes]),
+    }
+
+
+def share_paths(share_dir: str) -> list:
+    """Return the saved folders of SHARE_DIR"""
+    return [os.path.join(share_dir, name) for name in ("icons", "fonts", "wallpapers")]
+
+
+def tree_size(paths: list) -> dict:
+    """Return the number of files and bytes under the given paths"""
+    files, size = 0, 0
+    for path in paths:
+        for top, _, names in os.walk(path):
+            for name in names:
+                files += 1
+                size += os.path.getsize(os.path.join(top, name))
+    return {"files": files, "bytes": size}
+
+
+def prepare(home: str, params: dict, seed: int) -> dict:
+    """Generate the home tree, or reuse it if it was made with the same params.
+
+    Returns:
+        dict: the dataset sizes, see generate()
+    """
+    marker = os.path.join(home, MARKER)
+    wanted = {"params": params, "seed": seed}
+    try:
+        with open(marker, "r", encoding="utf-8") as src:
+            previous = json.load(src)
+    except (OSError, ValueError):
+        previous = {}
+
+    if {key: previous.get(key) for key in wanted} == wanted:
+        dataset = previous["dataset"]
+        print(f"Reusing synthetic home in {home}")
+    else:
+        print(f"Generating synthetic home in {home}...")
+        for name in (".config", ".local", MARKER):
+            path = os.path.join(home, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        os.makedirs(home, exist_ok=True)
+        dataset = generate(home, params, seed)
+        with open(marker, "w", encoding="utf-8") as dest:
+            json.dump({**wanted, "dataset": dataset}, dest)
+    return dataset
+
+
+def reset(home: str):
+    """Remove any konsave state (profiles, objects, ...) and install CONFIG"""
+    konsave_dir = os.path.join(home, ".config", "konsave")
+    shutil.rmtree(konsave_dir, ignore_errors=True)
+    os.makedirs(konsave_dir)
+    with open(os.path.join(konsave_dir, "conf.yaml"), "w", encoding="utf-8") as conf:
+        conf.write(CONFIG)
+
+
+def run(argv: list, env: dict) -> dict:
+    """Run ``python -m konsave <argv>`` and return its wall time and peak RSS"""
+    start = time.perf_counter()
+    # pylint: disable=consider-using-with
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "konsave", *argv],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    # Tell Popen the child is gone, so it does not try to reap it again
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise RuntimeError(f"'konsave {' '.join(argv)}' exited with {proc.returncode}")
+
+    # ru_maxrss is in bytes on macOS and in KiB everywhere else
+    rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return {"seconds": seconds, "max_rss_mb": rss / MB}
+
+
+def result(timing: dict, files: int, size: int) -> dict:
+    """Add throughput figures to a timing"""
+    seconds = max(timing["seconds"], 1e-9)
+    return {
+        **timing,
+        "files": files,
+        "bytes": size,
+        "files_per_s": files / seconds,
+        "mb_per_s": size / MB / seconds,
+    }
+
+
+def benchmark(home: str, dataset: dict) -> dict:
+    """Run every benchmarked command once, in order, from an empty store"""
+    reset(home)
+    env = dict(os.environ, HOME=home)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    archive = os.path.join(home, "bench.knsv")
+    save, export = dataset["save"], dataset["export"]
+    everything = (save["files"] + export["files"], save["bytes"] + export["bytes"])
+
+    steps = [
+        ("config_check", ["config-check"], (0, 0)),
+        ("save_profile", ["save", "bench"], (save["files"], save["bytes"])),
+        (
+            "save_profile_unchanged",
+            ["save", "bench", "-f"],
+            (save["files"], save["bytes"]),
+        ),
+        ("export", ["export", "bench", "-f", "-o", archive], everything),
+        ("ls_archive", ["ls-archive", archive], everything),
+        ("import_profile", ["import", archive, "-n", "imported"], everything),
+        ("apply_profile", ["apply", "bench"], (save["files"], save["bytes"])),
+    ]
+
+    results = {}
+    for name, argv, (files, size) in steps:
+        results[name] = result(run(argv, env), files, size)
+    results["export"]["archive_bytes"] = os.path.getsize(archive)
+    return results
+
+
+def print_result(name: str, stats: dict, old: dict = None):
+    """Print one line of results, with the change from ``old`` if given"""
+    line = (
+        f"{name:<24} {stats['seconds']:8.2f} s {stats['files_per_s']:10.0f} files/s "
+        f"{stats['mb_per_s']:9.1f} MB/s {stats['max_rss_mb']:8.1f} MB RSS"
+    )
+    if old:
+        change = (stats["seconds"] / max(old["seconds"], 1e-9) - 1) * 100
+        rss = (stats["max_rss_mb"] / max(old["max_rss_mb"], 1e-9) - 1) * 100
+        line += f"   time {change:+6.1f}%  rss {rss:+6.1f}%"
+    print(line)
+
+
+def konsave_version() -> str:
+    """Return the version of the konsave checkout being measured"""
+    try:
+        return subprocess.run(
+            ["git", "-C", ROOT, "describe", "--always", "--dirty", "--tags"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    """Generate the data set, run the benchmarks and report the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="Use a small data set (a few MB) instead of the full one (~1 GB)",
+    )
+    parser.add_argument(
+        "-n",
+        "--runs",
+        type=int,
+        default=1,
+        help="Run everything this many times and keep the fastest time of each",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--data",
+        metavar="DIR",
+        help="Keep the synthetic home in DIR and reuse it on later runs",
+    )
+    parser.add_argument("-o", "--output", metavar="JSON", help="Write results here")
+    parser.add_argument(
+        "--compare", metavar="JSON", help="Compare with the results of a previous run"
+    )
+    args = parser.parse_args()
+
+    preset = "quick" if args.quick else "full"
+    params = PRESETS[preset]
+    old = {}
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as src:
+            old = json.load(src)
+        if old.get("params") != params:
+            print(f"Warning: {args.compare} was made with a different data set")
+
+    with TemporaryDirectory(prefix="konsave-bench") as tmp:
+        home = os.path.abspath(args.data) if args.data else tmp
+        dataset = prepare(home, params, args.seed)
+        print(
+            f"Data set: {dataset['save']['files'] + dataset['export']['files']} files, "
+            f"{(dataset['save']['bytes'] + dataset['export']['bytes']) / MB:.1f} MB"
+        )
+        runs = [benchmark(home, dataset) for _ in range(args.runs)]
+    results = {
+        name: min((run[name] for run in runs), key=lambda stats: stats["seconds"])
+        for name in runs[0]
+    }
+
+    if old:
+        print(f"Compared to {args.compare} ({old.get('version', 'unknown')}):")
+    for name, stats in results.items():
+        print_result(name, stats, old.get("results", {}).get(name))
+
+    report = {
+        "version": konsave_version(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "preset": preset,
+        "params": params,
+        "seed": args.seed,
+        "dataset": dataset,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as dest:
+            json.dump(report, dest, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
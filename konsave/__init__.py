@@ -1,9 +1,16 @@
 """Top-level Konsave package."""
 
-from pkg_resources import get_distribution, DistributionNotFound
 
-try:
-    __version__ = get_distribution("konsave-urban").version
-except DistributionNotFound:
-    # Package is not installed
-    pass
+def __getattr__(name):
+    # The version is only looked up when asked for, as importlib.metadata
+    # noticeably slows down the start of every command
+    if name == "__version__":
+        # pylint: disable=import-outside-toplevel
+        from importlib.metadata import version, PackageNotFoundError
+
+        try:
+            return version("konsave-urban")
+        except PackageNotFoundError:
+            # Package is not installed
+            return "unknown"
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
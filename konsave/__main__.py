@@ -2,59 +2,174 @@
 
 import argparse
 import logging
-from konsave.funcs import (
-    config_check,
-    install_config,
-    list_profiles,
-    ls_archive,
-    reset_config,
-    save_profile,
-    remove_profile,
-    apply_profile,
-    export,
-    import_profile,
-    wipe,
-)
+from importlib import import_module
+from konsave import timings
 from konsave.consts import (
+    COPY_BACKEND,
+    COPY_BACKENDS,
     KDE_RELOAD_CMD,
-    VERSION,
+    WORKERS,
 )
 
 logging.basicConfig(format="%(name)s: %(message)s", level=logging.INFO)
 
+# Subcommand -> "module:function". Modules are only imported for the command
+# being run, so that each command only pays for what it uses
+COMMANDS = {
+    "list": "konsave.profiles:list_profiles",
+    "save": "konsave.funcs:save_profile",
+    "remove": "konsave.profiles:remove_profile",
+    "apply": "konsave.funcs:apply_profile",
+    "rollback": "konsave.funcs:rollback_apply",
+    "diff": "konsave.funcs:diff_profiles",
+    "history": "konsave.funcs:profile_history",
+    "prune": "konsave.funcs:prune_history",
+    "watch": "konsave.funcs:watch",
+    "export": "konsave.exchange:export",
+    "import": "konsave.exchange:import_profile",
+    "version": "konsave.__main__:version",
+    "wipe": "konsave.profiles:wipe",
+    "gc": "konsave.profiles:garbage_collect",
+    "reset-config": "konsave.funcs:reset_config",
+    "config-check": "konsave.funcs:config_check",
+    "ls-archive": "konsave.exchange:ls_archive",
+    "verify": "konsave.exchange:verify",
+}
 
-def parse_args() -> argparse.ArgumentParser:
-    """
-    Parses and returns all arguments
+# Commands reading the user's conf.yaml, which is installed on first use
+NEEDS_CONFIG = {"save", "watch", "export", "config-check"}
+
+
+def load_command(name: str):
+    """Import and return the function implementing a subcommand"""
+    module, func = COMMANDS[name].split(":")
+    return getattr(import_module(module), func)
+
+
+def version(args):  # pylint: disable=unused-argument
+    """Print the installed version"""
+    print(f"Konsave: {import_module('konsave').__version__}")
+
+
+def add_profile_parsers(sub) -> list:
+    """Add the subcommands handling saved profiles.
+
+    Returns:
+        list: the parsers of the subcommands that support --dry-run
     """
-    parser = argparse.ArgumentParser(
-        prog="Konsave",
-        epilog="Please report bugs at https://www.github.com/urban-1/konsave",
+    list_parser = sub.add_parser("list", help="List saved profiles")
+    list_parser.add_argument(
+        "-s",
+        "--sort",
+        choices=("name", "size", "files", "saved", "host"),
+        default="name",
+        help="Sort profiles by this column (default: name)",
     )
-    parser.add_argument(
-        "-d", "--debug", action="store_true", help="Enable debug logging"
+    list_parser.add_argument(
+        "-r", "--reverse", action="store_true", help="Reverse the order"
+    )
+    list_parser.add_argument(
+        "-f", "--filter", metavar="<glob>", help="Only list names matching a glob"
+    )
+    list_parser.add_argument(
+        "--host", help="Only list profiles saved on the given host"
+    )
+    list_parser.add_argument(
+        "-l", "--long", action="store_true", help="Show the size of every section"
     )
-
-    sub = parser.add_subparsers(dest="cmd", required=True)
-
-    sub.add_parser("list")
 
     save_parser = sub.add_parser("save")
     save_parser.add_argument("-f", "--force", action="store_true")
+    save_parser.add_argument(
+        "-c",
+        "--checksum",
+        action="store_true",
+        help="Hash every file instead of skipping the ones unchanged since last save",
+    )
     save_parser.add_argument("name")
 
     rm_parser = sub.add_parser("remove")
     rm_parser.add_argument("name")
 
     apply_parser = sub.add_parser("apply")
-    apply_parser.add_argument("name")
+    apply_parser.add_argument(
+        "name", help='The profile, or "<name>@<version>" for an older version'
+    )
     apply_parser.add_argument(
         "-r",
         "--reload-kde",
         action="store_true",
         help=f"If set, it will execute the KDE_RELOAD_CMD: '{KDE_RELOAD_CMD}'",
     )
+    apply_parser.add_argument(
+        "--homes",
+        nargs="+",
+        metavar="<home>",
+        help="Apply to the home directories of these users instead of yours",
+    )
+
+    sub.add_parser("rollback", help="Restore the files replaced by the last apply")
+
+    diff_parser = sub.add_parser(
+        "diff", help="Show the files that differ between a profile and your files"
+    )
+    diff_parser.add_argument(
+        "names",
+        nargs="+",
+        metavar="name",
+        help='The profile, and another one to compare it with ("<name>@<version>" '
+        "for an older version)",
+    )
+    diff_parser.add_argument(
+        "-u",
+        "--unified",
+        action="store_true",
+        help="Also show the changes in text files, as unified diffs",
+    )
+
+    history_parser = sub.add_parser(
+        "history", help="List the saved versions of a profile"
+    )
+    history_parser.add_argument("name")
+
+    prune_parser = sub.add_parser(
+        "prune", help="Remove old versions of profiles (the current one is kept)"
+    )
+    prune_parser.add_argument(
+        "names", nargs="*", metavar="name", help="The profiles to prune (default: all)"
+    )
+    prune_parser.add_argument(
+        "--keep-last", type=int, default=0, metavar="N", help="Keep the last N versions"
+    )
+    prune_parser.add_argument(
+        "--keep-daily",
+        type=int,
+        default=0,
+        metavar="M",
+        help="Keep the last version of each of the last M days with a save",
+    )
+
+    watch_parser = sub.add_parser(
+        "watch", help="Keep saving a profile as its files change, until interrupted"
+    )
+    watch_parser.add_argument("name")
+    watch_parser.add_argument(
+        "--delay",
+        type=float,
+        default=2,
+        metavar="<seconds>",
+        help="Wait for files to stop changing for this long before saving (default: 2)",
+    )
 
+    return [save_parser, apply_parser]
+
+
+def add_archive_parsers(sub) -> list:
+    """Add the subcommands handling archives.
+
+    Returns:
+        list: the parsers of the subcommands that support --dry-run
+    """
     export_parser = sub.add_parser(
         "export", help="Export a profile to a konsave archive"
     )
@@ -64,19 +179,140 @@ def parse_args() -> argparse.ArgumentParser:
         "-o",
         "--output",
         required=False,
-        help="Specify the full export path. Any extension will be ignored",
+        help=(
+            "Specify the full export path. Any extension will be ignored, "
+            '"-" writes to stdout'
+        ),
         metavar="<path>",
     )
+    export_parser.add_argument(
+        "--format",
+        choices=("zip", "tar.zst", "tar.xz"),
+        help=(
+            "The archive format: zip (the default), or a compressed tar stream "
+            "(the default for stdout)"
+        ),
+    )
+    export_parser.add_argument(
+        "--base",
+        metavar="<archive>",
+        help="Only export what changed since this archive (a delta archive)",
+    )
 
     import_parser = sub.add_parser(
         "import", help="Import a profile from a konsave archive"
     )
-    import_parser.add_argument("path")
+    import_parser.add_argument(
+        "paths",
+        nargs="+",
+        metavar="path",
+        help=(
+            "The archive, followed by the delta archives to apply on top of it. "
+            '"-" reads a tar stream from stdin'
+        ),
+    )
     import_parser.add_argument(
         "-n", "--import-name", help="Specify the name of the profile when importing it"
     )
+    import_parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check the whole archive before writing anything",
+    )
+
+    ls_parser = sub.add_parser(
+        "ls-archive",
+        help="List the files and folders in an archive with their sizes",
+    )
+    ls_parser.add_argument("path")
+    ls_parser.add_argument(
+        "--depth",
+        type=int,
+        metavar="N",
+        help="Only list N levels, folders showing the totals of their contents",
+    )
+    ls_parser.add_argument(
+        "--sort",
+        choices=("name", "size"),
+        default="name",
+        help="Order of the contents of every folder (default: name)",
+    )
+    ls_parser.add_argument(
+        "--top",
+        type=int,
+        metavar="K",
+        help="Only list the first K entries of every folder (the largest with "
+        "--sort size), and the totals of the others",
+    )
+    ls_parser.add_argument(
+        "--json", action="store_true", help="Print the listing as JSON"
+    )
+
+    verify_parser = sub.add_parser(
+        "verify", help="Check archives against the SHA-256 of their members"
+    )
+    verify_parser.add_argument("paths", nargs="+", metavar="path")
+    verify_parser.add_argument(
+        "-q",
+        "--quick",
+        action="store_true",
+        help="Only print the profile digest of each archive, without checking it",
+    )
+
+    return [export_parser, import_parser]
+
+
+def parse_args() -> argparse.ArgumentParser:
+    """
+    Parses and returns all arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog="Konsave",
+        epilog="Please report bugs at https://www.github.com/urban-1/konsave",
+    )
+    parser.add_argument(
+        "-d", "--debug", action="store_true", help="Enable debug logging"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=WORKERS,
+        help=f"Number of files to copy in parallel (default: {WORKERS})",
+    )
+    parser.add_argument(
+        "--copy-backend",
+        choices=("auto", *COPY_BACKENDS),
+        default=COPY_BACKEND,
+        help=(
+            "Force how files are copied (default: $KONSAVE_COPY_BACKEND or "
+            "auto, the fastest one that works)"
+        ),
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Show the time spent and files handled per section and entry",
+    )
+    parser.add_argument(
+        "--trace-file",
+        metavar="<path>",
+        help="Write the timings and I/O counts per section and entry as JSON",
+    )
+
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    for command_parser in add_profile_parsers(sub) + add_archive_parsers(sub):
+        command_parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only show what would be copied and how long it should take",
+        )
 
     sub.add_parser("wipe", help="Wipe all profiles - this cannot be undone!")
+    sub.add_parser(
+        "gc", help="Remove stored files that are no longer used by any profile"
+    )
     sub.add_parser("version", help="Show Konsave version")
     sub.add_parser(
         "reset-config",
@@ -94,21 +330,12 @@ def parse_args() -> argparse.ArgumentParser:
         ),
     )
 
-    ls_parser = sub.add_parser(
-        "ls-archive",
-        help="List all the files in an archive and their sizes",
-    )
-    ls_parser.add_argument("path")
-
     return parser.parse_args()
 
 
 def main():
     """The main function that handles all the arguments and options."""
 
-    # Never force by default
-    install_config(force=False)
-
     args = parse_args()
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
@@ -119,24 +346,27 @@ def main():
         for handler in logging.getLogger().handlers:
             handler.setFormatter(formatter)
 
-    funcs = {
-        "list": list_profiles,
-        "save": save_profile,
-        "remove": remove_profile,
-        "apply": apply_profile,
-        "export": export,
-        "import": import_profile,
-        "version": lambda args: print(f"Konsave: {VERSION}"),
-        "wipe": wipe,
-        "reset-config": reset_config,
-        "config-check": config_check,
-        "ls-archive": ls_archive,
-    }
+    if args.timings or args.trace_file:
+        timings.enable()
+
     try:
-        return funcs[args.cmd](args)
+        if args.cmd in NEEDS_CONFIG:
+            # Never force by default
+            import_module("konsave.funcs").install_config(force=False)
+        if args.jobs != WORKERS:
+            import_module("konsave.copier").set_workers(args.jobs)
+        if args.copy_backend != "auto":
+            import_module("konsave.copier").set_copy_backend(args.copy_backend)
+        with timings.span():
+            return load_command(args.cmd)(args)
     # FIXME(urban-1): Create a "user error" exception
     except (ValueError, AssertionError) as ex:
         print(str(ex))
+    finally:
+        if args.timings:
+            import_module("konsave.funcs").print_timings()
+        if args.trace_file:
+            timings.write_trace(args.cmd, args.trace_file)
 
     return -1
 
@@ -0,0 +1,962 @@
+"""
+This module writes and reads konsave archives (.knsv).
+
+Members are streamed into the zip straight from where they live (the object
+store for saved sections, the real locations for the export section) and
+back out of it straight to where they belong, so no staging copy of the
+profile is ever made.
+
+The last member (INTEGRITY_NAME) holds the SHA-256 and size of every file
+member and a digest of the whole profile. It is checked while importing and
+by verify_archive(), and lets imports skip the files that are already there.
+
+A delta archive only holds the files that are new or changed since a base
+archive (plus conf.yaml and all directories). Its integrity records still
+list every file of the profile, along with the digest of the base and the
+files deleted since. ArchiveChain reads a base and its deltas as one archive.
+"""
+
+import os
+import sys
+import json
+import stat
+import zlib
+import hashlib
+import zipfile
+import shutil
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from tempfile import NamedTemporaryFile
+from functools import partial
+from typing import NamedTuple, Optional
+from zipfile import ZipFile, ZipInfo, ZIP_BZIP2, ZIP_DEFLATED, ZIP_LZMA, ZIP_STORED
+
+from konsave import timings
+from konsave.consts import COMPRESSED_EXTENSIONS
+from konsave.copier import existing_entries, imap, parallel, section_patterns, walk
+from konsave.store import (
+    CHUNK_SIZE,
+    hash_file,
+    new_manifest,
+    new_section,
+    object_path,
+    store_stream,
+)
+
+
+log = logging.getLogger("Konsave")
+
+DIR_MODE = 0o775
+# Files up to this size are compressed in memory by the thread pool, larger
+# ones are streamed into the archive by the writer to bound memory use
+MAX_BUFFERED_SIZE = 4 * 1024 * 1024
+
+METHODS = {
+    "store": ZIP_STORED,
+    "deflate": ZIP_DEFLATED,
+    "bzip2": ZIP_BZIP2,
+    "lzma": ZIP_LZMA,
+}
+METHOD_NAMES = {value: key for key, value in METHODS.items()}
+# Levels each method accepts, None if it takes none
+LEVELS = {
+    "store": None,
+    "deflate": range(0, 10),
+    "bzip2": range(1, 10),
+    "lzma": None,
+}
+
+# compress_member() and write_compressed() rely on zipfile internals, which
+# were checked against CPython 3.9 to 3.13. On other versions, every member
+# is streamed through the public ZipFile.open() by write_member() instead
+PARALLEL_COMPRESSION = (3, 9) <= sys.version_info[:2] <= (3, 13)
+# General purpose flag of LZMA members: the data ends with an EOS marker
+LZMA_EOS_FLAG = 0x02
+
+INTEGRITY_NAME = "integrity.json"
+INTEGRITY_VERSION = 1
+# Raised when reading a damaged member
+READ_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError)
+
+
+class Member(NamedTuple):
+    """A file or directory to be written into an archive"""
+
+    arcname: str
+    # None for directories
+    path: Optional[str] = None
+    # Permission bits and mtime (ns) to record instead of those of ``path``
+    mode: Optional[int] = None
+    mtime_ns: Optional[int] = None
+    # SHA-256 of the content, if known (objects are named after it)
+    digest: Optional[str] = None
+
+
+class Compression(NamedTuple):
+    """How the members of an archive are compressed"""
+
+    method: int = ZIP_DEFLATED
+    # None for the default level of the method
+    level: Optional[int] = None
+    # Members with these (lower case) suffixes are always stored
+    store: tuple = COMPRESSED_EXTENSIONS
+
+    def method_for(self, arcname: str) -> int:
+        """Return the compression method of the member ``arcname``"""
+        if arcname.lower().endswith(self.store):
+            return ZIP_STORED
+        return self.method
+
+
+def compression_policy(konsave_config: dict) -> Compression:
+    """Build the compression policy from the "compression" section of a config.
+
+    Args:
+        konsave_config: the parsed config
+
+    Returns:
+        Compression: the policy (the defaults if the section is missing)
+    """
+    conf = konsave_config.get("compression") or {}
+    method = conf.get("method", "deflate")
+    assert (
+        method in METHODS
+    ), f"Unknown compression method '{method}', use one of: {', '.join(METHODS)}"
+    level = conf.get("level")
+    if level is not None:
+        levels = LEVELS[method]
+        assert levels, f"Compression method '{method}' takes no level"
+        assert (
+            isinstance(level, int) and level in levels
+        ), f"Compression level of {method} must be between {levels[0]} and {levels[-1]}"
+    store = conf.get("store", COMPRESSED_EXTENSIONS) or ()
+    return Compression(
+        METHODS[method], level, tuple(suffix.lower() for suffix in store)
+    )
+
+
+def profile_members(profile_dir: str, konsave_config: dict, sections: dict):
+    """Yield the members of the "save" part of a profile archive.
+
+    Args:
+        profile_dir: the profile directory
+        konsave_config: the parsed profile config
+        sections: the sections of the profile manifest
+    """
+    log.debug(f"Archiving profile in {profile_dir}")
+    yield Member("save/")
+    for name, config in konsave_config["save"].items():
+        log.info(f'Exporting "{name}"...')
+        section = sections.get(name, {"files": {}, "dirs": []})
+        # Saved with the same patterns, unless conf.yaml was edited since
+        patterns = section_patterns(config)
+        yield Member(f"save/{name}/")
+        for path in section["dirs"]:
+            if patterns.keep_path(path, True):
+                yield Member(f"save/{name}/{path}/")
+        for path, record in sorted(section["files"].items()):
+            if not patterns.keep_path(path):
+                continue
+            yield Member(
+                f"save/{name}/{path}",
+                object_path(record["digest"]),
+                record["mode"],
+                record.get("mtime_ns"),
+                record["digest"],
+            )
+
+
+def export_members(konsave_config: dict):
+    """Yield the members of the "export" part of a profile archive.
+
+    Args:
+        konsave_config: the parsed profile config
+    """
+    yield Member("export/")
+    for name, section in konsave_config["export"].items():
+        yield Member(f"export/{name}/")
+        patterns = section_patterns(section)
+        for entry, source in existing_entries(section):
+            log.info(f'Exporting "{entry}"...')
+            if not os.path.isdir(source):
+                yield Member(f"export/{name}/{entry}", source)
+                continue
+            yield Member(f"export/{name}/{entry}/")
+            for rel, item in walk(source, entry, patterns):
+                if item.is_dir():
+                    yield Member(f"export/{name}/{rel}/")
+                elif os.path.exists(item.path):
+                    yield Member(f"export/{name}/{rel}", item.path)
+
+
+def _zip_info(member: Member, policy: Compression) -> ZipInfo:
+    """Build the ZipInfo of an archive member"""
+    if member.path is None:
+        zinfo = ZipInfo(member.arcname, datetime.now().timetuple()[:6])
+        zinfo.external_attr = ((stat.S_IFDIR | DIR_MODE) << 16) | 0x10
+        zinfo.compress_type = ZIP_STORED
+        return zinfo
+
+    zinfo = ZipInfo.from_file(member.path, member.arcname)
+    zinfo.compress_type = policy.method_for(member.arcname)
+    # Read by ZipFile.open() when writing. It became compress_level in Python
+    # 3.13, which keeps this name as an alias
+    zinfo._compresslevel = policy.level  # pylint: disable=protected-access
+    if member.mode is not None:
+        zinfo.external_attr = (stat.S_IFREG | member.mode) << 16
+    if member.mtime_ns is not None:
+        mtime = datetime.fromtimestamp(member.mtime_ns / 1e9)
+        # Zip cannot represent dates before 1980
+        zinfo.date_time = max(mtime.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+    return zinfo
+
+
+def copy_hashed(src, dst, digest: str = None) -> str:
+    """Copy the stream ``src`` to ``dst``, returning the SHA-256 of the data
+    (``digest`` if already known)"""
+    if digest:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        return digest
+    sha = hashlib.sha256()
+    for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+        sha.update(chunk)
+        dst.write(chunk)
+    return sha.hexdigest()
+
+
+def write_member(arc: ZipFile, member: Member, policy: Compression) -> str:
+    """Stream one member into an open archive.
+
+    Returns:
+        str: the SHA-256 of a file member, None for a directory
+    """
+    zinfo = _zip_info(member, policy)
+    if member.path is None:
+        arc.writestr(zinfo, b"")
+        return None
+    with timings.member_scope(member.arcname), timings.track():
+        with open(member.path, "rb") as src, arc.open(zinfo, "w") as dst:
+            digest = copy_hashed(src, dst, member.digest)
+        timings.count(
+            bytes=zinfo.file_size, stored=zinfo.compress_size, stat=2, open=1, copy=1
+        )
+    return digest
+
+
+def compress_member(member: Member, policy: Compression) -> tuple:
+    """Read and compress a file member in memory.
+
+    Returns:
+        tuple: the complete ZipInfo, the compressed data and the SHA-256 of
+        the data, or the member itself and None twice if it has to be
+        streamed by write_member()
+    """
+    if not PARALLEL_COMPRESSION or member.path is None:
+        return member, None, None
+    if os.path.getsize(member.path) > MAX_BUFFERED_SIZE:
+        return member, None, None
+
+    with timings.member_scope(member.arcname), timings.track():
+        zinfo, payload, digest = _compress(member, policy)
+        timings.count(
+            bytes=zinfo.file_size, stored=len(payload), stat=2, open=1, copy=1
+        )
+    return zinfo, payload, digest
+
+
+def _compress(member: Member, policy: Compression) -> tuple:
+    """Read and compress a file, see compress_member()"""
+    zinfo = _zip_info(member, policy)
+    with open(member.path, "rb") as src:
+        data = src.read()
+    digest = member.digest or hashlib.sha256(data).hexdigest()
+    payload = data
+    if zinfo.compress_type != ZIP_STORED:
+        # zlib, bz2 and lzma release the GIL, so members compress in parallel
+        # pylint: disable=protected-access
+        compressor = zipfile._get_compressor(zinfo.compress_type, policy.level)
+        payload = compressor.compress(data) + compressor.flush()
+    if len(payload) >= len(data):
+        zinfo.compress_type = ZIP_STORED
+        payload = data
+    zinfo.file_size = len(data)
+    zinfo.compress_size = len(payload)
+    zinfo.CRC = zlib.crc32(data)
+    return zinfo, payload, digest
+
+
+def write_compressed(arc: ZipFile, zinfo: ZipInfo, payload: bytes):
+    """Append a member whose data is already compressed.
+
+    ZipFile has no public API for this, so this mirrors what
+    ZipFile._open_to_write() and _ZipWriteFile.close() do, with the CRC and
+    sizes known upfront (no data descriptor nor header rewrite needed). Only
+    used when PARALLEL_COMPRESSION is True.
+    """
+    # pylint: disable=protected-access
+    zinfo.flag_bits = 0
+    if zinfo.compress_type == ZIP_LZMA:
+        zinfo.flag_bits |= LZMA_EOS_FLAG
+    if arc._seekable:
+        arc.fp.seek(arc.start_dir)
+    zinfo.header_offset = arc.fp.tell()
+    arc._writecheck(zinfo)
+    arc._didModify = True
+    arc.fp.write(zinfo.FileHeader())
+    arc.fp.write(payload)
+    arc.start_dir = arc.fp.tell()
+    arc.filelist.append(zinfo)
+    arc.NameToInfo[zinfo.filename] = zinfo
+
+
+def profile_digest(members: dict) -> str:
+    """Return the digest of a whole profile from the integrity records of its
+    members (see write_members())"""
+    sha = hashlib.sha256()
+    for name, record in sorted(members.items()):
+        sha.update(f"{name}\0{record['sha256']}\0{record['size']}\n".encode())
+    return sha.hexdigest()
+
+
+def hash_member(member: Member, base: dict) -> Member:
+    """Fill in the digest of a file member that may be unchanged since the
+    base records (same size), so that it can be compared with them"""
+    record = base.get(member.arcname)
+    if member.path is None or member.digest or record is None:
+        return member
+    try:
+        if os.path.getsize(member.path) != record["size"]:
+            return member
+        timings.count(open=1)
+        return member._replace(digest=hash_file(member.path))
+    except FileNotFoundError:
+        return member
+
+
+def in_base(member: Member, base: dict) -> bool:
+    """Return True if a member (see hash_member()) has the same content in
+    the base records. conf.yaml never is, as imports read it from the last
+    archive"""
+    record = base.get(member.arcname)
+    return (
+        record is not None
+        and member.arcname != "conf.yaml"
+        and member.digest == record["sha256"]
+    )
+
+
+def write_members(
+    arc: ZipFile, members, policy: Compression, base: dict = None
+) -> tuple:
+    """Write members in order, compressing the small ones ahead in parallel,
+    followed by their integrity records.
+
+    Args:
+        arc: the archive
+        members: iterable of Member
+        policy: how to compress the members
+        base: the integrity records of a base archive, to write a delta of it
+            with only the files that are new or changed
+
+    Returns:
+        tuple: the number of files written and their uncompressed size
+    """
+    records = {}
+    if base:
+        members = _delta_members(members, base["members"], records)
+    files, size = 0, 0
+    with timings.member_spans() as section_span:
+        for item, payload, digest in imap(
+            partial(compress_member, policy=policy), members
+        ):
+            if payload is None:
+                section_span(item.arcname)
+                digest = write_member(arc, item, policy)
+            else:
+                section_span(item.filename)
+                write_compressed(arc, item, payload)
+            if digest:
+                zinfo = arc.filelist[-1]
+                records[zinfo.filename] = {"sha256": digest, "size": zinfo.file_size}
+                files += 1
+                size += zinfo.file_size
+
+    integrity = {
+        "version": INTEGRITY_VERSION,
+        "digest": profile_digest(records),
+        "members": records,
+    }
+    if base:
+        integrity["base"] = base["digest"]
+        integrity["deleted"] = sorted(base["members"].keys() - records.keys())
+    arc.writestr(INTEGRITY_NAME, json.dumps(integrity, indent=1), ZIP_DEFLATED)
+    return files, size
+
+
+def _delta_members(members, base: dict, records: dict):
+    """Yield the members not in the base records, adding the records of the
+    others to ``records``. Files are hashed in parallel, only when their size
+    did not change"""
+    for member in imap(partial(hash_member, base=base), members):
+        if in_base(member, base):
+            records[member.arcname] = base[member.arcname]
+        else:
+            yield member
+
+
+def _umask() -> int:
+    """Return the process umask"""
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def write_archive(
+    path: str, members, policy: Compression = Compression(), base: dict = None
+) -> tuple:
+    """Write all members into a new archive (see write_output()).
+
+    Args:
+        path: the archive to create
+        members: iterable of Member
+        policy: how to compress the members
+        base: the integrity records of the base archive of a delta archive
+
+    Returns:
+        tuple: the number of files written and their uncompressed size
+    """
+
+    def write(out):
+        with ZipFile(out, "w") as arc:
+            return write_members(arc, members, policy, base)
+
+    return write_output(path, write)
+
+
+def write_output(path: str, write):
+    """Call ``write`` with the binary stream of an archive to create.
+
+    Regular files are written under a temporary name and renamed into place
+    once complete. Devices and pipes (ie /dev/stdout) are written to
+    directly, "-" being stdout.
+
+    Returns:
+        what ``write`` returns
+    """
+    if path == "-":
+        try:
+            return write(sys.stdout.buffer)
+        finally:
+            sys.stdout.buffer.flush()
+    if path.startswith("/dev/") or (os.path.exists(path) and not os.path.isfile(path)):
+        with open(path, "wb") as out:
+            return write(out)
+
+    with NamedTemporaryFile(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=".konsave", delete=False
+    ) as out:
+        try:
+            written = write(out)
+        except BaseException:
+            os.unlink(out.name)
+            raise
+    os.chmod(out.name, 0o644 & ~_umask())
+    os.replace(out.name, path)
+    return written
+
+
+class ZipReaders:
+    """Per-thread read handles on an archive.
+
+    A ZipFile must not be read from several threads at once, so every thread
+    gets its own handle. All handles are closed when leaving the context.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def get(self) -> ZipFile:
+        """Return the handle of the calling thread"""
+        if not hasattr(self._local, "arc"):
+            # pylint: disable=consider-using-with
+            # Closed in __exit__
+            self._local.arc = ZipFile(self.path, "r")
+            with self._lock:
+                self._handles.append(self._local.arc)
+        return self._local.arc
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for arc in self._handles:
+            arc.close()
+
+
+class ArchiveChain:
+    """An archive followed by delta archives, each one built on the previous
+    one, read as a single archive.
+
+    Every member is read from the last archive that holds it. Directories are
+    those of the last archive, and the files it deletes are dropped.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.integrity = None
+        # Member name -> (index of its archive, ZipInfo)
+        self._members = {}
+        for index, path in enumerate(self.paths):
+            with ZipFile(path, "r") as arc:
+                self._add(index, read_integrity(arc), arc.infolist())
+
+        missing = self.records.keys() - self._members.keys()
+        assert not missing, f"Incomplete archive chain, missing: {sorted(missing)[0]}"
+        self._readers = [ZipReaders(path) for path in self.paths]
+
+    def _add(self, index: int, integrity: dict, infos: list):
+        path = self.paths[index]
+        base = (integrity or {}).get("base")
+        if index == 0:
+            assert not base, f"{path} is a delta archive, give its base archive first"
+        else:
+            assert base and base == (self.integrity or {}).get(
+                "digest"
+            ), f"{path} is not a delta of {self.paths[index - 1]}"
+            deleted = set(integrity["deleted"])
+            self._members = {
+                name: item
+                for name, item in self._members.items()
+                if not name.endswith("/") and name not in deleted
+            }
+        for zinfo in infos:
+            if zinfo.filename != INTEGRITY_NAME:
+                self._members[zinfo.filename] = (index, zinfo)
+        self.integrity = integrity
+
+    @property
+    def records(self) -> dict:
+        """The integrity records of the resulting profile (empty if none)"""
+        return (self.integrity or {}).get("members", {})
+
+    def infolist(self) -> list:
+        """Return the members of the resulting profile"""
+        return [zinfo for _, zinfo in self._members.values()]
+
+    def open(self, zinfo: ZipInfo):
+        """Open a member for reading, from the calling thread"""
+        index = self._members[zinfo.filename][0]
+        return self._readers[index].get().open(zinfo)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for readers in self._readers:
+            readers.__exit__(*exc)
+
+
+def member_parts(name: str) -> list:
+    """Split a member name, refusing anything that would escape the target"""
+    parts = name.rstrip("/").split("/")
+    assert (
+        not name.startswith("/") and ".." not in parts
+    ), f"Unsafe path in archive: {name}"
+    return parts
+
+
+def member_mode(zinfo: ZipInfo) -> int:
+    """Return the permission bits stored for a member (0644 if none)"""
+    return (zinfo.external_attr >> 16) & 0o777 or 0o644
+
+
+class Staging:
+    """The files an import writes to the locations of the "export" sections.
+
+    They are written under temporary names next to their destination, and
+    only renamed into place by commit(), once the whole archive was read, so
+    that a failed import leaves them as they were (see discard()).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (temporary file, destination)
+        self.files = []
+        # (destination, mode) of files already there with other permissions
+        self.modes = []
+        # Directories created, parents first
+        self.dirs = []
+
+    def makedirs(self, path: str):
+        """Create a directory and its missing parents"""
+        missing = []
+        while path and not os.path.isdir(path):
+            missing.append(path)
+            path = os.path.dirname(path)
+        for directory in reversed(missing):
+            os.makedirs(directory, exist_ok=True)
+            self.dirs.append(directory)
+
+    def write(self, src, dest: str, mode: int, expected: str = None):
+        """Write the stream ``src`` next to ``dest``, checking its SHA-256
+        against ``expected`` if given"""
+        with NamedTemporaryFile(
+            dir=os.path.dirname(dest), prefix=".konsave", delete=False
+        ) as tmp:
+            try:
+                digest = copy_hashed(src, tmp)
+                if expected:
+                    check_digest(digest, expected, dest)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+        os.chmod(tmp.name, mode)
+        with self._lock:
+            self.files.append((tmp.name, dest))
+
+    def chmod(self, dest: str, mode: int):
+        """Change the permissions of ``dest`` on commit"""
+        with self._lock:
+            self.modes.append((dest, mode))
+
+    def commit(self):
+        """Move the files written into place. If it fails, the files not
+        moved yet are left for discard()"""
+        while self.files:
+            tmp, dest = self.files[-1]
+            os.replace(tmp, dest)
+            self.files.pop()
+        for dest, mode in self.modes:
+            os.chmod(dest, mode)
+        self.files, self.modes, self.dirs = [], [], []
+
+    def discard(self):
+        """Remove the files written (and not committed) and the directories
+        created, unless they hold committed files"""
+        for tmp, _ in self.files:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+        for directory in reversed(self.dirs):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # Not empty: created by someone else meanwhile
+                pass
+        self.files, self.modes, self.dirs = [], [], []
+
+
+def check_digest(digest: str, expected: str, name: str):
+    """Raise ValueError if ``digest`` is not the ``expected`` one"""
+    if digest != expected:
+        raise ValueError(f"Corrupted archive member (SHA-256 mismatch): {name}")
+
+
+def read_integrity(arc: ZipFile) -> dict:
+    """Return the integrity records of an archive, None for archives written
+    before they were added"""
+    if INTEGRITY_NAME not in arc.NameToInfo:
+        return None
+    integrity = json.loads(arc.read(INTEGRITY_NAME))
+    assert (
+        integrity.get("version") == INTEGRITY_VERSION
+    ), f"Unsupported {INTEGRITY_NAME} version: {integrity.get('version')}"
+    return integrity
+
+
+def up_to_date(dest: str, record: dict) -> bool:
+    """Return True if a member does not need to be extracted, because the
+    object store (``dest`` None) or ``dest`` already holds its content.
+
+    Args:
+        dest: where the member goes, None for "save/" members
+        record: the integrity record of the member, if any
+    """
+    if not record:
+        return False
+    if dest is None:
+        return os.path.exists(object_path(record["sha256"]))
+    try:
+        if not stat.S_ISREG(os.lstat(dest).st_mode):
+            return False
+        if os.path.getsize(dest) != record["size"]:
+            return False
+    except FileNotFoundError:
+        return False
+    timings.count(open=1)
+    return hash_file(dest) == record["sha256"]
+
+
+def verify_archive(path: str) -> tuple:
+    """Read every file member of an archive in parallel and check it against
+    its integrity record (or only against its CRC if the archive has none).
+
+    Returns:
+        tuple: the integrity records (None if none) and a list of errors
+    """
+    with ZipFile(path, "r") as arc:
+        integrity = read_integrity(arc)
+        infos = [
+            zinfo
+            for zinfo in arc.infolist()
+            if not zinfo.is_dir() and zinfo.filename != INTEGRITY_NAME
+        ]
+    records = (integrity or {}).get("members", {})
+
+    def check(zinfo):
+        with timings.member_scope(zinfo.filename), timings.track():
+            try:
+                with readers.get().open(zinfo) as src:
+                    sha, size = hashlib.sha256(), 0
+                    for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                        sha.update(chunk)
+                        size += len(chunk)
+            except READ_ERRORS as ex:
+                return f"{zinfo.filename}: {ex}"
+            timings.count(bytes=size, stored=zinfo.compress_size)
+        if integrity is None:
+            return None
+        record = records.get(zinfo.filename)
+        if record is None:
+            return f"{zinfo.filename}: not in {INTEGRITY_NAME}"
+        if size != record["size"] or sha.hexdigest() != record["sha256"]:
+            return f"{zinfo.filename}: SHA-256 mismatch"
+        return None
+
+    with ZipReaders(path) as readers:
+        errors = [error for error in imap(check, infos) if error]
+    if not (integrity or {}).get("base"):
+        # The files of a delta archive that are not in it come from its base
+        names = {zinfo.filename for zinfo in infos}
+        errors.extend(f"{name}: missing" for name in records if name not in names)
+    if integrity and profile_digest(records) != integrity["digest"]:
+        errors.append(f"{INTEGRITY_NAME}: profile digest mismatch")
+    return integrity, errors
+
+
+def _listed(path: str, entries) -> bool:
+    """Return True if ``path`` is one of ``entries`` or inside one of them"""
+    return any(path == entry or path.startswith(f"{entry}/") for entry in entries)
+
+
+def import_members(arc, konsave_config: dict):
+    """Yield the members of an archive that an import writes.
+
+    All "save/" members are yielded, "export/" ones only for the entries
+    listed (and not filtered out) in the config.
+
+    Args:
+        arc: the open archive (ZipFile or ArchiveChain)
+        konsave_config: the parsed config of the archive
+
+    Yields:
+        tuple: the ZipInfo, the section name, the path in the section and the
+        destination (None for "save/" members)
+    """
+    for zinfo in arc.infolist():
+        target = import_target(zinfo.filename, zinfo.is_dir(), konsave_config)
+        if target:
+            yield (zinfo, *target)
+
+
+def import_target(name: str, is_dir: bool, konsave_config: dict) -> tuple:
+    """Return where an import puts a member, None if it does not.
+
+    Returns:
+        tuple: the section name, the path in the section and the destination
+        (None for "save/" members)
+    """
+    parts = member_parts(name)
+    if len(parts) < 3 or parts[0] not in ("save", "export"):
+        return None
+    rel = "/".join(parts[2:])
+    if parts[0] == "save":
+        return parts[1], rel, None
+
+    section = konsave_config["export"].get(parts[1])
+    if not _listed(rel, (section or {}).get("entries") or ()):
+        return None
+    if not section_patterns(section).keep_path(rel, is_dir):
+        return None
+    return parts[1], rel, os.path.join(section["location"], rel)
+
+
+def extract_member(data, mode: int, record: dict, into, target: str) -> bool:
+    """Store a "save/" member in the files of its manifest section (under
+    ``target``) or stage an "export/" one for ``target``, unless already
+    there.
+
+    Args:
+        data: callable returning the content of the member as a stream
+        mode: the permission bits of the member
+        record: its integrity record, if any
+        into: the files of the manifest section of a "save/" member, the
+            Staging of the import for an "export/" one
+        target: the path in the section, or the destination
+
+    Returns:
+        bool: True if written, False if up to date
+    """
+    saved = not isinstance(into, Staging)
+    if up_to_date(None if saved else target, record):
+        if saved:
+            into[target] = {
+                "digest": record["sha256"],
+                "size": record["size"],
+                "mode": mode,
+            }
+        elif stat.S_IMODE(os.stat(target).st_mode) != mode:
+            into.chmod(target, mode)
+        return False
+
+    expected = record["sha256"] if record else None
+    try:
+        with data() as src:
+            if saved:
+                into[target] = store_stream(src, mode)
+                if expected:
+                    check_digest(into[target]["digest"], expected, target)
+            else:
+                into.write(src, target, mode, expected)
+    except READ_ERRORS as ex:
+        raise ValueError(f"Corrupted archive member: {ex}") from ex
+    return True
+
+
+def extract_archive(
+    chain: ArchiveChain, konsave_config: dict, staging: Staging
+) -> dict:
+    """Stream every member of an archive (or chain of) to its final place.
+
+    Files under "save/" go into the object store and files under "export/"
+    are staged for the location of their section (only for the entries the
+    config lists), to be renamed into place once all succeeded. With
+    integrity records, every member is checked against its SHA-256 and the
+    ones already in place (same content) are not written at all.
+
+    Args:
+        chain: the archive and its deltas
+        konsave_config: the parsed config of the last archive
+        staging: where "export/" members are written until the import ends
+
+    Returns:
+        tuple: the manifest of the saved sections and a Counter of the files
+        "written" (and their "bytes") and "skipped"
+    """
+    manifest = new_manifest()
+    sections = manifest["sections"]
+    for name in konsave_config["save"]:
+        sections[name] = new_section()
+    exports = konsave_config["export"]
+    results = Counter()
+    lock = threading.Lock()
+
+    def extract(zinfo, into, target):
+        with timings.member_scope(zinfo.filename), timings.track():
+            written = extract_member(
+                partial(chain.open, zinfo),
+                member_mode(zinfo),
+                records.get(zinfo.filename),
+                into,
+                target,
+            )
+            if written:
+                timings.count(
+                    bytes=zinfo.file_size, stored=zinfo.compress_size, open=1, copy=1
+                )
+        with lock:
+            if written:
+                results["written"] += 1
+                results["bytes"] += zinfo.file_size
+            else:
+                results["skipped"] += 1
+
+    def members(section_span):
+        for zinfo, name, rel, dest in import_members(chain, konsave_config):
+            section_span(zinfo.filename)
+            if dest is None:
+                section = sections.setdefault(name, new_section())
+                if zinfo.is_dir():
+                    section["dirs"].append(rel)
+                else:
+                    yield zinfo, section["files"], rel
+                continue
+
+            if rel in exports[name]["entries"]:
+                log.info(f'Importing "{rel}"...')
+            if zinfo.is_dir():
+                staging.makedirs(dest)
+            else:
+                staging.makedirs(os.path.dirname(dest))
+                yield zinfo, staging, dest
+
+    records = chain.records
+    with timings.member_spans() as section_span:
+        parallel(extract, members(section_span))
+    return manifest, results
+
+
+class TreeNode:
+    """The totals of a directory of an archive, or a single file"""
+
+    __slots__ = ("files", "size", "compressed", "method", "children")
+
+    def __init__(self, method: str = None):
+        self.files = 0
+        self.size = 0
+        self.compressed = 0
+        # None for directories
+        self.method = method
+        self.children = {} if method is None else None
+
+    def is_dir(self) -> bool:
+        """Return True for directories"""
+        return self.method is None
+
+    def add(self, size: int, compressed: int):
+        """Count a file"""
+        self.files += 1
+        self.size += size
+        self.compressed += compressed
+
+
+def archive_tree(members, depth: int = None) -> tuple:
+    """Aggregate the members of an archive as a tree, in a single pass.
+
+    Args:
+        members: iterable of (name, size, compressed size, method), the
+            names of directories ending with "/"
+        depth: the deepest level kept. The files below it are only counted
+            in their parent at that level
+
+    Returns:
+        tuple: the root TreeNode and the TreeNode of every section
+        ("save/<name>" and "export/<name>"), whatever the depth
+    """
+    root = TreeNode()
+    sections = {}
+    for name, size, compressed, method in members:
+        is_dir = name.endswith("/")
+        parts = name.rstrip("/").split("/")
+        if not is_dir:
+            root.add(size, compressed)
+            if len(parts) > 2 and parts[0] in ("save", "export"):
+                section = "/".join(parts[:2])
+                sections.setdefault(section, TreeNode()).add(size, compressed)
+
+        node = root
+        for level, part in enumerate(parts[:depth], 1):
+            child = node.children.get(part)
+            if child is None:
+                leaf = not is_dir and level == len(parts)
+                child = node.children[part] = TreeNode(method if leaf else None)
+            if not is_dir:
+                child.add(size, compressed)
+            node = child
+    return root, sections
@@ -3,107 +3,246 @@ This module parses conf.yaml
 """
 import os
 import re
+import copy
+import json
+import logging
+from functools import lru_cache
+from tempfile import NamedTemporaryFile
 
-try:
-    import yaml
-except ModuleNotFoundError as error:
-    raise ModuleNotFoundError(
-        "Please install the module PyYAML using pip: \n pip install PyYAML"
-    ) from error
+from konsave.consts import (
+    HOME,
+    CONFIG_DIR,
+    SHARE_DIR,
+    BIN_DIR,
+    CONFIG_CACHE_FILE,
+    CONFIG_FILE,
+    PROFILES_DIR,
+)
 
-from konsave.consts import HOME, CONFIG_DIR, SHARE_DIR, BIN_DIR
 
+log = logging.getLogger("Konsave")
 
-def ends_with(value, path, token) -> str:
+# Number of config files kept in the cache
+CACHE_SIZE = 32
+
+
+@lru_cache(maxsize=None)
+def _listdir(path: str) -> tuple:
+    """Memoized, sorted os.listdir (empty if ``path`` does not exist)"""
+    try:
+        return tuple(sorted(os.listdir(path)))
+    except OSError:
+        return ()
+
+
+def ends_with(value, path) -> str:
     """Finds folder with name ending with the provided value in
     the given path.
 
     Args:
         value: the value of ENDS_WITH
-        path: path
-        token: The full token matched in the path (ex. ${ENDS_WITH='.default-release'})
+        path: the directory to look into
+
+    Returns:
+        The name of the first match or None
     """
-    dirs = os.listdir(path[0:token])
-    for directory in dirs:
+    for directory in _listdir(path):
         if directory.endswith(value):
-            return path.replace(token, directory)
-    return token
+            return directory
+    return None
 
 
-def begins_with(value, path, token) -> str:
+def begins_with(value, path) -> str:
     """Finds folder with name beginning with the provided string.
 
     Args:
         value: the value of BEGINS_WITH
-        path: path
-        token: The full token matched in the path (ex. ${ENDS_WITH='.default-release'})
+        path: the directory to look into
+
+    Returns:
+        The name of the first match or None
     """
-    dirs = os.listdir(path[0:token])
-    for directory in dirs:
+    for directory in _listdir(path):
         if directory.startswith(value):
-            return path.replace(token, directory)
-    return token
+            return directory
+    return None
+
 
+def resolve(location: str, tokens=None) -> str:
+    """Replaces keywords and functions in a location, in a single pass. For
+    example, $HOME becomes /home/username and ${ENDS_WITH='text'} becomes the
+    folder (in the location resolved so far) whose name ends with "text".
 
-def _parse_keywords(parsed, tokens=None):
-    """Replaces keywords with values in conf.yaml. For example,
-    it will replace, $HOME with /home/username/
+    Unknown keywords and functions without a match are left as they are.
 
     Args:
-        parsed: the parsed conf.yaml file
+        location: the location to resolve
         tokens: the token dictionary
     """
     tokens = tokens or TOKENS
-    for item in parsed:
-        for name in parsed[item]:
-            for key, value in tokens["keywords"].items():
-                word = TOKEN_SYMBOL + key
-                location = parsed[item][name]["location"]
-                if word in location:
-                    parsed[item][name]["location"] = location.replace(word, value)
+    resolved = []
+    pos = 0
+    for match in TOKEN_RE.finditer(location):
+        resolved.append(location[pos : match.start()])
+        pos = match.end()
+        func, value, keyword = match.groups()
+        if keyword:
+            resolved.append(tokens["keywords"].get(keyword, match.group(0)))
+            continue
+        replacement = None
+        if func in tokens["functions"]:
+            replacement = tokens["functions"][func](value, "".join(resolved))
+        resolved.append(replacement or match.group(0))
+    resolved.append(location[pos:])
+    return "".join(resolved)
 
 
-def _parse_functions(parsed, tokens=None):
-    """Replaces functions with values in conf.yaml. For example, it will replace,
-    ${ENDS_WITH='text'} with a folder whose name ends with "text"
+def _resolve_locations(parsed, tokens=None):
+    """Resolves the tokens in the location of every save/export item
 
     Args:
         parsed: the parsed conf.yaml file
         tokens: the token dictionary
     """
-    tokens = tokens or TOKENS
+    for item in SECTIONS:
+        for section in (parsed.get(item) or {}).values():
+            section["location"] = resolve(section["location"], tokens)
+
+
+def _load_yaml(text: str):
+    """Parse YAML text. PyYAML is only imported here, on a cache miss"""
+    try:
+        import yaml  # pylint: disable=import-outside-toplevel
+    except ModuleNotFoundError as error:
+        raise ModuleNotFoundError(
+            "Please install the module PyYAML using pip: \n pip install PyYAML"
+        ) from error
+
+    # The C loader is an order of magnitude faster, when libyaml is available
+    return yaml.load(text, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def _read_cache() -> dict:
+    """Return the cached configs, keyed by their absolute path"""
+    try:
+        with open(CONFIG_CACHE_FILE, "r", encoding="utf-8") as src:
+            return json.load(src)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(cache: dict):
+    """Atomically replace the config cache, ignoring any failure"""
+    try:
+        with NamedTemporaryFile(
+            "w",
+            dir=os.path.dirname(CONFIG_CACHE_FILE),
+            prefix=".tmp",
+            delete=False,
+            encoding="utf-8",
+        ) as tmp:
+            json.dump(cache, tmp)
+        os.replace(tmp.name, CONFIG_CACHE_FILE)
+    except (OSError, TypeError, ValueError) as ex:
+        log.debug(f"Could not update config cache: {ex}")
+
+
+def _cacheable(path: str) -> bool:
+    """Return True for the config files worth caching: the user's conf.yaml
+    and the ones of saved profiles. Others (eg. extracted from an archive to
+    a temporary directory) would never be read again"""
+    return path == CONFIG_FILE or path.startswith(os.path.join(PROFILES_DIR, ""))
+
+
+def load(config_file: str) -> dict:
+    """Load a config file as is (without resolving any tokens).
 
-    for item in parsed:
-        for name in parsed[item]:
-            location = parsed[item][name]["location"]
-            occurences = FUNC_RE.findall(location)
-            if not occurences:
-                continue
-            for token, func, value in occurences:
-                if func in tokens["functions"]:
-                    parsed[item][name]["location"] = tokens["functions"][func](
-                        value, location, token
-                    )
+    The result is cached in CONFIG_CACHE_FILE, keyed by the path, mtime, size
+    and inode of the file, so YAML is only parsed when the file changes. Only
+    the files for which _cacheable() is True are cached.
 
+    Args:
+        config_file: Path to the config file
+
+    Returns:
+        Dict
+    """
+    path = os.path.abspath(config_file)
+    if not _cacheable(path):
+        with open(path, "r", encoding="utf-8") as text:
+            return _load_yaml(text.read())
+
+    st = os.stat(path)
+    key = [st.st_mtime_ns, st.st_size, st.st_ino]
+
+    cache = _read_cache()
+    cached = cache.get(path)
+    if cached and cached["key"] == key:
+        return cached["config"]
+
+    with open(path, "r", encoding="utf-8") as text:
+        konsave_config = _load_yaml(text.read())
+
+    cache.pop(path, None)
+    cache[path] = {"key": key, "config": konsave_config}
+    for old in list(cache)[:-CACHE_SIZE]:
+        del cache[old]
+    _write_cache(cache)
+    return konsave_config
 
-def parse(config_file: str):
+
+def parse(config_file: str, tokens=None):
     """Parse and return the config given a file path
 
     Args:
         config_file: Path to the config file
+        tokens: the token dictionary, defaults to the current user's
 
     Returns:
         Dict
     """
-    with open(config_file, "r", encoding="utf-8") as text:
-        konsave_config = yaml.load(text.read(), Loader=yaml.SafeLoader)
-    _parse_keywords(konsave_config)
-    _parse_functions(konsave_config)
+    konsave_config = load(config_file)
+    _resolve_locations(konsave_config, tokens)
     return konsave_config
 
 
+def parse_homes(config_file: str, homes) -> dict:
+    """Parse a config file once and resolve it for several users
+
+    Args:
+        config_file: Path to the config file
+        homes: the home directories of the users
+
+    Returns:
+        Dict: the config of every home, by home directory
+    """
+    konsave_config = load(config_file)
+    parsed = {}
+    for home in homes:
+        parsed[home] = copy.deepcopy(konsave_config)
+        _resolve_locations(parsed[home], home_tokens(home))
+    return parsed
+
+
+def home_tokens(home: str) -> dict:
+    """Return the token dictionary of the user whose home directory is ``home``"""
+    return {
+        "keywords": {
+            "HOME": home,
+            "CONFIG_DIR": os.path.join(home, ".config"),
+            "SHARE_DIR": os.path.join(home, ".local/share"),
+            "BIN_DIR": os.path.join(home, ".local/bin"),
+        },
+        "functions": TOKENS["functions"],
+    }
+
+
+# Top-level keys holding entries with a "location"
+SECTIONS = ("save", "export")
 TOKEN_SYMBOL = "$"
-FUNC_RE = re.compile(rf"\{TOKEN_SYMBOL}\{{(\w+)\=(?:\"|')(\S+)(?:\"|')\}}")
+TOKEN_RE = re.compile(
+    rf"\{TOKEN_SYMBOL}\{{(\w+)\=(?:\"|')(\S+?)(?:\"|')\}}|\{TOKEN_SYMBOL}(\w+)"
+)
 TOKENS = {
     "keywords": {
         "HOME": HOME,
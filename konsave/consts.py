@@ -2,7 +2,6 @@
 This module contains all the variables for konsave
 """
 import os
-from konsave import __version__
 
 
 HOME = os.path.expandvars("$HOME")
@@ -11,14 +10,53 @@ SHARE_DIR = os.path.join(HOME, ".local/share")
 BIN_DIR = os.path.join(HOME, ".local/bin")
 KONSAVE_DIR = os.path.join(CONFIG_DIR, "konsave")
 PROFILES_DIR = os.path.join(KONSAVE_DIR, "profiles")
+OBJECTS_DIR = os.path.join(KONSAVE_DIR, "objects")
+# What the last apply replaced, for "konsave rollback"
+ROLLBACK_DIR = os.path.join(KONSAVE_DIR, "rollback")
 CONFIG_FILE = os.path.join(KONSAVE_DIR, "conf.yaml")
+# Summary of every profile, for "konsave list"
+INDEX_FILE = os.path.join(KONSAVE_DIR, "index.json")
+# File listing the saved files of a profile, in its directory
+MANIFEST_NAME = "manifest.json"
+# Throughput of past runs, to estimate durations for --dry-run
+THROUGHPUT_FILE = os.path.join(KONSAVE_DIR, "throughput.json")
+# Parsed config files, keyed by path, mtime, size and inode
+CONFIG_CACHE_FILE = os.path.join(KONSAVE_DIR, "conf.cache.json")
+# Digests of live files, keyed by path, size, mtime and inode, for diff
+HASH_CACHE_FILE = os.path.join(KONSAVE_DIR, "hashes.json")
 
 EXPORT_EXTENSION = ".knsv"
 
-KDE_RELOAD_CMD = "killall plasmashell; kstart plasmashell"
+# Threads used for file operations, unless set with -j/--jobs
+WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# Ways to copy a file, tried in this order ("auto") unless one is forced with
+# --copy-backend or $KONSAVE_COPY_BACKEND
+COPY_BACKENDS = ("reflink", "copy_file_range", "sendfile", "buffered")
+COPY_BACKEND = os.environ.get("KONSAVE_COPY_BACKEND", "auto")
 
-# Create PROFILES_DIR if it doesn't exist
-if not os.path.exists(PROFILES_DIR):
-    os.makedirs(PROFILES_DIR)
+# Already compressed file types, stored as-is in archives unless the
+# "compression" section of conf.yaml says otherwise
+COMPRESSED_EXTENSIONS = (
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".webp",
+    ".gif",
+    ".svgz",
+    ".woff",
+    ".woff2",
+    ".gz",
+    ".bz2",
+    ".xz",
+    ".zst",
+    ".zip",
+    ".7z",
+    ".knsv",
+    ".mp3",
+    ".ogg",
+    ".oga",
+    ".flac",
+)
 
-VERSION = __version__
+KDE_RELOAD_CMD = "killall plasmashell; kstart plasmashell"
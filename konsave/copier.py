@@ -0,0 +1,376 @@
+"""
+This module contains the file copy engine used by save, apply, export and import.
+
+Trees are walked with os.scandir (so the file type comes from the directory
+entry instead of extra stat calls) and the per-file work runs in a bounded
+thread pool, overlapping I/O across files.
+
+File data is copied by the kernel when possible: as a reflink (FICLONE,
+btrfs/xfs/...) sharing the extents of the source, else with copy_file_range
+or sendfile, and only as a last resort through a userspace buffer.
+"""
+
+import os
+import re
+import errno
+import fcntl
+import shutil
+import logging
+import threading
+from functools import lru_cache
+from collections import Counter, deque
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from konsave.consts import COPY_BACKEND, COPY_BACKENDS, WORKERS
+
+
+log = logging.getLogger("Konsave")
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+BUFFER_SIZE = 1024 * 1024
+# Errors meaning that a backend cannot copy between two files, as opposed to
+# an actual I/O error
+UNSUPPORTED = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EINVAL,
+    errno.EBADF,
+    errno.ENOTTY,
+    errno.ENOTSOCK,
+    errno.EPERM,
+}
+
+_workers = WORKERS
+_copy_backend = COPY_BACKEND
+_lock = threading.Lock()
+# Backends known not to work between two devices, (src, dst) -> set
+_unsupported = {}
+_usage = Counter()
+
+
+def set_workers(workers: int):
+    """Set the number of threads used for file operations"""
+    global _workers  # pylint: disable=global-statement
+    assert workers > 0, "The number of jobs must be positive"
+    _workers = workers
+
+
+def set_copy_backend(backend: str):
+    """Force the backend used to copy files ("auto" to pick the fastest)"""
+    global _copy_backend  # pylint: disable=global-statement
+    assert (
+        backend == "auto" or backend in COPY_BACKENDS
+    ), f"Unknown copy backend '{backend}', use one of: auto, {', '.join(COPY_BACKENDS)}"
+    _copy_backend = backend
+
+
+def backend_usage() -> dict:
+    """Return the number of files copied by each backend"""
+    with _lock:
+        return dict(_usage)
+
+
+def _reflink(src_fd: int, dst_fd: int) -> bool:
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    return True
+
+
+def _copy_file_range(src_fd: int, dst_fd: int) -> bool:
+    copied = 0
+    while True:
+        sent = os.copy_file_range(src_fd, dst_fd, BUFFER_SIZE * 8)
+        if not sent:
+            # Files of procfs and the like look empty to copy_file_range
+            return copied > 0
+        copied += sent
+
+
+def _sendfile(src_fd: int, dst_fd: int) -> bool:
+    offset = 0
+    while True:
+        sent = os.sendfile(dst_fd, src_fd, offset, BUFFER_SIZE * 8)
+        if not sent:
+            return offset > 0
+        offset += sent
+
+
+def _buffered(src_fd: int, dst_fd: int) -> bool:
+    with open(src_fd, "rb", closefd=False) as src, open(
+        dst_fd, "wb", closefd=False
+    ) as dst:
+        shutil.copyfileobj(src, dst, BUFFER_SIZE)
+    return True
+
+
+_BACKENDS = {
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range,
+    "sendfile": _sendfile,
+    "buffered": _buffered,
+}
+
+
+def copy_fileobj(fsrc, fdst) -> str:
+    """Copy the whole content of a file to an empty one.
+
+    Unless a backend is forced (see set_copy_backend), backends are tried in
+    the order of COPY_BACKENDS and the ones failing between two devices are
+    not tried again for them. A backend "fails" if it raises one of
+    UNSUPPORTED or copies nothing, before having written anything.
+
+    Args:
+        fsrc: the source, a binary file open for reading at offset 0
+        fdst: the destination, an empty binary file open for writing
+
+    Returns:
+        str: the backend used
+    """
+    fdst.flush()
+    src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+    if _copy_backend != "auto":
+        try:
+            _BACKENDS[_copy_backend](src_fd, dst_fd)
+        except OSError as ex:
+            raise ValueError(
+                f"Copy backend '{_copy_backend}' cannot copy {fsrc.name}: {ex}"
+            ) from ex
+        return _count(_copy_backend)
+
+    devices = (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+    unsupported = _unsupported.get(devices, ())
+    for backend in COPY_BACKENDS:
+        if backend in unsupported:
+            continue
+        try:
+            if _BACKENDS[backend](src_fd, dst_fd):
+                return _count(backend)
+            # Nothing copied: retry empty (or procfs-like) files with the next
+            continue
+        except AttributeError:
+            # os.copy_file_range or os.sendfile missing on this platform
+            pass
+        except OSError as ex:
+            if ex.errno not in UNSUPPORTED or os.fstat(dst_fd).st_size:
+                raise
+        log.debug(f"Copy backend '{backend}' not supported for {fsrc.name}")
+        with _lock:
+            _unsupported.setdefault(devices, set()).add(backend)
+    # Unreachable: the buffered backend always works
+    raise OSError(f"Could not copy {fsrc.name}")
+
+
+def _count(backend: str) -> str:
+    with _lock:
+        _usage[backend] += 1
+    return backend
+
+
+def _glob_to_regex(pattern: str) -> str:
+    """Translate a glob into a regex matching "/" separated relative paths.
+
+    ``*``, ``?`` and ``[...]`` never match "/" while ``**`` matches across
+    directories. A pattern without "/" matches a name at any depth, others
+    are relative to the section location.
+    """
+    pattern = pattern.strip("/")
+    anchored = "/" in pattern
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+            continue
+        end = pattern.find("]", i + 2)
+        if char == "[" and end != -1:
+            chars = pattern[i + 1 : end].replace("\\", "\\\\")
+            if chars[0] == "!":
+                chars = "^" + chars[1:]
+            elif chars[0] in "^[":
+                # A literal, like in fnmatch, not a negation (or a nested set)
+                chars = "\\" + chars
+            regex.append(f"(?!/)[{chars}]")
+            i = end + 1
+            continue
+        regex.append({"*": "[^/]*", "?": "[^/]"}.get(char, re.escape(char)))
+        i += 1
+    return ("" if anchored else "(?:.*/)?") + "".join(regex)
+
+
+def _compile(patterns: tuple):
+    """Compile globs into a single regex, None if there are none"""
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{_glob_to_regex(p)})" for p in patterns) + "$")
+
+
+class Patterns:
+    """The include/exclude globs of a config section.
+
+    Excluded paths are skipped, and so is everything under an excluded
+    directory. If there are include patterns, only the files matching one of
+    them are kept (directories are still walked, unless excluded).
+    """
+
+    def __init__(self, include: tuple = (), exclude: tuple = ()):
+        self._include = _compile(include)
+        self._exclude = _compile(exclude)
+
+    def __bool__(self):
+        return bool(self._include or self._exclude)
+
+    def keep(self, rel: str, is_dir: bool = False) -> bool:
+        """Return True unless the path ``rel`` itself is filtered out"""
+        if self._exclude and self._exclude.match(rel):
+            return False
+        return is_dir or not self._include or bool(self._include.match(rel))
+
+    def keep_path(self, rel: str, is_dir: bool = False) -> bool:
+        """Like keep(), also checking that no parent directory is excluded"""
+        if not self:
+            return True
+        parts = rel.split("/")
+        for i in range(1, len(parts)):
+            if not self.keep("/".join(parts[:i]), True):
+                return False
+        return self.keep(rel, is_dir)
+
+
+@lru_cache(maxsize=None)
+def _patterns(include: tuple, exclude: tuple) -> Patterns:
+    return Patterns(include, exclude)
+
+
+def section_patterns(section: dict) -> Patterns:
+    """Return the (compiled once) include/exclude patterns of a config section"""
+    return _patterns(
+        tuple(section.get("include") or ()), tuple(section.get("exclude") or ())
+    )
+
+
+def walk(path: str, prefix: str = "", patterns: Patterns = None):
+    """Walk a directory tree, following symlinks like os.path.isdir does.
+
+    Directories are always yielded before their contents and each directory
+    is listed in name order.
+
+    Args:
+        path: the directory to walk
+        prefix: prepended to the relative paths yielded
+        patterns: skip what these filter out, without descending into
+            excluded directories
+
+    Yields:
+        tuple: the relative path (with "/" separators) and the os.DirEntry
+    """
+    stack = [(path, prefix)]
+    while stack:
+        top, rel = stack.pop()
+        with os.scandir(top) as listing:
+            items = sorted(listing, key=lambda item: item.name)
+        subdirs = []
+        for item in items:
+            item_rel = f"{rel}/{item.name}" if rel else item.name
+            is_dir = item.is_dir()
+            if patterns and not patterns.keep(item_rel, is_dir):
+                continue
+            yield item_rel, item
+            if is_dir:
+                subdirs.append((item.path, item_rel))
+        stack.extend(reversed(subdirs))
+
+
+def existing_entries(section: dict):
+    """Yield the entries of a config section that exist in its location and
+    are not filtered out by its patterns.
+
+    Args:
+        section: a parsed config section (with "location" and "entries")
+
+    Yields:
+        tuple: the entry and its full path
+    """
+    patterns = section_patterns(section)
+    for entry in section["entries"] or ():
+        source = os.path.join(section["location"], entry)
+        if not os.path.exists(source):
+            log.debug(f"File or directory '{source}' does not exist")
+            continue
+        if not patterns.keep_path(entry, os.path.isdir(source)):
+            log.debug(f"'{source}' is excluded")
+            continue
+        yield entry, source
+
+
+def parallel(func, items, workers: int = None):
+    """Call ``func(*item)`` for every item in a bounded thread pool.
+
+    Items are consumed lazily, so generators may keep creating directories
+    or collecting state while earlier items are processed. The first
+    exception raised by ``func`` is re-raised once submitted work settles.
+
+    Args:
+        func: the function to call
+        items: iterable of argument tuples
+        workers: number of threads, defaults to the configured --jobs
+    """
+    workers = workers or _workers
+    if workers == 1:
+        for item in items:
+            func(*item)
+        return
+
+    with ThreadPoolExecutor(workers, thread_name_prefix="konsave") as pool:
+        pending = set()
+        try:
+            for item in items:
+                if len(pending) >= workers * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                # Run in a copy of our context, for the timings row
+                pending.add(pool.submit(copy_context().run, func, *item))
+            for future in pending:
+                future.result()
+        except BaseException:
+            pool.shutdown(cancel_futures=True)
+            raise
+
+
+def imap(func, items, workers: int = None):
+    """Like map(), but ``func`` runs in a bounded thread pool.
+
+    Results are yielded in the order of ``items`` while up to two items per
+    thread are processed ahead of the consumer.
+
+    Args:
+        func: the function to call with every item
+        items: iterable of arguments
+        workers: number of threads, defaults to the configured --jobs
+    """
+    workers = workers or _workers
+    if workers == 1:
+        yield from map(func, items)
+        return
+
+    with ThreadPoolExecutor(workers, thread_name_prefix="konsave") as pool:
+        ahead = deque()
+        try:
+            for item in items:
+                if len(ahead) >= workers * 2:
+                    yield ahead.popleft().result()
+                ahead.append(pool.submit(copy_context().run, func, item))
+            while ahead:
+                yield ahead.popleft().result()
+        except BaseException:
+            pool.shutdown(cancel_futures=True)
+            raise
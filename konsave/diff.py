@@ -0,0 +1,215 @@
+"""
+This module compares profiles with the live files, or with each other.
+
+A saved file whose size, mtime and inode did not change since it was saved
+is taken as unchanged, like on save. Other files with the size of the saved
+one are hashed, and their digest is kept in HASH_CACHE_FILE keyed by their
+path, size, mtime and inode, so that the next diff does not hash them again
+(eg. files written by apply, which get a new inode). Files of different size
+are never hashed.
+"""
+
+import os
+import json
+import difflib
+import logging
+import threading
+from tempfile import NamedTemporaryFile
+
+from konsave import timings
+from konsave.consts import HASH_CACHE_FILE
+from konsave.copier import existing_entries, imap, parallel, section_patterns, walk
+from konsave.store import hash_file, object_path, unchanged
+
+
+log = logging.getLogger("Konsave")
+
+# Number of digests kept in the cache, the least recently used are evicted
+CACHE_SIZE = 100000
+# Larger files are not shown as unified diffs
+TEXT_LIMIT = 1024 * 1024
+
+
+class HashCache:
+    """The digests of live files, by path, size, mtime and inode"""
+
+    def __init__(self):
+        try:
+            with open(HASH_CACHE_FILE, "r", encoding="utf-8") as src:
+                self.entries = json.load(src)
+        except (OSError, ValueError):
+            self.entries = {}
+        self._lock = threading.Lock()
+        self._changed = False
+
+    def digest(self, path: str, st: os.stat_result) -> str:
+        """Return the digest of a file, hashing it only if not cached"""
+        key = [st.st_size, st.st_mtime_ns, st.st_ino]
+        with self._lock:
+            cached = self.entries.pop(path, None)
+            if cached and cached[:3] == key:
+                # Most recently used last
+                self.entries[path] = cached
+                return cached[3]
+
+        with timings.track():
+            digest = hash_file(path)
+            timings.count(bytes=st.st_size, open=1)
+        with self._lock:
+            self.entries[path] = [*key, digest]
+            self._changed = True
+        return digest
+
+    def save(self):
+        """Write the cache, evicting the least recently used digests"""
+        for path in list(self.entries)[:-CACHE_SIZE]:
+            del self.entries[path]
+            self._changed = True
+        if not self._changed:
+            return
+        try:
+            with NamedTemporaryFile(
+                "w",
+                dir=os.path.dirname(HASH_CACHE_FILE),
+                prefix=".tmp",
+                delete=False,
+                encoding="utf-8",
+            ) as tmp:
+                json.dump(self.entries, tmp)
+            os.replace(tmp.name, HASH_CACHE_FILE)
+        except OSError as ex:
+            log.debug(f"Could not update hash cache: {ex}")
+
+
+def _entry_files(item: tuple) -> list:
+    """List the files of an entry of a config section, like save does"""
+    entry, source, patterns = item
+    if not os.path.isdir(source):
+        return [(entry, source)]
+    return [
+        (rel, found.path)
+        for rel, found in walk(source, entry, patterns)
+        if not found.is_dir()
+    ]
+
+
+def live_files(section: dict) -> dict:
+    """Return the paths of the live files of a config section, by their path
+    relative to its location. Entries are walked in parallel"""
+    patterns = section_patterns(section)
+    entries = ((entry, source, patterns) for entry, source in existing_entries(section))
+    files = {}
+    for found in imap(_entry_files, entries):
+        files.update(found)
+    return files
+
+
+def _changes() -> dict:
+    return {"added": {}, "removed": {}, "modified": {}}
+
+
+def _saved(record: dict) -> tuple:
+    """Return the path of the saved content of a manifest record and its size"""
+    return object_path(record["digest"]), record["size"]
+
+
+def diff_live(profile_config: dict, sections: dict, cache: HashCache) -> dict:
+    """Compare the files of a profile with the live ones.
+
+    Args:
+        profile_config: the "save" part of the parsed profile config
+        sections: the manifest sections of the profile
+        cache: the digests of live files
+
+    Returns:
+        dict: by section, the files "added" (live only), "removed" (saved
+        only) and "modified", by relative path. Each is a pair of the saved
+        and the live file, as (path, size), None if missing
+    """
+    changes = {}
+    lock = threading.Lock()
+
+    def compare(name, rel, record, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        timings.count(stat=1)
+        if record is None:
+            kind = "added"
+        elif st.st_size == record["size"] and (
+            unchanged(st, record) or cache.digest(path, st) == record["digest"]
+        ):
+            return
+        else:
+            kind = "modified"
+        with lock:
+            changes[name][kind][rel] = (
+                _saved(record) if record else None,
+                (path, st.st_size),
+            )
+
+    def files():
+        for name, section in profile_config.items():
+            saved = sections.get(name, {}).get("files", {})
+            changes[name] = _changes()
+            live = live_files(section)
+            for rel in saved.keys() - live.keys():
+                changes[name]["removed"][rel] = (_saved(saved[rel]), None)
+            for rel, path in live.items():
+                yield name, rel, saved.get(rel), path
+
+    parallel(compare, files())
+    return changes
+
+
+def diff_manifests(before: dict, after: dict) -> dict:
+    """Compare the manifest sections of two profiles.
+
+    Returns:
+        dict: by section, the files "added", "removed" and "modified" (see
+        diff_live())
+    """
+    changes = {}
+    for name in {**before, **after}:
+        old = before.get(name, {}).get("files", {})
+        new = after.get(name, {}).get("files", {})
+        section = changes[name] = _changes()
+        for rel in old.keys() - new.keys():
+            section["removed"][rel] = (_saved(old[rel]), None)
+        for rel in new.keys() - old.keys():
+            section["added"][rel] = (None, _saved(new[rel]))
+        for rel in old.keys() & new.keys():
+            if old[rel]["digest"] != new[rel]["digest"]:
+                section["modified"][rel] = (_saved(old[rel]), _saved(new[rel]))
+    return changes
+
+
+def _read_text(path: str) -> list:
+    """Return the lines of a text file, None if binary or too large"""
+    if os.path.getsize(path) > TEXT_LIMIT:
+        return None
+    with open(path, "rb") as src:
+        data = src.read()
+    if b"\0" in data:
+        return None
+    try:
+        return data.decode("utf-8").splitlines(keepends=True)
+    except UnicodeDecodeError:
+        return None
+
+
+def unified_diff(rel: str, before: tuple, after: tuple) -> str:
+    """Return the unified diff of two versions of a text file (only a line
+    saying they differ if one of them is binary or too large).
+
+    Args:
+        rel: the path of the file, for the headers
+        before: the old file, as (path, size), None if none
+        after: the new file, as (path, size), None if none
+    """
+    old = _read_text(before[0]) if before else []
+    new = _read_text(after[0]) if after else []
+    if old is None or new is None:
+        return f"Binary files a/{rel} and b/{rel} differ\n"
+    return "".join(difflib.unified_diff(old, new, f"a/{rel}", f"b/{rel}"))
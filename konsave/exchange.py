@@ -0,0 +1,419 @@
+"""
+This module contains the commands sharing profiles through archives: export,
+import, verify and ls-archive.
+"""
+
+import os
+import sys
+import json
+import logging
+from itertools import chain
+from pathlib import Path
+import shutil
+from datetime import datetime
+from functools import partial
+from tempfile import TemporaryDirectory, mkdtemp
+from zipfile import is_zipfile, ZipFile
+
+from konsave.consts import CONFIG_FILE, KONSAVE_DIR, PROFILES_DIR, EXPORT_EXTENSION
+from konsave.archive import (
+    ArchiveChain,
+    METHOD_NAMES,
+    Member,
+    Staging,
+    TreeNode,
+    archive_tree,
+    compression_policy,
+    export_members,
+    extract_archive,
+    read_integrity,
+    verify_archive,
+    profile_members,
+    write_archive,
+)
+from konsave.config import parse
+from konsave.funcs import mkdir, print_plan
+from konsave.index import add_profile
+from konsave.history import snapshot
+from konsave.profiles import convert, get_profiles
+from konsave.plan import plan_export, plan_import, plan_stream, start_run
+from konsave.stream import (
+    default_format,
+    extract_stream,
+    is_stream_archive,
+    open_input,
+    read_stream,
+    verify_stream,
+    write_stream_archive,
+)
+from konsave.store import (
+    collect_garbage,
+    load_manifest,
+    store_lock,
+    write_manifest,
+)
+
+
+log = logging.getLogger("Konsave")
+
+
+def export(args):
+    """It will export the specified profile as a ".knsv" to the specified directory.
+       If there is no specified directory, the directory is set to the current working directory.
+
+    Args:
+        args.name: name of the profile to be exported
+        args.directory: output directory for the export
+        args.force: force the overwrite of existing export file
+        args.archive_name: the name of the resulting archive
+        args.base: an archive to write a delta of (only the changed files)
+        args.format: "zip" or a stream format (see stream.STREAM_FORMATS),
+            a stream by default when writing to stdout ("-o -")
+    """
+    profile_name = args.name
+    fmt = args.format or ("zip" if args.output != "-" else default_format())
+    profile_list, profile_count = get_profiles()
+    # assert
+    assert profile_count != 0, "No profile saved yet."
+    assert profile_name in profile_list, f"Profile not found: {profile_name}"
+
+    # run
+    profile_dir = os.path.join(PROFILES_DIR, profile_name)
+    final_path = _export_path(args)
+
+    konsave_config = parse(os.path.join(profile_dir, "conf.yaml"))
+    policy = compression_policy(konsave_config)
+    sections = load_manifest(profile_dir)["sections"]
+
+    base = None
+    if args.base:
+        assert fmt == "zip", "Delta archives can only be zip archives"
+        assert is_zipfile(args.base), f"Not a valid konsave file: {args.base}"
+        with ZipFile(args.base, "r") as arc:
+            base = read_integrity(arc)
+        assert (
+            base
+        ), f"{args.base} was exported by an older konsave, it cannot be a base"
+
+    members = chain(
+        [Member("conf.yaml", CONFIG_FILE)],
+        profile_members(profile_dir, konsave_config, sections),
+        export_members(konsave_config),
+    )
+    if args.dry_run:
+        print_plan("export", plan_export(members, base))
+        return
+
+    log.info("Exporting profile. It might take a minute or two...")
+    done = start_run("export")
+    if fmt == "zip":
+        files, size = write_archive(final_path, members, policy, base)
+    else:
+        files, size = write_stream_archive(final_path, members, fmt, policy.level)
+    done(files, size)
+    if base:
+        log.info(f"Delta of {args.base}: {files} new or changed files")
+
+    log.info(f"Successfully exported to {final_path}")
+
+
+def _export_path(args) -> str:
+    """Return the path of the archive to export, "-" for stdout"""
+    if args.output in ("-", "/dev/stdout"):
+        return args.output
+    if args.output:
+        out = Path(args.output)
+        # remove anything after a dot (ie rm all suffixes)
+        if out.suffixes:
+            out = out.parent / out.name.split(out.suffixes[0])[0]
+        export_path = str(out)
+    else:
+        export_path = os.path.join(os.getcwd(), args.name)
+
+    # Only continue if export_path, export_path.ksnv and export_path.zip don't exist
+    # Appends date and time to create a unique file name
+    if not args.force:
+        orig_export_path = export_path
+        while True:
+            paths = [f"{export_path}", f"{export_path}.knsv", f"{export_path}.zip"]
+            if not any(os.path.exists(path) for path in paths):
+                break
+            export_path = f"{orig_export_path}_{datetime.now().isoformat()}"
+    return export_path + EXPORT_EXTENSION
+
+
+def extract_config(path: str, directory: str) -> str:
+    """Extract the conf.yaml of an archive into ``directory`` and return its path"""
+    config_location = os.path.join(directory, "conf.yaml")
+    with ZipFile(path, "r") as zip_file:
+        assert "conf.yaml" in zip_file.NameToInfo, "Not a valid konsave file"
+        with zip_file.open("conf.yaml") as src, open(config_location, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+    return config_location
+
+
+def import_profile(args):
+    """This will import an exported profile.
+
+    Args:
+        paths: path of the `.knsv` file, followed by the delta archives to
+            apply on top of it, if any. "-" reads a stream archive from stdin
+    """
+    paths = args.paths
+    streamed = len(paths) == 1 and is_stream_archive(paths[0])
+    # assert
+    for path in paths:
+        assert path == "-" or (
+            (streamed or is_zipfile(path))
+            and path[-len(EXPORT_EXTENSION) :] == EXPORT_EXTENSION
+        ), f"Not a valid konsave file: {path}"
+    assert (
+        paths[0] != "-" or args.import_name
+    ), "Specify the name of the profile with --import-name when importing from stdin"
+    item = args.import_name or os.path.basename(paths[0]).replace(EXPORT_EXTENSION, "")
+    assert not os.path.exists(os.path.join(PROFILES_DIR, item)), (
+        "A profile with this name already exists. Use --import-name to "
+        "import under different name"
+    )
+
+    # run
+    if args.verify:
+        assert paths[0] != "-", "A stream read from stdin cannot be verified first"
+        for path in paths:
+            log.info(f"Verifying {path}...")
+            if streamed:
+                with open_input(path) as src:
+                    _, errors = verify_stream(src)
+            else:
+                _, errors = verify_archive(path)
+            assert not errors, "Corrupted archive:\n  " + "\n  ".join(errors)
+
+    if streamed:
+        with open_input(paths[0]) as src:
+            if args.dry_run:
+                with TemporaryDirectory() as tmp:
+                    print_plan("import", plan_stream(src, tmp))
+                return
+            _import_profile(item, partial(extract_stream, src))
+        return
+
+    # The last archive has the conf.yaml of the result
+    with ArchiveChain(paths) as archives:
+        if args.dry_run:
+            with TemporaryDirectory() as tmp:
+                konsave_config = parse(extract_config(paths[-1], tmp))
+                print_plan("import", plan_import(archives, konsave_config))
+            return
+
+        def extract(profile_dir, staging):
+            konsave_config = parse(extract_config(paths[-1], profile_dir))
+            return extract_archive(archives, konsave_config, staging)
+
+        _import_profile(item, extract)
+
+
+def _import_profile(item: str, extract):
+    """Import an archive as the profile ``item``.
+
+    The profile is written to a temporary directory and the files of the
+    "export" sections under temporary names, all moved into place once the
+    whole archive was read, so that a failed import leaves nothing behind.
+    The profile goes first, so that the files it would replace are left
+    alone if it cannot be put in place.
+
+    Args:
+        item: the name of the profile
+        extract: called with the profile directory to write the conf.yaml
+            and the files of the archive, and the Staging of the "export"
+            files, returns the manifest and results (see
+            archive.extract_archive())
+    """
+    log.info("Importing profile. It might take a minute or two...")
+    done = start_run("import")
+
+    profile_dir = os.path.join(PROFILES_DIR, item)
+    # Next to the profiles directory rather than in it, not to be listed
+    tmp_dir = mkdtemp(dir=mkdir(KONSAVE_DIR), prefix=".import-")
+    staging = Staging()
+    placed = False
+    try:
+        # Until the profile is in place, its new objects must not be gc'ed
+        with store_lock():
+            manifest, results = extract(tmp_dir, staging)
+            write_manifest(tmp_dir, manifest)
+            snapshot(tmp_dir)
+            mkdir(PROFILES_DIR)
+            os.replace(tmp_dir, profile_dir)
+            placed = True
+        # Last, as the files it replaces cannot be brought back
+        staging.commit()
+    except BaseException:
+        staging.discard()
+        shutil.rmtree(profile_dir if placed else tmp_dir, ignore_errors=True)
+        # Drop the objects stored for this import only, once unlocked
+        collect_garbage()
+        raise
+    add_profile(item, manifest, imported=True)
+    done(results["written"], results["bytes"])
+
+    log.info(
+        f"Profile successfully imported! {results['written']} files written, "
+        f"{results['skipped']} already in place"
+    )
+
+
+def verify(args):
+    """Check every member of archives against their integrity records"""
+    failed = []
+    for path in args.paths:
+        if is_stream_archive(path):
+            # Streams have their integrity records at the end: always read through
+            with open_input(path) as src:
+                integrity, errors = verify_stream(src)
+        elif args.quick:
+            assert is_zipfile(path), f"Not a valid konsave file: {path}"
+            with ZipFile(path, "r") as arc:
+                integrity = read_integrity(arc)
+            print(f"{integrity['digest'] if integrity else '-':64}  {path}")
+            continue
+        else:
+            assert is_zipfile(path), f"Not a valid konsave file: {path}"
+            integrity, errors = verify_archive(path)
+
+        digest = integrity["digest"] if integrity else "-"
+        print(f"{digest:64}  {path}: {'FAILED' if errors else 'OK'}")
+        for error in errors:
+            print(f"  {error}")
+        if integrity is None and not errors:
+            log.warning(f"{path} has no integrity records, only CRCs were checked")
+        if errors:
+            failed.append(path)
+    assert not failed, f"{len(failed)} corrupted archive(s)"
+
+
+def ls_archive(args):
+    """
+    Open the given path and list its files and folders with their sizes, as a
+    tree where every folder holds the totals of its contents
+    """
+    assert args.depth is None or args.depth > 0, "The depth must be at least 1"
+    assert args.top is None or args.top > 0, "--top must be at least 1"
+    streamed = is_stream_archive(args.path)
+    if streamed:
+        with open_input(args.path) as src:
+            root, sections = archive_tree(
+                ((name, info.size, 0, "") for name, info, _ in read_stream(src)),
+                args.depth,
+            )
+    else:
+        assert is_zipfile(args.path), f"Not a valid konsave file: {args.path}"
+        with ZipFile(args.path, "r") as arc:
+            # The central directory, in one pass
+            root, sections = archive_tree(
+                (
+                    (
+                        zinfo.filename,
+                        zinfo.file_size,
+                        zinfo.compress_size,
+                        METHOD_NAMES.get(zinfo.compress_type, str(zinfo.compress_type)),
+                    )
+                    for zinfo in arc.infolist()
+                ),
+                args.depth,
+            )
+
+    rows = _tree_rows(root, "", args.sort, args.top)
+    if args.json:
+        _print_tree_json(args.path, root, sections, rows, streamed)
+    else:
+        _print_tree(root, sections, rows, streamed)
+
+
+def _tree_rows(node: TreeNode, path: str, sort: str, top: int = None):
+    """Yield the path and TreeNode of everything under ``node``, depth first.
+
+    The entries left out by ``top`` are yielded as a single TreeNode of their
+    totals, with the path of the directory and their count as a third
+    element (None for the other entries).
+
+    Args:
+        node: the directory to list
+        path: the path of the directory in the archive
+        sort: "name" or "size" (largest first), for the contents of every
+            directory
+        top: only list this many entries per directory, and the totals of
+            the others
+    """
+    if sort == "size":
+        children = sorted(node.children.items(), key=lambda item: -item[1].size)
+    else:
+        children = sorted(node.children.items(), key=lambda item: item[0])
+    for name, child in children[:top]:
+        child_path = f"{path}{name}/" if child.is_dir() else f"{path}{name}"
+        yield child_path, child, None
+        if child.is_dir():
+            yield from _tree_rows(child, child_path, sort, top)
+
+    others = children[top:] if top else ()
+    if others:
+        rest = TreeNode("")
+        for _, child in others:
+            rest.files += child.files
+            rest.size += child.size
+            rest.compressed += child.compressed
+        yield path, rest, len(others)
+
+
+def _print_tree(root: TreeNode, sections: dict, rows, streamed: bool):
+    """Print the rows of an archive tree as they come, then the totals"""
+
+    def human_size(value: int) -> str:
+        value, unit = convert(value)
+        return f"{value:.2f} {unit}"
+
+    def line(path: str, node: TreeNode) -> str:
+        compressed = "-" if streamed else human_size(node.compressed)
+        return (
+            f"{human_size(node.size):>10}  {compressed:>10}  {node.files:>7}  "
+            f"{node.method or '':<8}  {path}"
+        )
+
+    print(f"{'Size':>10}  {'Comp. Size':>10}  {'Files':>7}  {'Method':<8}  File/Folder")
+    for path, node, others in rows:
+        print(line(f"{path}... {others} more" if others else path, node))
+
+    print()
+    print(f"{'Size':>10}  {'Comp. Size':>10}  {'Files':>7}  {'':<8}  Section")
+    for name in sorted(sections):
+        print(line(name, sections[name]))
+    print(line("Total", root))
+
+
+def _print_tree_json(path: str, root: TreeNode, sections: dict, rows, streamed: bool):
+    """Print an archive tree as a JSON document, its entries as they come"""
+
+    def totals(node: TreeNode) -> dict:
+        return {
+            "files": node.files,
+            "size": node.size,
+            "compressed": None if streamed else node.compressed,
+        }
+
+    out = sys.stdout
+    out.write("{\n")
+    out.write(f' "path": {json.dumps(path)},\n')
+    out.write(f' "total": {json.dumps(totals(root))},\n')
+    sections = {name: totals(sections[name]) for name in sorted(sections)}
+    out.write(f' "sections": {json.dumps(sections)},\n')
+    out.write(' "entries": [')
+    for i, (entry, node, others) in enumerate(rows):
+        if others:
+            # The totals of the entries of the directory left out by --top
+            row = {"path": entry, "type": "more", "count": others}
+        else:
+            row = {"path": entry, "type": "dir" if node.is_dir() else "file"}
+        row.update(totals(node))
+        if not (others or node.is_dir()):
+            row["method"] = node.method
+        out.write(f"{',' if i else ''}\n  {json.dumps(row)}")
+    out.write("\n ]\n}\n")
@@ -3,35 +3,61 @@ This module contains all the functions for konsave.
 """
 
 import os
+import sys
 import logging
-from pathlib import Path
+from collections import Counter
 import shutil
 from datetime import datetime
-from tempfile import TemporaryDirectory
-from zipfile import ZipInfo, is_zipfile, ZipFile
-from pkg_resources import resource_filename
-
-import tabulate
+from tempfile import mkdtemp
 
 from konsave.consts import (
     CONFIG_DIR,
     CONFIG_FILE,
     KDE_RELOAD_CMD,
+    KONSAVE_DIR,
     PROFILES_DIR,
-    EXPORT_EXTENSION,
 )
-from konsave.config import parse
+from konsave import timings
+from konsave.config import parse, parse_homes
+from konsave.index import add_profile
+from konsave.history import (
+    describe,
+    parse_spec,
+    refresh,
+    remove_version,
+    resolve,
+    snapshot,
+    to_prune,
+    versions,
+)
+from konsave.plan import (
+    TOP_ENTRIES,
+    estimate,
+    format_duration,
+    plan_apply,
+    plan_save,
+    start_run,
+)
+from konsave.diff import HashCache, diff_live, diff_manifests, unified_diff
+from konsave.profiles import convert, get_profiles, tabulate
+from konsave.rollback import Journal, last_apply, rollback
+from konsave.copier import backend_usage, existing_entries, section_patterns
+from konsave.store import (
+    collect_garbage,
+    load_manifest,
+    new_manifest,
+    new_section,
+    restore_homes,
+    restore_section,
+    store_entry,
+    store_lock,
+    write_manifest,
+)
 
 
 log = logging.getLogger("Konsave")
 
 
-def get_profiles():
-    """Return the profile names installed/saved and their count"""
-    profs = os.listdir(PROFILES_DIR)
-    return profs, len(profs)
-
-
 def mkdir(path):
     """Creates directory if it doesn't exist.
 
@@ -46,75 +72,65 @@ def mkdir(path):
     return path
 
 
-def copy(source, dest):
-    """
-    This function was created because shutil.copytree gives error if the
-    destination folder exists and the argument "dirs_exist_ok" was introduced
-    only after python 3.8.
-
-    This restricts people with python 3.7 or less from using Konsave.
-    It uses recursion to copy files and folders from "source" to "dest"
-
-    Args:
-        source: the source destination
-        dest: the destination to copy the file/folder to
-    """
-    assert isinstance(source, str) and isinstance(dest, str), "Invalid path"
-    assert source != dest, "Source and destination can't be same"
-    assert os.path.exists(source), "Source path doesn't exist"
-
-    if not os.path.exists(dest):
-        os.mkdir(dest)
-
-    for item in os.listdir(source):
-        source_path = os.path.join(source, item)
-        dest_path = os.path.join(dest, item)
+def print_plan(command: str, plan):
+    """Print what a command would do (see konsave.plan) and how long it
+    should take, based on the previous runs of the command"""
 
-        if os.path.isdir(source_path):
-            copy(source_path, dest_path)
-            continue
+    def human_size(value: int) -> str:
+        value, unit = convert(value)
+        return f"{value:.2f} {unit}"
 
-        if os.path.exists(dest_path):
-            os.remove(dest_path)
-        if os.path.exists(source_path):
-            shutil.copy(source_path, dest)
+    rows = sorted(plan.rows.values(), key=lambda row: (row["section"], row["entry"]))
+    print(
+        tabulate(
+            [
+                [
+                    row["section"],
+                    row["entry"],
+                    row["files"],
+                    human_size(row["bytes"]),
+                    row["create"],
+                    row["overwrite"],
+                    row["skip"],
+                ]
+                for row in rows
+            ],
+            headers=[
+                "SECTION",
+                "ENTRY",
+                "FILES",
+                "SIZE",
+                "CREATE",
+                "OVERWRITE",
+                "SKIP",
+            ],
+        )
+    )
 
+    totals = plan.totals()
+    print(
+        f"\nTotal: {totals['files']} files, {totals['create']} to create, "
+        f"{totals['overwrite']} to overwrite, {totals['skip']} to skip, "
+        f"{human_size(totals['bytes'])} to copy"
+    )
 
-def copy_source_exist(source, dest):
-    """
-    Call the correct copy only if the source path exists. If this
-    is a directory then our copy() will be used, otherwise shutil
-    copy will be called
-    """
-    if not os.path.exists(source):
-        log.debug(f"File or directory '{source}' does not exist")
-        return
+    largest = sorted(rows, key=lambda row: row["bytes"], reverse=True)[:TOP_ENTRIES]
+    largest = [row for row in largest if row["bytes"]]
+    if largest:
+        print("Largest entries:")
+        for row in largest:
+            name = "/".join(filter(None, (row["section"], row["entry"])))
+            print(f"  {name}: {human_size(row['bytes'])}")
 
-    if os.path.isdir(source):
-        copy(source, dest)
+    seconds, runs = estimate(
+        command, totals["create"] + totals["overwrite"], totals["bytes"]
+    )
+    if seconds is None:
+        print(f"Estimated duration: unknown (no {command} run recorded yet)")
     else:
-        shutil.copy(source, dest)
-
-
-def list_profiles(args):  # pylint: disable=unused-argument
-    """Lists all the created profiles.
-
-    Args:
-        profile_list: the list of all created profiles
-        profile_count: number of profiles created
-    """
-    profile_list, profile_count = get_profiles()
-
-    # assert
-    assert os.path.exists(PROFILES_DIR) and profile_count != 0, "No profile found."
-
-    # run
-    print("Konsave profiles:")
-    print(
-        tabulate.tabulate(
-            [[i, item] for i, item in enumerate(profile_list)], headers=["ID", "NAME"]
+        print(
+            f"Estimated duration: {format_duration(seconds)} (from the last {runs} runs)"
         )
-    )
 
 
 def save_profile(args):
@@ -124,6 +140,7 @@ def save_profile(args):
         name: name of the profile
         profile_list: the list of all created profiles
         force: force overwrite already created profile, optional
+        checksum: hash every file even if it looks unchanged since the last save
     """
     name = args.name
     profile_list, _ = get_profiles()
@@ -134,51 +151,218 @@ def save_profile(args):
     ), "Profile with this name already exists"
 
     # run
-    log.info("Saving profile...")
     profile_dir = os.path.join(PROFILES_DIR, name)
-    mkdir(profile_dir)
-
     konsave_config = parse(CONFIG_FILE)["save"]
 
+    # Files whose size, mtime and inode did not change since the last save
+    # are neither hashed nor copied again
+    previous = {}
+    if name in profile_list:
+        previous = load_manifest(profile_dir)["sections"]
+
+    if args.dry_run:
+        print_plan("save", plan_save(konsave_config, previous, args.checksum))
+        return
+
+    log.info("Saving profile...")
+    done = start_run("save")
+    version, copied = _save(name, konsave_config, previous, args.checksum)
+    done(copied["files"], copied["bytes"])
+
+    log.debug(f"Copy backends used: {backend_usage()}")
+    log.info(f"Profile saved successfully as version {version}!")
+
+
+def _store_sections(konsave_config: dict, previous: dict, checksum: bool) -> tuple:
+    """Store the current files of the "save" sections (see _save()).
+
+    Returns:
+        tuple: the manifest and a Counter of the "files" copied and their
+        "bytes"
+    """
+    manifest = new_manifest()
+    copied = Counter()
     for section_name, section in konsave_config.items():
         log.debug(f" - Processing {section_name}")
-        folder = os.path.join(profile_dir, section_name)
-        mkdir(folder)
-        for entry in section["entries"] or ():
-            source = os.path.join(section["location"], entry)
-            dest = os.path.join(folder, entry)
-            copy_source_exist(source, dest)
-
+        stored = manifest["sections"][section_name] = new_section()
+        known = previous.get(section_name, new_section())["files"]
+        with timings.span(section_name):
+            for entry, source in existing_entries(section):
+                with timings.span(section_name, entry):
+                    store_entry(
+                        source,
+                        entry,
+                        stored,
+                        None if checksum else known,
+                        section_patterns(section),
+                    )
+        changed = [
+            record
+            for path, record in stored["files"].items()
+            if known.get(path, {}).get("digest") != record["digest"]
+        ]
+        copied["files"] += len(changed)
+        copied["bytes"] += sum(record["size"] for record in changed)
+        log.debug(f"   {len(stored['files'])} files, {len(changed)} changed")
+    return manifest, copied
+
+
+def _write_profile(profile_dir: str, manifest: dict) -> int:
+    """Write the conf.yaml and manifest of a profile, and record them as its
+    next version (returned)"""
     shutil.copy(CONFIG_FILE, profile_dir)
+    write_manifest(profile_dir, manifest)
+    return snapshot(profile_dir)
+
 
-    log.info("Profile saved successfully!")
+def _save(name: str, konsave_config: dict, previous: dict, checksum: bool) -> tuple:
+    """Save the current files of the "save" sections as a new version of the
+    profile ``name``.
+
+    Args:
+        name: the profile name
+        konsave_config: the "save" part of the parsed config
+        previous: the manifest sections of the last save of the profile
+        checksum: hash every file even if it looks unchanged since then
+
+    Returns:
+        tuple: the new version and a Counter of the "files" copied (new or
+        changed) and their "bytes"
+    """
+    profile_dir = os.path.join(PROFILES_DIR, name)
+    # Until the manifest refers to them, the new objects must not be gc'ed
+    with store_lock():
+        manifest, copied = _store_sections(konsave_config, previous, checksum)
+        if os.path.isdir(profile_dir):
+            if previous and not versions(profile_dir):
+                # Saved before versions were kept: keep what is about to be replaced
+                snapshot(profile_dir)
+            version = _write_profile(profile_dir, manifest)
+        else:
+            # Written aside and renamed into place once complete, so that a
+            # new profile is never seen half written
+            tmp_dir = mkdtemp(dir=mkdir(KONSAVE_DIR), prefix=".save-")
+            try:
+                version = _write_profile(tmp_dir, manifest)
+                mkdir(PROFILES_DIR)
+                os.replace(tmp_dir, profile_dir)
+            except BaseException:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+        add_profile(name, manifest)
+    return version, copied
+
+
+def watch(args):
+    """Keeps a profile in sync with the files it saves, until interrupted.
+
+    The profile is saved first, as a new version, then only the files that
+    change are stored again, in that same version.
+
+    Args:
+        name: name of the profile, created if it does not exist
+        delay: seconds without changes to wait for before saving
+    """
+    # Not at the top, ctypes is slow to import for the other commands
+    from konsave.watch import (  # pylint: disable=import-outside-toplevel
+        Inotify,
+        Watcher,
+        sync,
+    )
+
+    name = args.name
+    profile_list, _ = get_profiles()
+    assert args.delay >= 0, "The delay cannot be negative"
+
+    # run
+    profile_dir = os.path.join(PROFILES_DIR, name)
+    konsave_config = parse(CONFIG_FILE)["save"]
+    previous = {}
+    if name in profile_list:
+        previous = load_manifest(profile_dir)["sections"]
+
+    # Watching before saving, so that no change is missed in between
+    with Inotify() as inotify:
+        watcher = Watcher(konsave_config, inotify)
+        version, _ = _save(name, konsave_config, previous, False)
+        manifest = load_manifest(profile_dir)
+        log.info(
+            f"Profile saved as version {version}, watching {watcher.watched()} "
+            "directories for changes (Ctrl+C to stop)..."
+        )
+        try:
+            for changed in watcher.changes(args.delay):
+                with store_lock():
+                    count = sync(manifest["sections"], konsave_config, changed)
+                    if not count:
+                        continue
+                    write_manifest(profile_dir, manifest)
+                    refresh(profile_dir, version)
+                add_profile(name, manifest)
+                log.info(f"{count} files saved")
+        except KeyboardInterrupt:
+            log.info("Stopped watching")
+
+    # Drop the objects of the intermediate states
+    collect_garbage()
 
 
 def apply_profile(args):
     """Applies profile of the given id.
 
     Args:
-        profile_name: name of the profile to be applied
+        profile_name: name of the profile to be applied, "<name>@<version>"
+            for an older version
         profile_list: the list of all created profiles
         profile_count: number of profiles created
     """
 
     profile_list, profile_count = get_profiles()
+    profile_name, version = parse_spec(args.name)
     # assert
     assert profile_count != 0, "No profile saved yet."
-    assert args.name in profile_list, f"Profile not found: {args.name}"
+    assert profile_name in profile_list, f"Profile not found: {profile_name}"
 
     # run
-    profile_dir = os.path.join(PROFILES_DIR, args.name)
-
-    log.info("copying files...")
+    source = resolve(os.path.join(PROFILES_DIR, profile_name), version)
+    if args.homes:
+        apply_homes(args, source)
+        return
 
-    config_location = os.path.join(profile_dir, "conf.yaml")
+    config_location = os.path.join(source, "conf.yaml")
     profile_config = parse(config_location)["save"]
-    for name in profile_config:
-        location = os.path.join(profile_dir, name)
-        copy(location, profile_config[name]["location"])
+    sections = load_manifest(source)["sections"]
 
+    if args.dry_run:
+        print_plan("apply", plan_apply(profile_config, sections))
+        return
+
+    log.info("copying files...")
+    done = start_run("apply")
+    results = Counter()
+    journal = Journal(args.name)
+    try:
+        for name in profile_config:
+            with timings.span(name):
+                results += restore_section(
+                    sections.get(name, new_section()),
+                    profile_config[name]["location"],
+                    journal,
+                )
+    except BaseException:
+        journal.close()
+        if journal.started():
+            log.error("Apply failed, restoring the previous files...")
+            rollback()
+        raise
+    journal.close()
+    done(results["added"] + results["changed"], results["bytes"])
+
+    log.debug(f"Copy backends used: {backend_usage()}")
+    log.info(
+        f"{results['changed']} files changed, {results['added']} added, "
+        f"{results['skipped']} already up to date"
+    )
     log.info(
         "Profile applied successfully! Please log-out and log-in to see the changes completely!"
     )
@@ -188,153 +372,160 @@ def apply_profile(args):
         os.system(KDE_RELOAD_CMD)
 
 
-def remove_profile(args):
-    """Removes the specified profile.
-
-    Args:
-        profile_name: name of the profile to be removed
-        profile_list: the list of all created profiles
-        profile_count: number of profiles created
-    """
-
-    profile_list, profile_count = get_profiles()
-    # assert
-    assert profile_count != 0, "No profile saved yet."
-    assert args.name in profile_list, f"Profile not found: {args.name}"
-
-    # run
-    log.info("removing profile...")
-    shutil.rmtree(os.path.join(PROFILES_DIR, args.name))
-    log.info("removed profile successfully")
-
+def apply_homes(args, source: str):
+    """Applies a profile to the home directories of several users at once.
 
-def export(args):
-    """It will export the specified profile as a ".knsv" to the specified directory.
-       If there is no specified directory, the directory is set to the current working directory.
+    The profile is read once and its tokens are resolved for every home. A
+    home that fails does not stop the others: a report of every home is
+    printed at the end. The whole run can be undone with rollback.
 
     Args:
-        args.name: name of the profile to be exported
-        args.directory: output directory for the export
-        args.force: force the overwrite of existing export file
-        args.archive_name: the name of the resulting archive
+        args.homes: the home directories
+        source: the directory holding the conf.yaml and manifest to apply
     """
-    profile_name = args.name
-    if args.output:
-        out = Path(args.output)
-        # remove anything after a dot (ie rm all suffixes)
-        if out.suffixes:
-            out = out.parent / out.name.split(out.suffixes[0])[0]
-        export_path = str(out)
-    else:
-        export_path = os.path.join(os.getcwd(), profile_name)
-
-    profile_list, profile_count = get_profiles()
-    # assert
-    assert profile_count != 0, "No profile saved yet."
-    assert profile_name in profile_list, f"Profile not found: {profile_name}"
-
-    # run
-    profile_dir = os.path.join(PROFILES_DIR, profile_name)
-
-    # Only continue if export_path, export_path.ksnv and export_path.zip don't exist
-    # Appends date and time to create a unique file name
-    if not args.force and export_path != "/dev/stdout":
-        orig_export_path = export_path
-        while True:
-            paths = [f"{export_path}", f"{export_path}.knsv", f"{export_path}.zip"]
-            if not any(os.path.exists(path) for path in paths):
-                break
-            export_path = f"{orig_export_path}_{datetime.now().isoformat()}"
-
-    # compressing the files as zip
-    log.info("Exporting profile. It might take a minute or two...")
-
-    konsave_config = parse(os.path.join(profile_dir, "conf.yaml"))
-
-    with TemporaryDirectory(prefix="konsave") as temp_path:
-        log.debug(f"Building archive in {temp_path}")
-        export_path_save = mkdir(os.path.join(temp_path, "save"))
-        for name in konsave_config["save"]:
-            location = os.path.join(profile_dir, name)
-            log.info(f'Exporting "{name}"...')
-            copy(location, os.path.join(export_path_save, name))
-
-        konsave_config_export = konsave_config["export"]
-        export_path_export = mkdir(os.path.join(temp_path, "export"))
-        for name, section in konsave_config_export.items():
-            path = mkdir(os.path.join(export_path_export, name))
-            for entry in section["entries"] or ():
-                source = os.path.join(section["location"], entry)
-                dest = os.path.join(path, entry)
-                log.info(f'Exporting "{entry}"...')
-                copy_source_exist(source, dest)
-
-        shutil.copy(CONFIG_FILE, temp_path)
-
-        log.info(f"Creating temp archive in {temp_path}.zip")
-        # The following adds the .zip extension
-        # Make sure the archive is in the temp location for now
-        shutil.make_archive(temp_path, "zip", temp_path)
-
-        if export_path == "/dev/stdout":
-            final_path = export_path
-        else:
-            final_path = export_path + EXPORT_EXTENSION
-
-        # Move the archive and remove the .zip extension
-        shutil.move(temp_path + ".zip", final_path)
+    homes = list(dict.fromkeys(os.path.abspath(home) for home in args.homes))
+    for home in homes:
+        assert os.path.isdir(home), f"Home directory not found: {home}"
+
+    configs = parse_homes(os.path.join(source, "conf.yaml"), homes)
+    sections = load_manifest(source)["sections"]
+
+    if args.dry_run:
+        plan = None
+        for home in homes:
+            plan = plan_apply(configs[home]["save"], sections, plan)
+        print_plan("apply", plan)
+        return
 
-    log.info(f"Successfully exported to {export_path}{EXPORT_EXTENSION}")
+    log.info(f"copying files to {len(homes)} homes...")
+    done = start_run("apply")
+    results = {home: Counter() for home in homes}
+    errors = {}
+    journal = Journal(args.name)
+    try:
+        for name in configs[homes[0]]["save"]:
+            dests = {
+                home: configs[home]["save"][name]["location"]
+                for home in homes
+                if home not in errors
+            }
+            with timings.span(name):
+                section_results, section_errors = restore_homes(
+                    sections.get(name, new_section()), dests, journal
+                )
+            for home, counts in section_results.items():
+                results[home] += counts
+            errors.update(section_errors)
+    except BaseException:
+        journal.close()
+        if journal.started():
+            log.error("Apply failed, restoring the previous files...")
+            rollback()
+        raise
+    journal.close()
+    total = sum(results.values(), Counter())
+    done(total["added"] + total["changed"], total["bytes"])
+
+    log.debug(f"Copy backends used: {backend_usage()}")
+    print(
+        tabulate(
+            [
+                [
+                    home,
+                    "FAILED" if home in errors else "ok",
+                    results[home]["changed"],
+                    results[home]["added"],
+                    results[home]["skipped"],
+                    errors.get(home, ""),
+                ]
+                for home in homes
+            ],
+            headers=["HOME", "STATUS", "CHANGED", "ADDED", "UP TO DATE", "ERROR"],
+        )
+    )
+    assert (
+        not errors
+    ), f"Profile applied to {len(homes) - len(errors)} of {len(homes)} homes"
+    log.info(f"Profile applied successfully to {len(homes)} homes!")
 
 
-def import_profile(args):
-    """This will import an exported profile.
+def diff_profiles(args):
+    """Shows the files added, removed and modified between a profile and the
+    live files, or between two profiles.
 
     Args:
-        path: path of the `.knsv` file
+        names: the profile, and the profile to compare it with if any
+            ("<name>@<version>" for older versions)
+        unified: also print the unified diffs of text files
     """
-    path = args.path
-    # assert
-    assert (
-        is_zipfile(path) and path[-len(EXPORT_EXTENSION) :] == EXPORT_EXTENSION
-    ), "Not a valid konsave file"
-    item = args.import_name or os.path.basename(path).replace(EXPORT_EXTENSION, "")
-    assert not os.path.exists(os.path.join(PROFILES_DIR, item)), (
-        "A profile with this name already exists. Use --import-name to "
-        "import under different name"
-    )
+    assert len(args.names) <= 2, "Give one profile, or two to compare"
+    profile_list, _ = get_profiles()
+    sources = []
+    for spec in args.names:
+        profile_name, version = parse_spec(spec)
+        assert profile_name in profile_list, f"Profile not found: {profile_name}"
+        sources.append(resolve(os.path.join(PROFILES_DIR, profile_name), version))
 
     # run
-    log.info("Importing profile. It might take a minute or two...")
-
-    with TemporaryDirectory(prefix="konsave") as temp_path:
-        with ZipFile(path, "r") as zip_file:
-            zip_file.extractall(temp_path)
-
-        config_file_location = os.path.join(temp_path, "conf.yaml")
-        konsave_config = parse(config_file_location)
-
-        # Copies only under "profiles"
-        profile_dir = os.path.join(PROFILES_DIR, item)
-        copy(os.path.join(temp_path, "save"), profile_dir)
-        shutil.copy(os.path.join(temp_path, "conf.yaml"), profile_dir)
-
-        for section_name, section in konsave_config["export"].items():
-            path = os.path.join(temp_path, "export", section_name)
-            mkdir(path)
-            for entry in section["entries"] or ():
-                source = os.path.join(path, entry)
-                dest = os.path.join(section["location"], entry)
-                log.info(f'Importing "{entry}"...')
-                copy_source_exist(source, dest)
+    sections = load_manifest(sources[0])["sections"]
+    if len(sources) == 2:
+        changes = diff_manifests(sections, load_manifest(sources[1])["sections"])
+    else:
+        cache = HashCache()
+        profile_config = parse(os.path.join(sources[0], "conf.yaml"))["save"]
+        changes = diff_live(profile_config, sections, cache)
+        cache.save()
+
+    def human_size(side: tuple) -> str:
+        if side is None:
+            return "-"
+        value, unit = convert(side[1])
+        return f"{value:.2f} {unit}"
 
-    log.info("Profile successfully imported!")
+    table = []
+    diffs = []
+    for name in sorted(changes):
+        for kind, mark in (("added", "A"), ("removed", "D"), ("modified", "M")):
+            for rel, (before, after) in sorted(changes[name][kind].items()):
+                table.append([name, mark, rel, human_size(before), human_size(after)])
+                if args.unified:
+                    diffs.append(unified_diff(rel, before, after))
+
+    if not table:
+        log.info("No differences")
+        return
+    after = args.names[1] if len(args.names) == 2 else "live"
+    print(tabulate(table, headers=["SECTION", "", "PATH", args.names[0], after]))
+    for diff in diffs:
+        print()
+        print(diff, end="")
+    counts = Counter(row[1] for row in table)
+    print(f"\n{counts['A']} added, {counts['D']} removed, {counts['M']} modified")
+
+
+def rollback_apply(args):  # pylint: disable=unused-argument
+    """Restores the files replaced by the last apply"""
+    last = last_apply()
+    assert last, "Nothing to roll back."
+
+    applied = datetime.fromtimestamp(last["time"]).strftime("%Y-%m-%d %H:%M")
+    log.info(f"Rolling back apply of '{last['profile']}' from {applied}...")
+    results = rollback()
+    log.info(
+        f"{results['restored']} files restored, {results['removed']} removed. "
+        "Please log-out and log-in to see the changes completely!"
+    )
 
 
 def config_check(args):  # pylint: disable=unused-argument
     """Compare konsave config with user's ~/.config"""
 
+    # pylint: disable=import-outside-toplevel
+    from konsave.archive import compression_policy
+
     konsave_config = parse(CONFIG_FILE)
+    # Raises on an invalid "compression" section, like export would
+    compression_policy(konsave_config)
 
     dir_entries = set(os.listdir(CONFIG_DIR))
 
@@ -344,86 +535,112 @@ def config_check(args):  # pylint: disable=unused-argument
 
         print(f"\n# Config section: {name}\n")
         entries = set(section["entries"])
+        patterns = section_patterns(section)
         table = []
         for entry in sorted(entries | dir_entries):
-            table.append([entry, entry in entries, entry in dir_entries])
-        print(tabulate.tabulate(table, headers=["Entry", "Backed Up?", "In ~/.config"]))
-
-
-def convert(value, cur_unit="B", units=None, increment=1024):
-    """
-    Convert the given value/cur_unit to the largest unit available
-    or to a value less than ``increment``
-    """
-    units = units or ["B", "KB", "MB", "GB", "TB"]
-    unit_idx = units.index(cur_unit)
-    while value >= increment and len(units) > unit_idx + 1:
-        unit_idx += 1
-        value /= 1024
-
-    return value, units[unit_idx]
-
-
-def ls_archive(args):
-    """
-    Open the given path and list all files/folders and their sizes
-    """
-    entries = []
-    dirs = {}
-    with ZipFile(args.path, "r") as arc:
-        # Entries appear as we would like to display them. This means
-        # that dirs come first but this way we cannot sum their child
-        # file sizes. So... reverse
-        for entry in reversed(arc.infolist()):
-            # print(entry.filename, ' : ', entry.file_size, ' : ')
-            # store filename and size in dictionary
-            if entry.is_dir():
-                # We should already have all the info!
-                # Try to get it but if it has no files, then it will
-                # not exist in dirs
-                dir_entry = dirs.get(entry.filename, entry)
-                entries.append(dir_entry)
-                continue
-
-            # Accumulate size of directories
-            for parent in Path(entry.filename).parents:
-                if str(parent) in {"/", "."}:
-                    break
-                str_parent = f"{parent}/"
-                if str_parent not in dirs:
-                    dirs[str_parent] = ZipInfo(str_parent)
-                # Sum shit up!
-                dirs[str_parent].file_size += entry.file_size
-                dirs[str_parent].compress_size += entry.compress_size
-
-            # Handle files
-            entries.append(entry)
-
-    def human_size(value: int) -> str:
-        value, unit = convert(value)
-        return f"{value:.2f} {unit}"
+            path = os.path.join(CONFIG_DIR, entry)
+            saved = entry in entries and patterns.keep_path(entry, os.path.isdir(path))
+            table.append([entry, saved, entry in dir_entries])
+        print(tabulate(table, headers=["Entry", "Backed Up?", "In ~/.config"]))
+
+
+def _timings_cells(name: str, entry: str, row: dict) -> list:
+    """Format a row of timings.summary() for print_timings()"""
+
+    def seconds(value):
+        return "" if value is None else f"{value:.3f}s"
+
+    size, unit = convert(row["bytes"])
+    return [
+        name,
+        entry,
+        row["files"],
+        f"{size:.1f} {unit}",
+        "" if row["ratio"] is None else f"{row['ratio']:.0%}",
+        row["stat"],
+        row["open"],
+        row["copy"],
+        seconds(row["busy"]),
+        seconds(row["wall"]),
+        seconds(row["cpu"]),
+    ]
+
+
+def print_timings():
+    """Print the recorded timings per section and entry (to stderr, so that
+    it does not mix with an archive exported to stdout)"""
+    result = timings.summary()
+    rows = []
+    for section in result["sections"]:
+        rows.append(_timings_cells(section["section"], "", section))
+        rows.extend(
+            _timings_cells("", entry["entry"], entry) for entry in section["entries"]
+        )
+    rows.append(_timings_cells("TOTAL", "", result["total"]))
+    headers = ["SECTION", "ENTRY", "FILES", "SIZE", "RATIO"]
+    headers += ["STAT", "OPEN", "COPY", "BUSY", "WALL", "CPU"]
+    print(tabulate(rows, headers), file=sys.stderr)
+    usage = backend_usage()
+    if usage:
+        copies = ", ".join(f"{count} by {name}" for name, count in usage.items())
+        print(f"Files copied: {copies}", file=sys.stderr)
+
+
+def profile_history(args):
+    """List the saved versions of a profile"""
+    profile_list, _ = get_profiles()
+    assert args.name in profile_list, f"Profile not found: {args.name}"
 
-    # Now print!
-    # tabulate.PRESERVE_WHITESPACE = True
-    print(
-        tabulate.tabulate(
+    rows = describe(os.path.join(PROFILES_DIR, args.name))
+    table = []
+    for row in rows:
+        size, unit = convert(row["size"])
+        table.append(
             [
-                [e.filename, human_size(e.file_size), human_size(e.compress_size)]
-                for e in reversed(entries)
-            ],
-            headers=["File/Folder", "Size", "Comp. Size"],
+                row["version"],
+                datetime.fromtimestamp(row["saved"]).strftime("%Y-%m-%d %H:%M"),
+                row["files"],
+                f"{size:.2f} {unit}",
+                row["changed"],
+                row["removed"],
+                "*" if row is rows[-1] else "",
+            ]
+        )
+    print(
+        tabulate(
+            table,
+            headers=["VERSION", "SAVED", "FILES", "SIZE", "CHANGED", "REMOVED", ""],
         )
     )
 
 
-def wipe():
-    """Wipes all profiles."""
-    confirm = input('This will wipe all your profiles. Enter "WIPE" To continue: ')
-    if confirm == "WIPE":
-        shutil.rmtree(PROFILES_DIR)
-        log.info("Removed all profiles!")
-    else:
-        log.info("Aborting...")
+def prune_history(args):
+    """Remove the versions of profiles that a retention policy does not keep.
+
+    Args:
+        names: the profiles to prune, all if none
+        keep_last: keep the last N versions
+        keep_daily: keep the last version of each of the last M days
+    """
+    assert args.keep_last or args.keep_daily, "Use --keep-last and/or --keep-daily"
+    profile_list, _ = get_profiles()
+    for name in args.names:
+        assert name in profile_list, f"Profile not found: {name}"
+
+    pruned = 0
+    for name in args.names or profile_list:
+        profile_dir = os.path.join(PROFILES_DIR, name)
+        for version in to_prune(describe(profile_dir), args.keep_last, args.keep_daily):
+            log.debug(f"Removing version {version} of '{name}'")
+            remove_version(profile_dir, version)
+            pruned += 1
+
+    removed, freed = collect_garbage()
+    size, unit = convert(freed)
+    log.info(
+        f"Removed {pruned} versions and {removed} unreferenced objects "
+        f"({size:.2f} {unit})"
+    )
 
 
 def install_config(force: bool = False):
@@ -439,12 +656,16 @@ def install_config(force: bool = False):
     if os.path.exists(CONFIG_FILE):
         return
 
+    # Only needed on first run, importlib.resources is slow to import
+    from importlib.resources import files  # pylint: disable=import-outside-toplevel
+
+    mkdir(os.path.dirname(CONFIG_FILE))
     if os.path.expandvars("$XDG_CURRENT_DESKTOP") == "KDE":
-        default_config_path = resource_filename("konsave", "conf_kde.yaml")
-        shutil.copy(default_config_path, CONFIG_FILE)
+        default_config = files("konsave") / "conf_kde.yaml"
     else:
-        default_config_path = resource_filename("konsave", "conf_other.yaml")
-        shutil.copy(default_config_path, CONFIG_FILE)
+        default_config = files("konsave") / "conf_other.yaml"
+    with open(CONFIG_FILE, "wb") as dst:
+        dst.write(default_config.read_bytes())
 
 
 def reset_config(args):  # pylint: disable=unused-argument
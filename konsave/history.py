@@ -0,0 +1,157 @@
+"""
+This module keeps the versions of a profile.
+
+Every save of a profile is kept as a snapshot in its HISTORY_NAME directory,
+numbered from 1, the last one being the current profile. Since files are
+stored once in the object store, a snapshot is only the conf.yaml and the
+manifest of the save: the manifest is hard linked (write_manifest() renames a
+new file over the old one, so a linked manifest never changes) and the
+conf.yaml is copied. Only the files changed since the previous save are
+stored, and objects are removed by collect_garbage() once no snapshot refers
+to them anymore.
+"""
+
+import os
+import shutil
+from datetime import datetime
+
+from konsave.store import HISTORY_NAME, MANIFEST_NAME, load_manifest, manifest_path
+
+
+def parse_spec(spec: str) -> tuple:
+    """Split a "<name>@<version>" profile spec.
+
+    Returns:
+        tuple: the profile name and version (None for the current one)
+    """
+    name, sep, version = spec.rpartition("@")
+    if not sep:
+        return spec, None
+    assert version.isdigit() and int(version) > 0, f"Invalid version: {version}"
+    return name, int(version)
+
+
+def versions(profile_dir: str) -> list:
+    """Return the versions of a profile, oldest first"""
+    path = os.path.join(profile_dir, HISTORY_NAME)
+    if not os.path.isdir(path):
+        return []
+    return sorted(int(name) for name in os.listdir(path) if name.isdigit())
+
+
+def version_dir(profile_dir: str, version: int) -> str:
+    """Return the directory of a version of a profile"""
+    return os.path.join(profile_dir, HISTORY_NAME, str(version))
+
+
+def resolve(profile_dir: str, version: int = None) -> str:
+    """Return the directory holding the conf.yaml and manifest of a version of
+    a profile, the profile directory itself for the current version"""
+    if version is None:
+        return profile_dir
+    path = version_dir(profile_dir, version)
+    assert os.path.isdir(path), f"Version not found: {version}"
+    return path
+
+
+def snapshot(profile_dir: str) -> int:
+    """Record the current conf.yaml and manifest of a profile as its next
+    version.
+
+    Returns:
+        int: the new version
+    """
+    known = versions(profile_dir)
+    version = known[-1] + 1 if known else 1
+    path = version_dir(profile_dir, version)
+    tmp = f"{path}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    manifest = manifest_path(profile_dir)
+    try:
+        os.link(manifest, os.path.join(tmp, MANIFEST_NAME))
+    except OSError:
+        shutil.copy2(manifest, tmp)
+    shutil.copy2(os.path.join(profile_dir, "conf.yaml"), tmp)
+    # A version is either complete or missing
+    os.rename(tmp, path)
+    return version
+
+
+def refresh(profile_dir: str, version: int):
+    """Make a version hold the current manifest of a profile, in place of the
+    one it was saved with (for konsave watch, which keeps updating a single
+    version)"""
+    path = os.path.join(version_dir(profile_dir, version), MANIFEST_NAME)
+    tmp = f"{path}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(manifest_path(profile_dir), tmp)
+    except OSError:
+        shutil.copy2(manifest_path(profile_dir), tmp)
+    os.replace(tmp, path)
+
+
+def describe(profile_dir: str) -> list:
+    """Describe every version of a profile, oldest first.
+
+    Returns:
+        list: dicts with the "version", when it was "saved", its "files",
+        "size", and the number of files "changed" (or added) and "removed"
+        since the previous version
+    """
+    rows = []
+    previous = {}
+    for version in versions(profile_dir):
+        path = version_dir(profile_dir, version)
+        files = {}
+        for name, section in load_manifest(path)["sections"].items():
+            for rel, record in section["files"].items():
+                files[(name, rel)] = record
+        rows.append(
+            {
+                "version": version,
+                "saved": os.stat(manifest_path(path)).st_mtime,
+                "files": len(files),
+                "size": sum(record["size"] for record in files.values()),
+                "changed": sum(
+                    1
+                    for key, record in files.items()
+                    if previous.get(key, {}).get("digest") != record["digest"]
+                ),
+                "removed": len(previous.keys() - files.keys()),
+            }
+        )
+        previous = files
+    return rows
+
+
+def to_prune(rows: list, keep_last: int = 0, keep_daily: int = 0) -> list:
+    """Select the versions a retention policy drops.
+
+    Args:
+        rows: the versions, as returned by describe()
+        keep_last: keep the last N versions
+        keep_daily: keep the last version of each of the last M days with a
+            save
+
+    Returns:
+        list: the versions to remove. The current (last) one is always kept
+    """
+    keep = {row["version"] for row in rows[-max(keep_last, 1) :]}
+    days = set()
+    for row in reversed(rows):
+        day = datetime.fromtimestamp(row["saved"]).date()
+        if day in days:
+            continue
+        if len(days) == keep_daily:
+            break
+        days.add(day)
+        keep.add(row["version"])
+    return [row["version"] for row in rows if row["version"] not in keep]
+
+
+def remove_version(profile_dir: str, version: int):
+    """Remove a version of a profile (run collect_garbage() afterwards)"""
+    shutil.rmtree(version_dir(profile_dir, version))
@@ -0,0 +1,149 @@
+"""
+This module maintains the profile index (INDEX_FILE).
+
+The index holds a summary of every profile (files, size per section, when and
+where it was saved, hash of its conf.yaml) so that listing profiles does not
+read their manifests, nor import the object store. It is updated by save,
+import and remove, under a lock and through an atomic rename, and entries
+missing or older than their manifest (ie. written by an older konsave) are
+rebuilt when listing.
+"""
+
+import os
+import json
+import fcntl
+import socket
+import logging
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+
+from konsave.consts import INDEX_FILE, KONSAVE_DIR, MANIFEST_NAME, PROFILES_DIR
+
+
+log = logging.getLogger("Konsave")
+
+INDEX_VERSION = 1
+
+
+def read_index() -> dict:
+    """Return the indexed profiles, by name (empty if there is no index)"""
+    try:
+        with open(INDEX_FILE, "r", encoding="utf-8") as src:
+            index = json.load(src)
+    except (OSError, ValueError):
+        return {}
+    if index.get("version") != INDEX_VERSION:
+        return {}
+    return index["profiles"]
+
+
+@contextmanager
+def transaction():
+    """Lock the index and yield its profiles, to be changed in place.
+
+    The changes are written atomically when leaving the context, unless an
+    exception is raised.
+    """
+    os.makedirs(KONSAVE_DIR, exist_ok=True)
+    with open(f"{INDEX_FILE}.lock", "w", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        profiles = read_index()
+        yield profiles
+        with NamedTemporaryFile(
+            "w", dir=KONSAVE_DIR, prefix=".tmp", delete=False, encoding="utf-8"
+        ) as tmp:
+            json.dump({"version": INDEX_VERSION, "profiles": profiles}, tmp, indent=1)
+        os.replace(tmp.name, INDEX_FILE)
+
+
+def profile_entry(name: str, manifest: dict, host: str = None) -> dict:
+    """Build the index entry of a profile.
+
+    Args:
+        name: the profile name
+        manifest: the manifest of the profile
+        host: the host the profile was saved on, None if unknown
+
+    Returns:
+        dict: the entry
+    """
+    # pylint: disable=import-outside-toplevel
+    from konsave.store import hash_file, section_size
+
+    profile_dir = os.path.join(PROFILES_DIR, name)
+    st = os.stat(os.path.join(profile_dir, MANIFEST_NAME))
+    sections = {
+        section: section_size(files) for section, files in manifest["sections"].items()
+    }
+    files = sum(len(section["files"]) for section in manifest["sections"].values())
+    return {
+        "files": files,
+        "size": sum(sections.values()),
+        "sections": sections,
+        # The manifest is written last by save and import
+        "saved": st.st_mtime,
+        "host": host,
+        "config_hash": hash_file(os.path.join(profile_dir, "conf.yaml")),
+        "manifest_mtime_ns": st.st_mtime_ns,
+    }
+
+
+def add_profile(name: str, manifest: dict, imported: bool = False):
+    """Add or replace the index entry of a profile that was just written.
+
+    Args:
+        name: the profile name
+        manifest: the manifest of the profile
+        imported: True if the profile comes from an archive (unknown host)
+    """
+    entry = profile_entry(name, manifest, None if imported else socket.gethostname())
+    with transaction() as profiles:
+        profiles[name] = entry
+
+
+def remove_profiles(names):
+    """Remove the index entries of the given profiles"""
+    with transaction() as profiles:
+        for name in names:
+            profiles.pop(name, None)
+
+
+def list_index() -> dict:
+    """Return the index entries of all profiles, by name.
+
+    Entries of profiles that no longer exist are dropped, and the ones that
+    are missing or outdated are rebuilt from the manifests (one stat per
+    profile otherwise). Incomplete profile directories are left out.
+    """
+    names = os.listdir(PROFILES_DIR) if os.path.isdir(PROFILES_DIR) else []
+    profiles = read_index()
+    stale = []
+    for name in list(names):
+        entry = profiles.get(name) or {}
+        try:
+            st = os.stat(os.path.join(PROFILES_DIR, name, MANIFEST_NAME))
+        except FileNotFoundError:
+            if os.path.exists(os.path.join(PROFILES_DIR, name, "conf.yaml")):
+                # Saved before the object store, migrated by load_manifest()
+                stale.append(name)
+            else:
+                log.debug(f"Skipping incomplete profile: {name}")
+                names.remove(name)
+            continue
+        if entry.get("manifest_mtime_ns") != st.st_mtime_ns:
+            stale.append(name)
+
+    if stale or set(profiles) - set(names):
+        # Only needed to rebuild entries, the object store is slow to import
+        # pylint: disable=import-outside-toplevel
+        from konsave.store import load_manifest
+
+        log.debug(f"Updating profile index: {', '.join(stale) or 'removals'}")
+        with transaction() as profiles:
+            for name in stale:
+                manifest = load_manifest(os.path.join(PROFILES_DIR, name))
+                host = (profiles.get(name) or {}).get("host")
+                profiles[name] = profile_entry(name, manifest, host)
+            for name in set(profiles) - set(names):
+                del profiles[name]
+    return {name: profiles[name] for name in names}
@@ -0,0 +1,291 @@
+"""
+This module plans save, apply, export and import for --dry-run, and keeps the
+throughput of past runs (THROUGHPUT_FILE) to estimate how long they take.
+
+A plan is a list of rows, one per section and entry, counting the files that
+would be created, overwritten or skipped and the bytes that would be copied.
+Nothing is written while planning, although apply may read (hash) files to
+tell whether they changed, exactly like a real apply does.
+"""
+
+import os
+import json
+import time
+import logging
+from functools import partial
+from tempfile import NamedTemporaryFile
+
+from konsave.archive import hash_member, import_members, in_base, up_to_date
+from konsave.consts import KONSAVE_DIR, THROUGHPUT_FILE
+from konsave.copier import existing_entries, imap, section_patterns, walk
+from konsave.store import matches, unchanged
+from konsave.stream import import_stream
+from konsave.timings import member_key
+
+
+log = logging.getLogger("Konsave")
+
+# Number of past runs per command used for estimates
+HISTORY_SIZE = 10
+# Number of entries listed as the largest ones
+TOP_ENTRIES = 5
+
+
+class Planner:
+    """Collects the rows of a plan"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, section: str, entry: str, action: str, size: int):
+        """Count a file
+
+        Args:
+            section: the section of the file
+            entry: the entry of the file
+            action: "create", "overwrite" or "skip"
+            size: the size of the file in bytes
+        """
+        row = self.rows.get((section, entry))
+        if row is None:
+            row = self.rows[(section, entry)] = {
+                "section": section,
+                "entry": entry,
+                "files": 0,
+                "bytes": 0,
+                "create": 0,
+                "overwrite": 0,
+                "skip": 0,
+            }
+        row["files"] += 1
+        row[action] += 1
+        if action != "skip":
+            row["bytes"] += size
+
+    def totals(self) -> dict:
+        """Return the sum of all rows"""
+        totals = dict.fromkeys(("files", "bytes", "create", "overwrite", "skip"), 0)
+        for row in self.rows.values():
+            for key in totals:
+                totals[key] += row[key]
+        return totals
+
+
+def plan_save(konsave_config: dict, previous: dict, checksum: bool) -> Planner:
+    """Plan a save.
+
+    Args:
+        konsave_config: the "save" part of the parsed config
+        previous: the manifest sections of the last save of the profile
+        checksum: whether every file would be hashed
+
+    Returns:
+        Planner: files are created (new), overwritten (changed) or skipped
+    """
+    plan = Planner()
+    for name, section in konsave_config.items():
+        known = previous.get(name, {}).get("files", {})
+        patterns = section_patterns(section)
+        for entry, source in existing_entries(section):
+            if os.path.isdir(source):
+                paths = (
+                    (rel, item.path)
+                    for rel, item in walk(source, entry, patterns)
+                    if not item.is_dir()
+                )
+            else:
+                paths = [(entry, source)]
+            for rel, path in paths:
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                record = known.get(rel)
+                if record is None:
+                    action = "create"
+                elif not checksum and unchanged(st, record):
+                    action = "skip"
+                else:
+                    action = "overwrite"
+                plan.add(name, entry, action, st.st_size)
+    return plan
+
+
+def plan_apply(profile_config: dict, sections: dict, plan: Planner = None) -> Planner:
+    """Plan an apply.
+
+    Args:
+        profile_config: the "save" part of the parsed profile config
+        sections: the manifest sections of the profile
+        plan: a plan to add to (to plan an apply to several homes)
+
+    Returns:
+        Planner: files are created, overwritten or skipped (up to date)
+    """
+    plan = plan or Planner()
+    for name, section in profile_config.items():
+        files = sections.get(name, {}).get("files", {})
+        for path, record in files.items():
+            target = os.path.join(section["location"], path)
+            if not os.path.lexists(target):
+                action = "create"
+            elif matches(record, target):
+                action = "skip"
+            else:
+                action = "overwrite"
+            plan.add(name, path.split("/", 1)[0], action, record["size"])
+    return plan
+
+
+def plan_export(members, base: dict = None) -> Planner:
+    """Plan an export: every file member is added to a new archive, except
+    for a delta archive the ones that did not change since its base.
+
+    Args:
+        members: the archive members (see archive.Member)
+        base: the integrity records of the base archive, if any
+    """
+    plan = Planner()
+    base_records = (base or {}).get("members", {})
+    for member in imap(partial(hash_member, base=base_records), members):
+        if member.path is None:
+            continue
+        try:
+            size = os.path.getsize(member.path)
+        except FileNotFoundError:
+            continue
+        action = "skip" if in_base(member, base_records) else "create"
+        plan.add(*member_key(member.arcname), action, size)
+    return plan
+
+
+def plan_import(archives, konsave_config: dict) -> Planner:
+    """Plan an import.
+
+    Saved files are created in the object store, exported ones are created
+    or overwrite the files in their location (only for the listed entries).
+    With integrity records, the files already there are skipped.
+
+    Args:
+        archives: the archive and its deltas (archive.ArchiveChain)
+        konsave_config: the parsed config of the last archive
+    """
+    plan = Planner()
+    records = archives.records
+    for zinfo, _, _, dest in import_members(archives, konsave_config):
+        if zinfo.is_dir():
+            continue
+        if up_to_date(dest, records.get(zinfo.filename)):
+            action = "skip"
+        elif dest and os.path.lexists(dest):
+            action = "overwrite"
+        else:
+            action = "create"
+        plan.add(*member_key(zinfo.filename), action, zinfo.file_size)
+    return plan
+
+
+def plan_stream(src, config_dir: str) -> Planner:
+    """Plan the import of a stream archive, reading it through (see
+    plan_import()).
+
+    Args:
+        src: the stream archive
+        config_dir: where to write its conf.yaml
+    """
+    plan = Planner()
+    for _, info, data, record, target in import_stream(src, config_dir):
+        if data is None:
+            continue
+        dest = target[2]
+        if up_to_date(dest, record):
+            action = "skip"
+        elif dest and os.path.lexists(dest):
+            action = "overwrite"
+        else:
+            action = "create"
+        plan.add(*member_key(info.name), action, info.size)
+    return plan
+
+
+def _read_history() -> dict:
+    try:
+        with open(THROUGHPUT_FILE, "r", encoding="utf-8") as src:
+            return json.load(src)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_run(command: str, files: int, size: int, seconds: float):
+    """Remember the throughput of a command, for later estimates.
+
+    Args:
+        command: "save", "apply", "export" or "import"
+        files: the number of files copied
+        size: the number of bytes copied
+        seconds: how long it took
+    """
+    if not files:
+        # Nothing to learn from
+        return
+    history = _read_history()
+    runs = history.setdefault(command, [])
+    runs.append({"files": files, "bytes": size, "seconds": seconds})
+    del runs[:-HISTORY_SIZE]
+    try:
+        os.makedirs(KONSAVE_DIR, exist_ok=True)
+        with NamedTemporaryFile(
+            "w", dir=KONSAVE_DIR, prefix=".tmp", delete=False, encoding="utf-8"
+        ) as tmp:
+            json.dump(history, tmp)
+        os.replace(tmp.name, THROUGHPUT_FILE)
+    except OSError as ex:
+        log.debug(f"Could not update throughput history: {ex}")
+
+
+def estimate(command: str, files: int, size: int) -> tuple:
+    """Estimate how long copying ``files`` files of ``size`` bytes takes.
+
+    Half of the time is scaled by bytes and half by files, from the totals
+    of the last runs of the same command.
+
+    Returns:
+        tuple: the estimate in seconds (None without history) and the number
+        of runs it is based on
+    """
+    runs = _read_history().get(command, [])
+    if not runs:
+        return None, 0
+    seconds = sum(run["seconds"] for run in runs)
+    total_files = sum(run["files"] for run in runs)
+    total_bytes = sum(run["bytes"] for run in runs)
+    by_bytes = size * seconds / total_bytes if total_bytes else 0
+    by_files = files * seconds / total_files
+    return (by_bytes + by_files) / 2, len(runs)
+
+
+def format_duration(seconds: float) -> str:
+    """Format a duration like "1h 02m", "3m 20s" or "12s" """
+    if seconds < 1:
+        return "less than a second"
+    seconds = round(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def start_run(command: str):
+    """Start timing a command.
+
+    Returns:
+        function: to call with the number of files and bytes copied once the
+        command is done, to record its throughput (see record_run)
+    """
+    started = time.perf_counter()
+
+    def done(files: int, size: int):
+        record_run(command, files, size, time.perf_counter() - started)
+
+    return done
@@ -0,0 +1,166 @@
+"""
+This module contains the commands managing the saved profiles as a whole:
+list, remove, wipe and gc, and the helpers shared by all commands.
+
+It only imports the profile index, so that listing profiles does not pay for
+the object store and the copy engine.
+"""
+
+import os
+import shutil
+import logging
+from fnmatch import fnmatch
+from datetime import datetime
+
+from konsave.consts import INDEX_FILE, OBJECTS_DIR, PROFILES_DIR
+from konsave.index import list_index, remove_profiles
+
+
+log = logging.getLogger("Konsave")
+
+
+def tabulate(rows, headers) -> str:
+    """Format a table with tabulate, which is only imported when needed as it
+    is one of the slowest modules to import"""
+    # pylint: disable=import-outside-toplevel,redefined-outer-name
+    import tabulate
+
+    return tabulate.tabulate(rows, headers=headers)
+
+
+def get_profiles():
+    """Return the profile names installed/saved and their count"""
+    profs = os.listdir(PROFILES_DIR) if os.path.isdir(PROFILES_DIR) else []
+    return profs, len(profs)
+
+
+def convert(value, cur_unit="B", units=None, increment=1024):
+    """
+    Convert the given value/cur_unit to the largest unit available
+    or to a value less than ``increment``
+    """
+    units = units or ["B", "KB", "MB", "GB", "TB"]
+    unit_idx = units.index(cur_unit)
+    while value >= increment and len(units) > unit_idx + 1:
+        unit_idx += 1
+        value /= 1024
+
+    return value, units[unit_idx]
+
+
+def list_profiles(args):
+    """Lists all the created profiles, from the profile index.
+
+    Args:
+        args.sort: the column to sort by
+        args.reverse: reverse the order
+        args.filter: only list profiles whose name matches this glob
+        args.host: only list profiles saved on this host
+        args.long: show the size of every section
+    """
+    profiles = list_index()
+
+    # assert
+    assert profiles, "No profile found."
+
+    # run
+    if args.filter:
+        profiles = {
+            name: entry
+            for name, entry in profiles.items()
+            if fnmatch(name, args.filter)
+        }
+    if args.host:
+        profiles = {
+            name: entry
+            for name, entry in profiles.items()
+            if entry["host"] == args.host
+        }
+    assert profiles, "No profile matches."
+
+    def sort_key(item):
+        name, entry = item
+        if args.sort == "name":
+            return name
+        # Only the host can be missing, numeric columns stay numeric
+        value = entry[args.sort]
+        return ("" if value is None else value, name)
+
+    table = []
+    for i, (name, entry) in enumerate(
+        sorted(profiles.items(), key=sort_key, reverse=args.reverse)
+    ):
+        size, unit = convert(entry["size"])
+        row = [
+            i,
+            name,
+            entry["files"],
+            f"{size:.2f} {unit}",
+            datetime.fromtimestamp(entry["saved"]).strftime("%Y-%m-%d %H:%M"),
+            entry["host"] or "-",
+            entry["config_hash"][:12],
+        ]
+        if args.long:
+            sections = []
+            for section, section_bytes in entry["sections"].items():
+                size, unit = convert(section_bytes)
+                sections.append(f"{section}: {size:.2f} {unit}")
+            row.append(", ".join(sections))
+        table.append(row)
+
+    headers = ["ID", "NAME", "FILES", "SIZE", "SAVED", "HOST", "CONFIG"]
+    if args.long:
+        headers.append("SECTIONS")
+    print("Konsave profiles:")
+    print(tabulate(table, headers=headers))
+
+
+def remove_profile(args):
+    """Removes the specified profile.
+
+    Args:
+        profile_name: name of the profile to be removed
+        profile_list: the list of all created profiles
+        profile_count: number of profiles created
+    """
+
+    profile_list, profile_count = get_profiles()
+    # assert
+    assert profile_count != 0, "No profile saved yet."
+    assert args.name in profile_list, f"Profile not found: {args.name}"
+
+    # Only needed here, the object store is slow to import for list
+    from konsave.store import (  # pylint: disable=import-outside-toplevel
+        collect_garbage,
+    )
+
+    # run
+    log.info("removing profile...")
+    shutil.rmtree(os.path.join(PROFILES_DIR, args.name))
+    remove_profiles([args.name])
+    collect_garbage()
+    log.info("removed profile successfully")
+
+
+def wipe(args):  # pylint: disable=unused-argument
+    """Wipes all profiles."""
+    confirm = input('This will wipe all your profiles. Enter "WIPE" To continue: ')
+    if confirm == "WIPE":
+        shutil.rmtree(PROFILES_DIR, ignore_errors=True)
+        shutil.rmtree(OBJECTS_DIR, ignore_errors=True)
+        if os.path.exists(INDEX_FILE):
+            os.remove(INDEX_FILE)
+        log.info("Removed all profiles!")
+    else:
+        log.info("Aborting...")
+
+
+def garbage_collect(args):  # pylint: disable=unused-argument
+    """Remove stored files that are no longer referenced by any profile"""
+    from konsave.store import (  # pylint: disable=import-outside-toplevel
+        collect_garbage,
+    )
+
+    removed, freed = collect_garbage()
+    size, unit = convert(freed)
+    log.info(f"Removed {removed} unreferenced objects ({size:.2f} {unit})")
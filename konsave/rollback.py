@@ -0,0 +1,167 @@
+"""
+This module keeps what apply is about to overwrite, so that it can be undone.
+
+Before apply replaces a file, the file is hard linked into ROLLBACK_DIR.
+Since apply writes new files under a temp name and renames them over the old
+ones, the old inode is never modified and the link keeps its content at no
+cost. A copy (a reflink where supported) is only made when linking fails,
+ie. across filesystems.
+
+Every change is appended to a journal, so that only the last apply can be
+rolled back, even after a crash.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+
+from konsave.consts import ROLLBACK_DIR
+from konsave.copier import copy_fileobj
+
+
+log = logging.getLogger("Konsave")
+
+JOURNAL_NAME = "journal"
+
+
+class Journal:
+    """The rollback area of the apply in progress.
+
+    The rollback area of the previous apply is only dropped on the first
+    change recorded, so that an apply that fails before changing anything,
+    or has nothing to change, keeps it.
+    """
+
+    def __init__(self, profile: str):
+        self.profile = profile
+        self.time = time.time()
+        self.files_dir = os.path.join(ROLLBACK_DIR, "files")
+        self._lock = threading.Lock()
+        self._count = 0
+        self._journal = None
+
+    def _start(self):
+        """Replace the previous rollback area with this one, on the first
+        change. Must hold _lock"""
+        if self._journal is not None:
+            return
+        shutil.rmtree(ROLLBACK_DIR, ignore_errors=True)
+        os.makedirs(self.files_dir)
+        # pylint: disable=consider-using-with
+        # Closed in close()
+        self._journal = open(
+            os.path.join(ROLLBACK_DIR, JOURNAL_NAME), "a", encoding="utf-8"
+        )
+        self._journal.write(
+            json.dumps({"profile": self.profile, "time": self.time}) + "\n"
+        )
+
+    def started(self) -> bool:
+        """Return True once a change was recorded"""
+        return self._journal is not None
+
+    def _write(self, change: dict):
+        """Append a change to the journal. Must be called before making it"""
+        with self._lock:
+            self._start()
+            self._journal.write(json.dumps(change) + "\n")
+            self._journal.flush()
+
+    def _backup_name(self) -> str:
+        with self._lock:
+            self._start()
+            self._count += 1
+            return str(self._count)
+
+    def backup(self, path: str):
+        """Record that ``path`` is about to be replaced (or created)"""
+        if not os.path.lexists(path):
+            self._write({"path": path, "backup": None})
+            return
+
+        name = self._backup_name()
+        backup = os.path.join(self.files_dir, name)
+        try:
+            os.link(path, backup, follow_symlinks=False)
+        except OSError:
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), backup)
+            else:
+                with open(path, "rb") as src, open(backup, "wb") as dst:
+                    copy_fileobj(src, dst)
+                shutil.copystat(path, backup)
+        self._write({"path": path, "backup": name})
+
+    def chmod(self, path: str, mode: int):
+        """Record that the mode of ``path`` is about to be changed from ``mode``"""
+        self._write({"path": path, "mode": mode})
+
+    def makedirs(self, path: str):
+        """Create a directory and its missing parents, recording each of them"""
+        missing = []
+        while not os.path.isdir(path):
+            missing.append(path)
+            path = os.path.dirname(path)
+        for directory in reversed(missing):
+            self._write({"dir": directory})
+            os.makedirs(directory, exist_ok=True)
+
+    def close(self):
+        """Close the journal"""
+        if self._journal is not None:
+            self._journal.close()
+
+
+def last_apply() -> dict:
+    """Return the first record (profile, time) of the journal, None if none"""
+    try:
+        with open(
+            os.path.join(ROLLBACK_DIR, JOURNAL_NAME), "r", encoding="utf-8"
+        ) as src:
+            return json.loads(src.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def rollback() -> dict:
+    """Undo the changes of the last apply, in reverse order, and drop them.
+
+    Returns:
+        dict: the number of files "restored" and "removed"
+    """
+    files_dir = os.path.join(ROLLBACK_DIR, "files")
+    changes = []
+    with open(os.path.join(ROLLBACK_DIR, JOURNAL_NAME), "r", encoding="utf-8") as src:
+        for line in src:
+            try:
+                changes.append(json.loads(line))
+            except ValueError:
+                # Last line cut short by a crash
+                break
+
+    results = {"restored": 0, "removed": 0}
+    for change in reversed(changes[1:]):
+        if "dir" in change:
+            try:
+                os.rmdir(change["dir"])
+            except OSError:
+                # Not empty (or already gone): leave it
+                pass
+        elif "mode" in change:
+            if os.path.exists(change["path"]):
+                os.chmod(change["path"], change["mode"])
+        elif change["backup"] is None:
+            if os.path.lexists(change["path"]):
+                os.remove(change["path"])
+                results["removed"] += 1
+        else:
+            backup = os.path.join(files_dir, change["backup"])
+            if os.path.lexists(backup):
+                os.replace(backup, change["path"])
+                results["restored"] += 1
+
+    shutil.rmtree(ROLLBACK_DIR, ignore_errors=True)
+    return results
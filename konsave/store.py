@@ -0,0 +1,546 @@
+"""
+This module implements the content-addressed object store used by profiles.
+
+Every saved file is stored once under OBJECTS_DIR, keyed by its SHA-256
+digest. Each profile only keeps its conf.yaml and a manifest.json that maps
+the files of every section to their objects, so identical files across
+profiles (or across saves of the same profile) share the same object.
+"""
+
+import os
+import json
+import stat
+import fcntl
+import shutil
+import hashlib
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+from tempfile import NamedTemporaryFile
+
+from konsave import timings
+from konsave.consts import MANIFEST_NAME, OBJECTS_DIR, PROFILES_DIR
+from konsave.config import parse
+from konsave.copier import Patterns, copy_fileobj, parallel, walk
+
+
+log = logging.getLogger("Konsave")
+
+# Directory of the saved versions of a profile (see konsave.history)
+HISTORY_NAME = "history"
+MANIFEST_VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+
+
+# The object store lock held by each thread, see store_lock()
+_held = threading.local()
+
+
+@contextmanager
+def store_lock(exclusive: bool = False):
+    """Lock the object store: shared while adding objects that no profile
+    manifest refers to yet, exclusive while collecting garbage, so that gc
+    never removes the objects of a save or import in progress.
+
+    Re-entering it in a thread that already holds it does nothing (legacy
+    profiles are migrated while collecting garbage), so gc must not be run
+    while holding a shared lock.
+    """
+    if getattr(_held, "lock", False):
+        yield
+        return
+    os.makedirs(OBJECTS_DIR, exist_ok=True)
+    fd = os.open(OBJECTS_DIR, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        _held.lock = True
+        yield
+    finally:
+        _held.lock = False
+        os.close(fd)
+
+
+def object_path(digest: str) -> str:
+    """Return the path of the object with the given digest"""
+    return os.path.join(OBJECTS_DIR, digest[:2], digest[2:])
+
+
+def hash_file(path: str) -> str:
+    """Return the hex SHA-256 digest of the file in ``path``"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as src:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _add_object(write) -> str:
+    """Create an object from the content written by ``write(tmp)``.
+
+    ``write`` fills the given temp file and returns the digest of what it
+    wrote. The temp file is then renamed into place (or dropped if the object
+    already exists), so that a crash never leaves a partial object behind a
+    valid digest.
+
+    Returns:
+        str: the digest of the object
+    """
+    os.makedirs(OBJECTS_DIR, exist_ok=True)
+    with NamedTemporaryFile(dir=OBJECTS_DIR, prefix=".tmp", delete=False) as tmp:
+        try:
+            digest = write(tmp)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+
+    obj = object_path(digest)
+    if os.path.exists(obj):
+        os.unlink(tmp.name)
+    else:
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        os.chmod(tmp.name, 0o444)
+        os.replace(tmp.name, obj)
+    return digest
+
+
+def store_stream(src, mode: int) -> dict:
+    """Add the content of a readable binary stream to the object store.
+
+    Args:
+        src: the stream to consume
+        mode: the permission bits to record
+
+    Returns:
+        dict: the manifest record of the content
+    """
+    size = 0
+
+    def write(tmp):
+        nonlocal size
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            tmp.write(chunk)
+            size += len(chunk)
+        return digest.hexdigest()
+
+    return {"digest": _add_object(write), "size": size, "mode": mode}
+
+
+def unchanged(st: os.stat_result, record: dict) -> bool:
+    """Return True if ``st`` matches the size, mtime and inode of a record"""
+    return (
+        record.get("size") == st.st_size
+        and record.get("mtime_ns") == st.st_mtime_ns
+        and record.get("ino") == st.st_ino
+    )
+
+
+def store_file(path: str, previous: dict = None) -> dict:
+    """Add a file to the object store, unless an identical one is already there.
+
+    Args:
+        path: the file to store
+        previous: the record of the same file from the last save, if any. If
+            the file looks unchanged since then, it is neither read nor copied
+
+    Returns:
+        dict: the manifest record of the file
+    """
+    # Stat before reading: a change while hashing shows up on the next save
+    st = os.stat(path)
+    timings.count(bytes=st.st_size, stat=1)
+    if previous and unchanged(st, previous):
+        return {**previous, "mode": stat.S_IMODE(st.st_mode)}
+
+    digest = hash_file(path)
+    timings.count(open=1, stat=1)
+
+    def write(tmp):
+        with open(path, "rb") as src:
+            copy_fileobj(src, tmp)
+        return digest
+
+    if not os.path.exists(object_path(digest)):
+        _add_object(write)
+        timings.count(open=1, copy=1)
+    return {
+        "digest": digest,
+        "size": st.st_size,
+        "mode": stat.S_IMODE(st.st_mode),
+        "mtime_ns": st.st_mtime_ns,
+        "ino": st.st_ino,
+    }
+
+
+def new_section() -> dict:
+    """Return an empty manifest section"""
+    return {"files": {}, "dirs": []}
+
+
+def store_entry(
+    source: str,
+    entry: str,
+    section: dict,
+    previous: dict = None,
+    patterns: Patterns = None,
+):
+    """Store the file or directory ``source`` as ``entry`` of the given section.
+
+    Args:
+        source: the path of the file/directory to store
+        entry: the path relative to the section location
+        section: the manifest section to record the entry in
+        previous: the file records of the same section from the last save
+        patterns: the include/exclude patterns of the config section
+    """
+    previous = previous or {}
+
+    def store(path, rel):
+        try:
+            with timings.track():
+                section["files"][rel] = store_file(path, previous.get(rel))
+        except FileNotFoundError:
+            # Broken symlink or removed while saving
+            log.debug(f"File '{path}' does not exist")
+
+    if not os.path.isdir(source):
+        store(source, entry)
+        return
+
+    def files():
+        for rel, item in walk(source, entry, patterns):
+            if item.is_dir():
+                section["dirs"].append(rel)
+            else:
+                yield item.path, rel
+
+    if entry:
+        section["dirs"].append(entry)
+    parallel(store, files())
+
+
+def store_tree(path: str) -> dict:
+    """Store the contents of the directory ``path`` as a new manifest section"""
+    section = new_section()
+    if os.path.isdir(path):
+        store_entry(path, "", section)
+    return section
+
+
+def new_manifest() -> dict:
+    """Return an empty manifest"""
+    return {"version": MANIFEST_VERSION, "sections": {}}
+
+
+def manifest_path(profile_dir: str) -> str:
+    """Return the manifest path of the given profile directory"""
+    return os.path.join(profile_dir, MANIFEST_NAME)
+
+
+def write_manifest(profile_dir: str, manifest: dict):
+    """Atomically write the manifest of a profile"""
+    with NamedTemporaryFile(
+        "w", dir=profile_dir, prefix=".tmp", delete=False, encoding="utf-8"
+    ) as tmp:
+        json.dump(manifest, tmp, indent=1, sort_keys=True)
+    os.replace(tmp.name, manifest_path(profile_dir))
+
+
+def migrate_legacy(profile_dir: str) -> dict:
+    """Move a profile saved as plain copies (pre object store) into the store.
+
+    Args:
+        profile_dir: the profile directory
+
+    Returns:
+        dict: the new manifest
+    """
+    log.info(f"Migrating profile '{os.path.basename(profile_dir)}' to object store")
+    manifest = new_manifest()
+    with store_lock():
+        for name in parse(os.path.join(profile_dir, "conf.yaml"))["save"]:
+            manifest["sections"][name] = store_tree(os.path.join(profile_dir, name))
+        write_manifest(profile_dir, manifest)
+
+    for name in manifest["sections"]:
+        shutil.rmtree(os.path.join(profile_dir, name), ignore_errors=True)
+    return manifest
+
+
+def is_complete(profile_dir: str) -> bool:
+    """Return True if ``profile_dir`` holds a whole profile: its manifest, or
+    the conf.yaml of a profile saved before the object store"""
+    return os.path.exists(manifest_path(profile_dir)) or os.path.exists(
+        os.path.join(profile_dir, "conf.yaml")
+    )
+
+
+def load_manifest(profile_dir: str) -> dict:
+    """Load the manifest of a profile, migrating legacy profiles on the way"""
+    path = manifest_path(profile_dir)
+    if not os.path.exists(path):
+        name = os.path.basename(profile_dir)
+        assert is_complete(profile_dir), f"Incomplete profile: {name}"
+        return migrate_legacy(profile_dir)
+    with open(path, "r", encoding="utf-8") as src:
+        return json.load(src)
+
+
+def matches(record: dict, path: str) -> bool:
+    """Return True if the file in ``path`` has the content of a record.
+
+    Like on save, a file with the size and mtime of the record is taken as
+    is. Otherwise, if the size matches, the file is hashed.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if st.st_size != record["size"]:
+        return False
+    if record.get("mtime_ns") == st.st_mtime_ns:
+        return True
+    timings.count(open=1)
+    return hash_file(path) == record["digest"]
+
+
+def restore_file(record: dict, dest: str, journal=None, owner: tuple = None) -> str:
+    """Make ``dest`` hold the object of a manifest record.
+
+    Files that already have the right content are left alone (at most their
+    mode is fixed), so their mtime does not change and file watchers are not
+    triggered. Others are written to a temp file renamed over ``dest``.
+
+    Args:
+        record: the manifest record
+        dest: the file to write
+        journal: the rollback.Journal to record changes in, if any
+        owner: the uid and gid to give the written file, if any
+
+    Returns:
+        str: "added", "changed" or "skipped"
+    """
+    timings.count(stat=1)
+    exists = os.path.lexists(dest)
+    if exists and matches(record, dest):
+        mode = stat.S_IMODE(os.stat(dest).st_mode)
+        if mode != record["mode"]:
+            if journal:
+                journal.chmod(dest, mode)
+            os.chmod(dest, record["mode"])
+        return "skipped"
+
+    with open(object_path(record["digest"]), "rb") as src, NamedTemporaryFile(
+        dir=os.path.dirname(dest), prefix=".konsave", delete=False
+    ) as tmp:
+        try:
+            copy_fileobj(src, tmp)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+    os.chmod(tmp.name, record["mode"])
+    if owner:
+        os.chown(tmp.name, *owner)
+    if "mtime_ns" in record:
+        # So that the next apply finds it unchanged without hashing it
+        os.utime(tmp.name, ns=(record["mtime_ns"], record["mtime_ns"]))
+    if journal:
+        journal.backup(dest)
+    os.replace(tmp.name, dest)
+    timings.count(bytes=record["size"], open=2, copy=1)
+    return "changed" if exists else "added"
+
+
+def restore_section(section: dict, dest: str, journal=None) -> Counter:
+    """Write the directories and files of a manifest section under ``dest``,
+    skipping the files that are already up to date.
+
+    Args:
+        section: the manifest section
+        dest: the location of the section
+        journal: the rollback.Journal to record changes in, if any
+
+    Returns:
+        Counter: the number of files "added", "changed" and "skipped", and
+        the "bytes" written
+    """
+    makedirs = journal.makedirs if journal else partial(os.makedirs, exist_ok=True)
+    makedirs(dest)
+    for path in section["dirs"]:
+        makedirs(os.path.join(dest, path))
+
+    results = Counter()
+    lock = threading.Lock()
+
+    def restore(record, target, path):
+        # Attribute the file to the top level entry it belongs to
+        with timings.scope(entry=path.split("/", 1)[0]), timings.track():
+            result = restore_file(record, target, journal)
+        with lock:
+            results[result] += 1
+            if result != "skipped":
+                results["bytes"] += record["size"]
+
+    def files():
+        for path, record in section["files"].items():
+            target = os.path.join(dest, path)
+            makedirs(os.path.dirname(target))
+            yield record, target, path
+
+    parallel(restore, files())
+    return results
+
+
+def home_owner(home: str) -> tuple:
+    """Return the uid and gid that files written under another user's home
+    should get: the owner of ``home`` when running as root, None otherwise"""
+    if os.geteuid() != 0:
+        return None
+    st = os.stat(home)
+    return (st.st_uid, st.st_gid) if st.st_uid != 0 else None
+
+
+def restore_homes(section: dict, dests: dict, journal=None) -> tuple:
+    """Write a manifest section under the location of several homes (see
+    restore_section()).
+
+    Every file is written to all homes in a row, while its object is hot in
+    the page cache (or shares its extents, with reflinks), and all writes go
+    through a single worker pool. A failing home does not stop the others,
+    it is only skipped from then on.
+
+    Args:
+        section: the manifest section
+        dests: the location of the section, by home
+        journal: the rollback.Journal to record changes in, if any
+
+    Returns:
+        tuple: a Counter per home (see restore_section()) and the error of
+        each failed home
+    """
+    make = journal.makedirs if journal else partial(os.makedirs, exist_ok=True)
+    owners = {home: home_owner(home) for home in dests}
+    results = {home: Counter() for home in dests}
+    errors = {}
+    lock = threading.Lock()
+
+    def makedirs(home, path):
+        missing = []
+        while not os.path.isdir(path):
+            missing.append(path)
+            path = os.path.dirname(path)
+        if missing:
+            make(missing[0])
+            for directory in missing if owners[home] else ():
+                os.chown(directory, *owners[home])
+
+    def fail(home, ex):
+        with lock:
+            errors.setdefault(home, f"{type(ex).__name__}: {ex}")
+
+    for home, dest in dests.items():
+        try:
+            makedirs(home, dest)
+            for path in section["dirs"]:
+                makedirs(home, os.path.join(dest, path))
+        except OSError as ex:
+            fail(home, ex)
+
+    def restore(home, record, target, path):
+        if home in errors:
+            return
+        with timings.scope(entry=path.split("/", 1)[0]), timings.track():
+            try:
+                result = restore_file(record, target, journal, owners[home])
+            except OSError as ex:
+                fail(home, ex)
+                return
+        with lock:
+            results[home][result] += 1
+            if result != "skipped":
+                results[home]["bytes"] += record["size"]
+
+    def files():
+        for path, record in section["files"].items():
+            for home, dest in dests.items():
+                if home in errors:
+                    continue
+                target = os.path.join(dest, path)
+                try:
+                    makedirs(home, os.path.dirname(target))
+                except OSError as ex:
+                    fail(home, ex)
+                    continue
+                yield home, record, target, path
+
+    parallel(restore, files())
+    return results, errors
+
+
+def section_size(section: dict) -> int:
+    """Return the total size in bytes of the files in a manifest section"""
+    return sum(record["size"] for record in section["files"].values())
+
+
+def referenced_digests() -> set:
+    """Return the digests of all objects referenced by any profile or any of
+    their versions"""
+    digests = set()
+    if not os.path.isdir(PROFILES_DIR):
+        return digests
+    for name in os.listdir(PROFILES_DIR):
+        profile_dir = os.path.join(PROFILES_DIR, name)
+        if not is_complete(profile_dir):
+            continue
+        manifests = [load_manifest(profile_dir)]
+        history = os.path.join(profile_dir, HISTORY_NAME)
+        if os.path.isdir(history):
+            for version in os.listdir(history):
+                path = os.path.join(history, version)
+                if os.path.exists(manifest_path(path)):
+                    manifests.append(load_manifest(path))
+        for manifest in manifests:
+            for section in manifest["sections"].values():
+                digests.update(record["digest"] for record in section["files"].values())
+    return digests
+
+
+def collect_garbage() -> tuple:
+    """Remove all objects not referenced by any profile (or version) manifest.
+
+    Waits for the saves and imports in progress, which hold store_lock()
+    until the manifest referring to their new objects is in place.
+
+    Returns:
+        tuple: number of objects removed and bytes freed
+    """
+    if not os.path.exists(OBJECTS_DIR):
+        return 0, 0
+
+    with store_lock(exclusive=True):
+        return _collect_garbage(referenced_digests())
+
+
+def _collect_garbage(keep: set) -> tuple:
+    removed, freed = 0, 0
+    for prefix in os.listdir(OBJECTS_DIR):
+        prefix_dir = os.path.join(OBJECTS_DIR, prefix)
+        if not os.path.isdir(prefix_dir):
+            # Leftover temp file of an interrupted save or import
+            freed += os.stat(prefix_dir).st_size
+            os.remove(prefix_dir)
+            removed += 1
+            continue
+        for name in os.listdir(prefix_dir):
+            if prefix + name in keep:
+                continue
+            path = os.path.join(prefix_dir, name)
+            freed += os.stat(path).st_size
+            os.remove(path)
+            removed += 1
+        if not os.listdir(prefix_dir):
+            os.rmdir(prefix_dir)
+    return removed, freed
@@ -0,0 +1,442 @@
+"""
+This module writes and reads streamed konsave archives: tar streams
+compressed with zstd or xz, which unlike zip archives can be written to and
+read from a pipe (``konsave export -o -`` and ``konsave import -``).
+
+Members are the same as in zip archives, in an order that allows importing
+as the stream comes: conf.yaml first, so that the config is known before any
+other member, and INTEGRITY_NAME last. Every file also carries its SHA-256
+in a PAX header (DIGEST_HEADER), so that it is checked before it is put in
+place and skipped if already there. To write that header upfront, files not
+coming from the object store are hashed ahead, in parallel with compression.
+
+zstd needs the optional zstandard module, xz only the standard library.
+"""
+
+import io
+import os
+import sys
+import json
+import lzma
+import time
+import hashlib
+import tarfile
+import logging
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from importlib.util import find_spec
+
+from konsave import timings
+from konsave.archive import (
+    DIR_MODE,
+    INTEGRITY_NAME,
+    INTEGRITY_VERSION,
+    Member,
+    Staging,
+    extract_member,
+    import_target,
+    profile_digest,
+    write_output,
+)
+from konsave.config import parse
+from konsave.copier import imap
+from konsave.store import CHUNK_SIZE, hash_file, new_manifest, new_section
+
+
+log = logging.getLogger("Konsave")
+
+STREAM_FORMATS = ("tar.zst", "tar.xz")
+DIGEST_HEADER = "KONSAVE.sha256"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+
+
+def _zstandard():
+    """Import the optional zstandard module"""
+    try:
+        import zstandard  # pylint: disable=import-outside-toplevel
+    except ImportError as ex:
+        raise ValueError(
+            "zstd archives need the zstandard module (pip install zstandard), "
+            "use --format tar.xz instead"
+        ) from ex
+    return zstandard
+
+
+def default_format() -> str:
+    """Return the stream format used by default: zstd if available, else xz"""
+    return "tar.zst" if find_spec("zstandard") else "tar.xz"
+
+
+def stream_format(src) -> str:
+    """Return the format of a stream from its first bytes, without consuming
+    them, None if not a stream archive.
+
+    Args:
+        src: a buffered binary stream (with peek())
+    """
+    head = src.peek(len(XZ_MAGIC))[: len(XZ_MAGIC)]
+    if head.startswith(ZSTD_MAGIC):
+        return "tar.zst"
+    if head.startswith(XZ_MAGIC):
+        return "tar.xz"
+    return None
+
+
+def is_stream_archive(path: str) -> bool:
+    """Return True if ``path`` is a stream archive ("-" for stdin)"""
+    if path == "-":
+        return True
+    try:
+        with open(path, "rb") as src:
+            return stream_format(src) is not None
+    except OSError:
+        return False
+
+
+@contextmanager
+def open_input(path: str):
+    """Open an archive for reading, "-" being stdin"""
+    if path == "-":
+        yield sys.stdin.buffer
+    else:
+        with open(path, "rb") as src:
+            yield src
+
+
+@contextmanager
+def _compressor(out, fmt: str, level: int = None):
+    if fmt == "tar.zst":
+        # zstd levels go up to 22, 3 being its default
+        compressor = _zstandard().ZstdCompressor(level=level or 3, threads=-1)
+        with compressor.stream_writer(out, closefd=False) as writer:
+            yield writer
+    else:
+        with lzma.LZMAFile(out, "w", preset=6 if level is None else level) as writer:
+            yield writer
+
+
+@contextmanager
+def _reading():
+    """Turn the errors of a damaged or truncated stream into ValueError"""
+    errors = (tarfile.TarError, lzma.LZMAError, EOFError)
+    if "zstandard" in sys.modules:
+        errors += (sys.modules["zstandard"].ZstdError,)
+    try:
+        yield
+    except errors as ex:
+        raise ValueError(f"Corrupted or truncated archive: {ex}") from ex
+
+
+def _decompressor(src, fmt: str):
+    if fmt == "tar.zst":
+        return _zstandard().ZstdDecompressor().stream_reader(src, closefd=False)
+    return lzma.LZMAFile(src, "r")
+
+
+def _hash_ahead(member: Member) -> tuple:
+    """Fill in the digest of a file member, for its PAX header.
+
+    Returns:
+        tuple: the member and True if its digest was computed from a live
+        file, which may change before it is added
+    """
+    if member.path is None or member.digest:
+        return member, False
+    try:
+        return member._replace(digest=hash_file(member.path)), True
+    except FileNotFoundError:
+        return member, False
+
+
+class _HashingReader:
+    """A readable stream hashing the data read from another"""
+
+    def __init__(self, src):
+        self.src = src
+        self.sha = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read and hash up to ``size`` bytes"""
+        data = self.src.read(size)
+        self.sha.update(data)
+        return data
+
+    def hexdigest(self) -> str:
+        """Return the SHA-256 of the data read so far"""
+        return self.sha.hexdigest()
+
+
+def _add_member(tar: tarfile.TarFile, member: Member, live: bool = False) -> dict:
+    """Add a member to a tar stream.
+
+    Args:
+        tar: the tar stream
+        member: the member to add
+        live: True if the digest of the member was computed from a live file
+            (see _hash_ahead()), to be checked against the data added
+
+    Returns:
+        dict: the integrity record of a file member, None otherwise
+    """
+    if member.path is None:
+        info = tarfile.TarInfo(member.arcname)
+        info.type = tarfile.DIRTYPE
+        info.mode = DIR_MODE
+        info.mtime = time.time()
+        tar.addfile(info)
+        return None
+
+    if member.digest is None:
+        # Removed before it could be hashed
+        log.debug(f"File '{member.path}' does not exist")
+        return None
+    with timings.member_scope(member.arcname), timings.track():
+        with open(member.path, "rb") as src:
+            st = os.fstat(src.fileno())
+            info = tarfile.TarInfo(member.arcname)
+            info.size = st.st_size
+            info.mode = member.mode if member.mode is not None else st.st_mode & 0o777
+            info.mtime = (member.mtime_ns or st.st_mtime_ns) / 1e9
+            info.pax_headers = {DIGEST_HEADER: member.digest}
+            reader = _HashingReader(src) if live else src
+            tar.addfile(info, reader)
+        if live and reader.hexdigest() != member.digest:
+            raise ValueError(
+                f"'{member.path}' changed while being exported, export again"
+            )
+        timings.count(bytes=st.st_size, stat=1, open=1, copy=1)
+    return {"sha256": member.digest, "size": st.st_size}
+
+
+def write_stream(out, members, fmt: str, level: int = None) -> tuple:
+    """Write members as a compressed tar stream, followed by their integrity
+    records.
+
+    Args:
+        out: the binary stream to write to
+        members: iterable of Member, conf.yaml first
+        fmt: one of STREAM_FORMATS
+        level: the compression level, None for the default of the format
+
+    Returns:
+        tuple: the number of files written and their uncompressed size
+    """
+    records = {}
+    with _compressor(out, fmt, level) as writer, tarfile.open(
+        fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT
+    ) as tar:
+        with timings.member_spans() as section_span:
+            for member, live in imap(_hash_ahead, members):
+                section_span(member.arcname)
+                record = _add_member(tar, member, live)
+                if record:
+                    records[member.arcname] = record
+
+        data = json.dumps(
+            {
+                "version": INTEGRITY_VERSION,
+                "digest": profile_digest(records),
+                "members": records,
+            },
+            indent=1,
+        ).encode()
+        info = tarfile.TarInfo(INTEGRITY_NAME)
+        info.size = len(data)
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(data))
+    return len(records), sum(record["size"] for record in records.values())
+
+
+def write_stream_archive(path: str, members, fmt: str, level: int = None) -> tuple:
+    """Write a stream archive to ``path``, "-" being stdout (see write_stream())"""
+    return write_output(path, lambda out: write_stream(out, members, fmt, level))
+
+
+def read_stream(src):
+    """Yield the members of a stream archive, in order.
+
+    Args:
+        src: a buffered binary stream (with peek())
+
+    Yields:
+        tuple: the member name (ending with "/" for directories), its TarInfo
+        and its content as a stream (None for directories)
+    """
+    fmt = stream_format(src)
+    assert fmt, "Not a valid konsave file"
+    with _reading(), _decompressor(src, fmt) as raw, tarfile.open(
+        fileobj=raw, mode="r|"
+    ) as tar:
+        for info in tar:
+            if info.isdir():
+                yield f"{info.name.rstrip('/')}/", info, None
+            elif info.isfile():
+                yield info.name, info, tar.extractfile(info)
+
+
+def member_record(info: tarfile.TarInfo) -> dict:
+    """Return the integrity record of a member from its PAX header"""
+    digest = info.pax_headers.get(DIGEST_HEADER)
+    return {"sha256": digest, "size": info.size} if digest else None
+
+
+def _check_integrity(integrity: dict, records: dict):
+    """Check the integrity records at the end of a stream against the PAX
+    headers of its members"""
+    assert integrity, "Truncated archive: integrity records missing"
+    errors = [
+        name
+        for name in integrity["members"].keys() | records.keys()
+        if integrity["members"].get(name) != records.get(name)
+    ]
+    if errors or profile_digest(records) != integrity["digest"]:
+        raise ValueError(f"Corrupted archive, mismatching members: {errors}")
+
+
+def import_stream(src, config_dir: str):
+    """Read a stream archive for import, checking it against its integrity
+    records once read through.
+
+    conf.yaml is written to ``config_dir`` and parsed, the other members are
+    yielded with where they belong.
+
+    Yields:
+        tuple: the parsed config, the TarInfo of the member, its content as a
+        stream (None for directories), its integrity record (None if it has
+        none) and its target (see archive.import_target())
+    """
+    records = {}
+    integrity = None
+    konsave_config = None
+
+    with _reading():
+        for name, info, data in read_stream(src):
+            if name == INTEGRITY_NAME:
+                integrity = json.load(data)
+                continue
+            record = member_record(info)
+            if record:
+                records[name] = record
+            if name == "conf.yaml":
+                config_location = os.path.join(config_dir, "conf.yaml")
+                content = data.read()
+                if record and hashlib.sha256(content).hexdigest() != record["sha256"]:
+                    raise ValueError("Corrupted archive: SHA-256 mismatch of conf.yaml")
+                with open(config_location, "wb") as dst:
+                    dst.write(content)
+                konsave_config = parse(config_location)
+                continue
+            assert konsave_config, "Not a valid konsave file: conf.yaml must come first"
+
+            target = import_target(name, info.isdir(), konsave_config)
+            if target is not None:
+                yield konsave_config, info, data, record, target
+
+    _check_integrity(integrity, records)
+
+
+def extract_stream(src, profile_dir: str, staging: Staging) -> tuple:
+    """Import a stream archive as it is read.
+
+    conf.yaml is written to ``profile_dir``, files under "save/" go into the
+    object store and files under "export/" are staged for their location
+    (see archive.extract_archive()).
+
+    Returns:
+        tuple: the manifest of the saved sections and a Counter of the files
+        "written" (and their "bytes") and "skipped"
+    """
+    manifest = new_manifest()
+    sections = manifest["sections"]
+    results = Counter()
+
+    def place(info, data, record, target):
+        """Put a member where it belongs (see import_target()). Returns True
+        if written, False if up to date, None for directories"""
+        section_name, rel, dest = target
+        if dest is None:
+            section = sections.setdefault(section_name, new_section())
+            if data is None:
+                section["dirs"].append(rel)
+                return None
+            into, path = section["files"], rel
+        else:
+            if data is None:
+                staging.makedirs(dest)
+                return None
+            staging.makedirs(os.path.dirname(dest))
+            into, path = staging, dest
+
+        with timings.member_scope(info.name), timings.track():
+            written = extract_member(
+                lambda: nullcontext(data), info.mode & 0o777, record, into, path
+            )
+            if written:
+                timings.count(bytes=info.size, open=1, copy=1)
+        return written
+
+    with timings.member_spans() as section_span:
+        for konsave_config, info, data, record, target in import_stream(
+            src, profile_dir
+        ):
+            section_span(info.name)
+            if not sections:
+                for section in konsave_config["save"]:
+                    sections[section] = new_section()
+            section_name, rel, dest = target
+            if dest and rel in konsave_config["export"][section_name]["entries"]:
+                log.info(f'Importing "{rel}"...')
+            written = place(info, data, record, target)
+            if written:
+                results["written"] += 1
+                results["bytes"] += info.size
+            elif written is not None:
+                results["skipped"] += 1
+    return manifest, results
+
+
+def _hash_stream(src) -> str:
+    sha = hashlib.sha256()
+    for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def verify_stream(src) -> tuple:
+    """Read a stream archive and check every file against its digest.
+
+    Returns:
+        tuple: the integrity records (None if missing) and a list of errors
+    """
+    records = {}
+    integrity = None
+    errors = []
+    try:
+        with _reading():
+            for name, info, data in read_stream(src):
+                if data is None:
+                    continue
+                if name == INTEGRITY_NAME:
+                    integrity = json.load(data)
+                    continue
+                record = member_record(info)
+                with timings.member_scope(name), timings.track():
+                    digest = _hash_stream(data)
+                    timings.count(bytes=info.size)
+                if record is None:
+                    errors.append(f"{name}: no {DIGEST_HEADER} header")
+                elif digest != record["sha256"]:
+                    errors.append(f"{name}: SHA-256 mismatch")
+                records[name] = {"sha256": digest, "size": info.size}
+    except ValueError as ex:
+        errors.append(str(ex))
+
+    if integrity is None:
+        errors.append(f"{INTEGRITY_NAME}: missing, the archive is truncated")
+        return None, errors
+    try:
+        _check_integrity(integrity, records)
+    except ValueError as ex:
+        errors.append(str(ex))
+    return integrity, errors
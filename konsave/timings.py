@@ -0,0 +1,244 @@
+"""
+This module records where the time of a command goes, for --timings and
+--trace-file.
+
+Counts and times are kept per (section, entry) row. The row being recorded
+to is held in a context variable, which copier.parallel() and copier.imap()
+hand over to their threads, so per-file work is attributed to the section
+and entry that queued it. Until enable() is called, nothing is recorded and
+every function below is a no-op.
+
+Two kinds of time are recorded:
+    - wall/cpu: elapsed wall and process CPU time of a span(), only for rows
+      processed one at a time (the command, the sections of save/apply, the
+      entries of save). The sections of streamed commands (export, import)
+      get theirs from member_spans(), as their members come in order
+    - busy: wall time spent on the files of a row, summed over all threads.
+      This is the only time of the entries of streamed commands
+"""
+
+import sys
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+
+# Counters of a row, in report order
+COUNTERS = ("files", "bytes", "stored", "stat", "open", "copy", "busy")
+TRACE_VERSION = 1
+
+_enabled = False  # pylint: disable=invalid-name
+_lock = threading.Lock()
+_rows = {}
+_current = ContextVar("konsave_timings_row", default=("", ""))
+_null = nullcontext()
+
+
+def enable():
+    """Start recording"""
+    global _enabled  # pylint: disable=global-statement
+    _enabled = True
+
+
+def enabled() -> bool:
+    """Return True if recording"""
+    return _enabled
+
+
+def _new_row() -> dict:
+    return {**dict.fromkeys(COUNTERS, 0), "wall": None, "cpu": None}
+
+
+def _row(key: tuple) -> dict:
+    """Return the row of ``key``, creating it. Must hold _lock"""
+    row = _rows.get(key)
+    if row is None:
+        row = _rows[key] = _new_row()
+    return row
+
+
+def count(**counters):
+    """Add to the counters (see COUNTERS) of the current row"""
+    if not _enabled:
+        return
+    key = _current.get()
+    with _lock:
+        row = _row(key)
+        for name, value in counters.items():
+            row[name] += value
+
+
+def scope(section: str = None, entry: str = ""):
+    """Return a context manager recording to the row of a section and entry.
+
+    Args:
+        section: the section name, defaults to the current one
+        entry: the entry name, "" for the section itself
+    """
+    if not _enabled:
+        return _null
+    return _scope(section, entry)
+
+
+@contextmanager
+def _scope(section: str, entry: str):
+    if section is None:
+        section = _current.get()[0]
+    token = _current.set((section, entry))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def span(section: str = "", entry: str = ""):
+    """Like scope(), also recording the elapsed wall and CPU time of the block.
+
+    With no arguments, the span is the whole command.
+    """
+    if not _enabled:
+        return _null
+    return _span(section, entry)
+
+
+@contextmanager
+def _span(section: str, entry: str):
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        with _scope(section, entry):
+            yield
+    finally:
+        _add_time((section, entry), wall, cpu)
+
+
+def _add_time(key: tuple, wall: float, cpu: float):
+    """Add the time elapsed since ``wall`` and ``cpu`` to the row of ``key``"""
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    with _lock:
+        row = _row(key)
+        row["wall"] = (row["wall"] or 0) + wall
+        row["cpu"] = (row["cpu"] or 0) + cpu
+
+
+def track():
+    """Return a context manager counting one file and its busy time"""
+    if not _enabled:
+        return _null
+    return _track()
+
+
+@contextmanager
+def _track():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count(files=1, busy=time.perf_counter() - start)
+
+
+def member_key(arcname: str) -> tuple:
+    """Return the section ("save/<section>") and entry of an archive member
+    ("save/<section>/<entry>/..."), as timed here and planned by
+    konsave.plan"""
+    parts = arcname.split("/")
+    return "/".join(parts[:2]), parts[2] if len(parts) > 2 else ""
+
+
+def member_scope(arcname: str):
+    """Return scope() for an archive member ("save/<section>/<entry>/...")"""
+    if not _enabled:
+        return _null
+    return _scope(*member_key(arcname))
+
+
+def _ignore(_arcname: str):
+    pass
+
+
+def member_spans():
+    """Return a context manager yielding a function to call with the name of
+    every member of an archive, in the order they are written or read. Each
+    section ("save/<section>") gets the wall and CPU time from its first
+    member to the first member of the next section."""
+    if not _enabled:
+        return nullcontext(_ignore)
+    return _member_spans()
+
+
+@contextmanager
+def _member_spans():
+    # The current section and when it started
+    current = [None, 0, 0]
+
+    def close():
+        if current[0] is not None:
+            _add_time((current[0], ""), current[1], current[2])
+
+    def enter(arcname: str):
+        section = member_key(arcname)[0]
+        # The top directories ("save/", "export/") are not sections
+        if section == current[0] or section.endswith("/"):
+            return
+        close()
+        current[:] = section, time.perf_counter(), time.process_time()
+
+    try:
+        yield enter
+    finally:
+        close()
+
+
+def _with_ratio(row: dict) -> dict:
+    """Return a copy of a row with the compression ratio (stored/bytes)"""
+    ratio = row["stored"] / row["bytes"] if row["stored"] and row["bytes"] else None
+    return {**row, "ratio": ratio}
+
+
+def summary() -> dict:
+    """Return the recorded rows as the total, its sections and their entries"""
+    total = {**_rows.get(("", ""), _new_row())}
+    sections = {}
+    for (section, entry), row in _rows.items():
+        if not section:
+            continue
+        if section not in sections:
+            sections[section] = {"section": section, **_new_row(), "entries": []}
+        current = sections[section]
+        for name in COUNTERS:
+            current[name] += row[name]
+            total[name] += row[name]
+        if entry:
+            current["entries"].append({"entry": entry, **_with_ratio(row)})
+        else:
+            current["wall"], current["cpu"] = row["wall"], row["cpu"]
+
+    return {
+        "total": _with_ratio(total),
+        "sections": [_with_ratio(section) for section in sections.values()],
+    }
+
+
+def write_trace(command: str, path: str):
+    """Write the summary as a JSON trace.
+
+    Args:
+        command: the command that was run
+        path: the file to write
+    """
+    # pylint: disable=import-outside-toplevel
+    import json
+
+    # Not at the top, as every command imports this module
+    from konsave.copier import backend_usage
+
+    trace = {
+        "version": TRACE_VERSION,
+        "command": command,
+        "argv": sys.argv[1:],
+        "time": time.time(),
+        **summary(),
+        "copy_backends": backend_usage(),
+    }
+    with open(path, "w", encoding="utf-8") as dest:
+        json.dump(trace, dest, indent=1)
@@ -0,0 +1,301 @@
+"""
+This module keeps a profile in sync with the files it saves (konsave watch).
+
+The directories of the "save" sections are watched with inotify(7), one
+watch per directory rather than per file, so that memory does not grow with
+the number of files. Changed paths are collected until no event came for a
+while, so that a burst of writes (eg. plasma rewriting its appletsrc while
+widgets are moved) ends up as a single sync, and only these paths are
+stored again. When too many paths change at once, their entries are stored
+again instead (skipping unchanged files by stat, like save), which keeps
+the set of pending changes bounded too.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+from konsave.copier import existing_entries, section_patterns, walk
+from konsave.store import new_section, store_entry, store_file
+
+
+log = logging.getLogger("Konsave")
+
+# inotify(7) event masks
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_ONLYDIR
+)
+# struct inotify_event, followed by its name
+EVENT = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+# Longest wait for a burst of changes to end, in seconds
+MAX_DELAY = 30
+# Number of changed paths kept, beyond which whole entries are synced
+MAX_PENDING = 1000
+
+
+def _libc():
+    assert sys.platform.startswith("linux"), "konsave watch needs inotify (Linux)"
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def _error(path: str) -> OSError:
+    err = ctypes.get_errno()
+    if err == errno.ENOSPC:
+        return OSError(
+            err, "Too many directories to watch, raise fs.inotify.max_user_watches"
+        )
+    return OSError(err, os.strerror(err), path)
+
+
+class Inotify:
+    """A minimal binding of inotify(7)"""
+
+    def __init__(self):
+        self._libc = _libc()
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise _error("inotify_init1")
+        self._poll = select.poll()
+        self._poll.register(self.fd, select.POLLIN)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        os.close(self.fd)
+
+    def add(self, path: str) -> int:
+        """Watch the directory ``path`` and return its watch descriptor"""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise _error(path)
+        return wd
+
+    def read(self, timeout: float = None) -> list:
+        """Wait for events, up to ``timeout`` seconds (forever if None).
+
+        Returns:
+            list: the watch descriptor, mask and name of every event, none
+            if the timeout expired
+        """
+        if not self._poll.poll(None if timeout is None else timeout * 1000):
+            return []
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = os.fsdecode(data[pos : pos + length].rstrip(b"\0"))
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+
+class Watcher:
+    """Collects the paths changed in the "save" sections of a config.
+
+    Args:
+        konsave_config: the "save" part of the parsed config
+        inotify: the Inotify instance to watch with
+    """
+
+    def __init__(self, konsave_config: dict, inotify: Inotify):
+        self.config = konsave_config
+        self.inotify = inotify
+        # Watch descriptor -> [(section, directory relative to its location)]
+        self.dirs = {}
+        self.pending = set()
+        self.coarse = False
+        for name, section in konsave_config.items():
+            for entry in section["entries"] or ():
+                # The parent catches an entry being created, replaced or removed
+                parent = os.path.dirname(entry)
+                self._watch(name, os.path.join(section["location"], parent), parent)
+            for entry, source in existing_entries(section):
+                if os.path.isdir(source):
+                    self._watch_tree(name, source, entry)
+
+    def watched(self) -> int:
+        """Return the number of directories watched"""
+        return len(self.dirs)
+
+    def _watch(self, section: str, path: str, rel: str):
+        try:
+            wd = self.inotify.add(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        places = self.dirs.setdefault(wd, [])
+        if (section, rel) not in places:
+            places.append((section, rel))
+
+    def _watch_tree(self, section: str, path: str, rel: str):
+        self._watch(section, path, rel)
+        for item_rel, item in walk(path, rel, section_patterns(self.config[section])):
+            if item.is_dir():
+                self._watch(section, item.path, item_rel)
+
+    def _entry(self, section: str, rel: str) -> str:
+        """Return the entry ``rel`` belongs to, None if not tracked"""
+        for entry in self.config[section]["entries"] or ():
+            if rel == entry or rel.startswith(f"{entry}/"):
+                return entry
+        return None
+
+    def _add(self, section: str, rel: str):
+        if self.coarse:
+            rel = self._entry(section, rel)
+        self.pending.add((section, rel))
+        if len(self.pending) > MAX_PENDING:
+            log.debug("Too many changes, syncing whole entries")
+            self.coarse = True
+            self.pending = {
+                (name, self._entry(name, rel)) for name, rel in self.pending
+            }
+
+    def _handle(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            log.debug("Events lost, syncing every entry")
+            self.coarse = True
+            for section, conf in self.config.items():
+                for entry in conf["entries"] or ():
+                    self._add(section, entry)
+            return
+        if mask & IN_IGNORED:
+            # Removed directory
+            self.dirs.pop(wd, None)
+            return
+
+        is_dir = bool(mask & IN_ISDIR)
+        for section, directory in self.dirs.get(wd, ()):
+            rel = f"{directory}/{name}" if directory else name
+            conf = self.config[section]
+            if self._entry(section, rel) is None:
+                continue
+            if not section_patterns(conf).keep_path(rel, is_dir):
+                continue
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(section, os.path.join(conf["location"], rel), rel)
+            self._add(section, rel)
+
+    def changes(self, delay: float):
+        """Yield the changed paths, once no event came for ``delay`` seconds
+        (or MAX_DELAY seconds after the first one). Blocks while idle.
+
+        Yields:
+            set: the changed paths, as (section, path relative to its
+            location)
+        """
+        while True:
+            for event in self.inotify.read():
+                self._handle(*event)
+            if not self.pending:
+                continue
+            deadline = time.monotonic() + MAX_DELAY
+            while True:
+                timeout = min(delay, deadline - time.monotonic())
+                events = self.inotify.read(timeout) if timeout > 0 else []
+                if not events:
+                    break
+                for event in events:
+                    self._handle(*event)
+            changed, self.pending, self.coarse = self.pending, set(), False
+            yield changed
+
+
+def _replace_tree(section: dict, rel: str, path: str, patterns) -> tuple:
+    """Store again the directory (or what used to be one) ``rel`` of a
+    manifest section.
+
+    Returns:
+        tuple: the previous and new records of the files under ``rel``
+    """
+    old = {
+        item: record
+        for item, record in section["files"].items()
+        if item == rel or item.startswith(f"{rel}/")
+    }
+    for item in old:
+        del section["files"][item]
+    section["dirs"] = [
+        item
+        for item in section["dirs"]
+        if item != rel and not item.startswith(f"{rel}/")
+    ]
+    stored = new_section()
+    if os.path.exists(path):
+        store_entry(path, rel, stored, old, patterns)
+    section["files"].update(stored["files"])
+    section["dirs"].extend(stored["dirs"])
+    return old, stored["files"]
+
+
+def sync(sections: dict, konsave_config: dict, changed) -> int:
+    """Store again the changed paths of a profile.
+
+    Args:
+        sections: the manifest sections of the profile, updated in place
+        konsave_config: the "save" part of the parsed config
+        changed: the changed paths, as (section, path relative to its
+            location)
+
+    Returns:
+        int: the number of files stored (new or changed) or removed
+    """
+    count = 0
+    dirs = {}
+    # Parents first, so that their children are found stored already
+    for name, rel in sorted(changed):
+        section = sections.setdefault(name, new_section())
+        if name not in dirs:
+            dirs[name] = set(section["dirs"])
+        conf = konsave_config[name]
+        path = os.path.join(conf["location"], rel)
+
+        if rel in dirs[name] or os.path.isdir(path):
+            old, new = _replace_tree(section, rel, path, section_patterns(conf))
+            dirs[name] = set(section["dirs"])
+        else:
+            old = {rel: section["files"].pop(rel)} if rel in section["files"] else {}
+            try:
+                new = {rel: store_file(path, old.get(rel))}
+            except FileNotFoundError:
+                new = {}
+            section["files"].update(new)
+
+        count += len(old.keys() - new.keys())
+        count += sum(
+            1
+            for item, record in new.items()
+            if old.get(item, {}).get("digest") != record["digest"]
+        )
+    return count
@@ -46,12 +46,12 @@ setup(
     long_description=_read_desc(),
     long_description_content_type="text/markdown",
     url="https://www.github.com/urban/konsave/",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     package_data={"config": ["conf.yaml"]},
     include_package_data=True,
-    python_requires=">=3.6",
+    python_requires=">=3.9",
     install_requires=_REQUIREMENTS,
-    extras_require={"dev": _REQUIREMENTS_DEV},
+    extras_require={"dev": _REQUIREMENTS_DEV, "zstd": ["zstandard"]},
     classifiers=[
         "License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)",
         "Operating System :: POSIX",
@@ -0,0 +1,116 @@
+"""
+Tests of konsave.
+
+konsave derives all its paths from $HOME when imported, so HOME points to a
+temporary directory before any konsave module is imported, and is emptied
+between tests (see KonsaveTestCase).
+"""
+
+import io
+import os
+import sys
+import atexit
+import shutil
+import logging
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+HOME = tempfile.mkdtemp(prefix="konsave-tests-")
+os.environ["HOME"] = HOME
+atexit.register(shutil.rmtree, HOME, True)
+# Keep the output of the commands run out of the test report
+logging.disable(logging.CRITICAL)
+
+# pylint: disable=wrong-import-position
+from konsave import config
+from konsave.__main__ import main
+
+
+CONFIG = """\
+---
+save:
+    app:
+        location: "$HOME/live"
+        entries:
+            - app.conf
+            - appdir
+export:
+    theme:
+        location: "$HOME/themes"
+        entries:
+            - mytheme
+"""
+
+
+def konsave(*argv):
+    """Run a konsave command, failing on the errors it reports to the user"""
+    out = io.StringIO()
+    with mock.patch.object(sys, "argv", ["konsave", *argv]), redirect_stdout(out):
+        failed = main() == -1
+    assert not failed, f"konsave {' '.join(argv)} failed: {out.getvalue().strip()}"
+    sys.stdout.write(out.getvalue())
+
+
+def output(*argv) -> str:
+    """Return what a konsave command prints"""
+    out = io.StringIO()
+    with redirect_stdout(out):
+        konsave(*argv)
+    return out.getvalue()
+
+
+def write(path: str, content: str, mode: int = 0o644):
+    """Write a file, with its missing parent directories"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as dst:
+        dst.write(content)
+    os.chmod(path, mode)
+
+
+def read(path: str) -> str:
+    """Return the content of a text file"""
+    with open(path, "r", encoding="utf-8") as src:
+        return src.read()
+
+
+def snapshot_tree(root: str) -> dict:
+    """Return the relative paths under ``root`` with their mode, and their
+    content or link target"""
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            st = os.lstat(path)
+            if os.path.islink(path):
+                tree[rel] = ("link", os.readlink(path))
+            elif name in dirnames:
+                tree[rel] = ("dir", st.st_mode)
+            else:
+                tree[rel] = ("file", st.st_mode, read(path))
+    return tree
+
+
+class KonsaveTestCase(unittest.TestCase):
+    """A test with an empty home, holding a konsave config saving
+    $HOME/live/app.conf and $HOME/live/appdir, and exporting
+    $HOME/themes/mytheme"""
+
+    def setUp(self):
+        for name in os.listdir(HOME):
+            path = os.path.join(HOME, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        config._listdir.cache_clear()  # pylint: disable=protected-access
+        self.home = HOME
+        self.live = os.path.join(HOME, "live")
+        self.themes = os.path.join(HOME, "themes")
+        write(os.path.join(self.live, "app.conf"), "key=1\n")
+        write(os.path.join(self.live, "appdir", "a.txt"), "a\n")
+        write(os.path.join(self.live, "appdir", "sub", "b.txt"), "b\n", 0o600)
+        write(os.path.join(self.themes, "mytheme", "theme.txt"), "theme\n")
+        write(config.CONFIG_FILE, CONFIG)
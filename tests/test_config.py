@@ -0,0 +1,52 @@
+"""Tests of the config cache"""
+
+import os
+import json
+import unittest
+from unittest import mock
+
+from konsave import config
+from konsave.consts import CONFIG_CACHE_FILE, KONSAVE_DIR, PROFILES_DIR
+
+from tests import KonsaveTestCase, konsave, read, write
+
+
+class ConfigCacheTest(KonsaveTestCase):
+    """YAML is only parsed when a cached config file changes"""
+
+    def load(self, path: str) -> tuple:
+        """Load a config, returning it and whether YAML was parsed"""
+        with mock.patch.object(
+            config,
+            "_load_yaml",
+            wraps=config._load_yaml,  # pylint: disable=protected-access
+        ) as parsed:
+            return config.load(path), parsed.called
+
+    def test_cached_until_changed(self):
+        first, parsed = self.load(config.CONFIG_FILE)
+        self.assertTrue(parsed)
+        self.assertEqual(self.load(config.CONFIG_FILE), (first, False))
+
+        write(config.CONFIG_FILE, read(config.CONFIG_FILE).replace("app.conf", "b"))
+        changed, parsed = self.load(config.CONFIG_FILE)
+        self.assertTrue(parsed)
+        self.assertEqual(changed["save"]["app"]["entries"], ["b", "appdir"])
+
+    def test_only_user_and_profile_configs(self):
+        konsave("save", "first")
+        profile = os.path.join(PROFILES_DIR, "first", "conf.yaml")
+        other = os.path.join(KONSAVE_DIR, "other", "conf.yaml")
+        write(other, read(config.CONFIG_FILE))
+        for path in (config.CONFIG_FILE, profile, other):
+            config.load(path)
+        self.assertEqual(self.load(profile)[1], False)
+        self.assertEqual(self.load(other)[1], True)
+        with open(CONFIG_CACHE_FILE, "r", encoding="utf-8") as src:
+            self.assertEqual(
+                sorted(json.load(src)), sorted([config.CONFIG_FILE, profile])
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
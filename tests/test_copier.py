@@ -0,0 +1,43 @@
+"""Tests of the include/exclude patterns of config sections"""
+
+import unittest
+from fnmatch import fnmatchcase
+
+from konsave.copier import Patterns
+
+
+class PatternsTest(unittest.TestCase):
+    """Names are matched like fnmatch, paths with ** across directories"""
+
+    NAMES = ["a.txt", "^.txt", "!.txt", "b.log", "[.txt", "x"]
+
+    def assert_like_fnmatch(self, pattern: str):
+        patterns = Patterns(exclude=(pattern,))
+        for name in self.NAMES:
+            self.assertEqual(
+                not patterns.keep(name), fnmatchcase(name, pattern), (pattern, name)
+            )
+
+    def test_like_fnmatch(self):
+        for pattern in ("*.txt", "?.log", "[ab].*", "[!a].txt", "[^a].txt", "[[].txt"):
+            self.assert_like_fnmatch(pattern)
+
+    def test_paths(self):
+        patterns = Patterns(exclude=("cache", "sub/*.log", "**/tmp/*"))
+        self.assertFalse(patterns.keep("dir/cache", True))
+        self.assertFalse(patterns.keep("sub/a.log"))
+        self.assertTrue(patterns.keep("other/sub/a.log"))
+        self.assertFalse(patterns.keep("a/b/tmp/c"))
+        self.assertFalse(patterns.keep_path("cache/inner/file"))
+        self.assertTrue(patterns.keep("dir/[x]"))
+
+    def test_include(self):
+        patterns = Patterns(include=("*.conf",))
+        self.assertTrue(patterns.keep("a/b.conf"))
+        self.assertFalse(patterns.keep("a/b.txt"))
+        # Directories are still walked
+        self.assertTrue(patterns.keep("a", True))
+
+
+if __name__ == "__main__":
+    unittest.main()
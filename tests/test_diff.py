@@ -0,0 +1,41 @@
+"""Tests of konsave diff"""
+
+import os
+import unittest
+
+from tests import KonsaveTestCase, konsave, output, write
+
+
+class DiffTest(KonsaveTestCase):
+    """konsave diff against the live files, another profile or a version"""
+
+    def setUp(self):
+        super().setUp()
+        konsave("save", "first")
+        write(os.path.join(self.live, "app.conf"), "key=2\n")
+        write(os.path.join(self.live, "appdir", "new.txt"), "new\n")
+        os.remove(os.path.join(self.live, "appdir", "a.txt"))
+
+    def test_live(self):
+        out = output("diff", "first")
+        self.assertIn("1 added, 1 removed, 1 modified", out)
+        self.assertNotIn("+key=2", out)
+        self.assertIn("-key=1\n+key=2", output("diff", "-u", "first"))
+
+    def test_profiles(self):
+        konsave("save", "second")
+        self.assertIn(
+            "1 added, 1 removed, 1 modified", output("diff", "first", "second")
+        )
+        self.assertEqual(output("diff", "second"), "")
+
+    def test_versions(self):
+        konsave("save", "first", "--force")
+        self.assertEqual(output("diff", "first"), "")
+        self.assertIn(
+            "1 added, 1 removed, 1 modified", output("diff", "first@1", "first")
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+"""Tests of export and import"""
+
+import os
+import json
+import shutil
+import unittest
+from importlib.util import find_spec
+from unittest import mock
+
+from konsave import exchange, stream
+from konsave.archive import Staging
+from konsave.consts import OBJECTS_DIR, PROFILES_DIR
+from konsave.store import load_manifest, object_path
+
+from tests import KonsaveTestCase, konsave, output, read, snapshot_tree, write
+
+
+def contents(name: str) -> dict:
+    """Return the directories and the digest and mode of the files of every
+    section of a profile (leaving out the stat data of the saved files)"""
+    sections = load_manifest(os.path.join(PROFILES_DIR, name))["sections"]
+    return {
+        section_name: (
+            sorted(section["dirs"]),
+            {
+                path: (record["digest"], record["mode"])
+                for path, record in section["files"].items()
+            },
+        )
+        for section_name, section in sections.items()
+    }
+
+
+class RoundTripTest(KonsaveTestCase):
+    """Export a profile, import it back and apply it"""
+
+    def setUp(self):
+        super().setUp()
+        konsave("save", "first")
+
+    def export(self, name: str, *argv) -> str:
+        """Export the profile "first" as ``name``.knsv, returning its path"""
+        konsave("export", "first", "-o", os.path.join(self.home, name), *argv)
+        return os.path.join(self.home, f"{name}.knsv")
+
+    def assert_round_trip(self, *paths):
+        """Import ``paths`` as the profile "copy" and check that applying it
+        gives back the files and export files of "first" """
+        saved, themes = snapshot_tree(self.live), snapshot_tree(self.themes)
+        shutil.rmtree(self.themes)
+        konsave("import", *paths, "-n", "copy")
+        self.assertEqual(snapshot_tree(self.themes), themes)
+        self.assertEqual(contents("copy"), contents("first"))
+
+        shutil.rmtree(self.live)
+        konsave("apply", "copy")
+        self.assertEqual(snapshot_tree(self.live), saved)
+
+    def test_zip(self):
+        self.assert_round_trip(self.export("first"))
+
+    def test_delta_chain(self):
+        base = self.export("base")
+        write(os.path.join(self.live, "app.conf"), "key=2\n")
+        write(os.path.join(self.live, "appdir", "new.txt"), "new\n")
+        os.remove(os.path.join(self.live, "appdir", "a.txt"))
+        konsave("save", "first", "--force")
+        delta = self.export("delta", "--base", base)
+
+        listing = json.loads(output("ls-archive", delta, "--json"))
+        files = {
+            entry["path"] for entry in listing["entries"] if entry["type"] == "file"
+        }
+        # Only what changed since the base
+        self.assertIn("save/app/appdir/new.txt", files)
+        self.assertIn("save/app/app.conf", files)
+        self.assertNotIn("save/app/appdir/sub/b.txt", files)
+        self.assertNotIn("export/theme/mytheme/theme.txt", files)
+
+        self.assert_round_trip(base, delta)
+
+    def test_tar_xz(self):
+        self.assert_round_trip(self.export("first", "--format", "tar.xz"))
+
+    @unittest.skipUnless(find_spec("zstandard"), "needs zstandard")
+    def test_tar_zst(self):
+        self.assert_round_trip(self.export("first", "--format", "tar.zst"))
+
+    def test_files_in_place_are_skipped(self):
+        path = self.export("first")
+        theme = os.path.join(self.themes, "mytheme", "theme.txt")
+        before = os.stat(theme)
+        konsave("import", path, "-n", "copy")
+        after = os.stat(theme)
+        self.assertEqual(after.st_ino, before.st_ino)
+        self.assertEqual(after.st_mtime_ns, before.st_mtime_ns)
+
+    def test_verify(self):
+        path = self.export("first")
+        self.assertIn(": OK", output("verify", path))
+        self.assertIn(
+            ": OK", output("verify", self.export("stream", "--format", "tar.xz"))
+        )
+
+        # An object damaged in the store is exported as is
+        record = load_manifest(os.path.join(PROFILES_DIR, "first"))["sections"]["app"][
+            "files"
+        ]["app.conf"]
+        os.chmod(object_path(record["digest"]), 0o644)
+        write(object_path(record["digest"]), "key=0\n")
+        damaged = self.export("damaged")
+        with self.assertRaises(AssertionError):
+            output("verify", damaged)
+        with self.assertRaises(AssertionError):
+            konsave("import", damaged, "-n", "copy", "--verify")
+        self.assertFalse(os.path.exists(os.path.join(PROFILES_DIR, "copy")))
+
+    def test_ls_archive(self):
+        listing = json.loads(output("ls-archive", self.export("first"), "--json"))
+        self.assertEqual(listing["sections"]["save/app"]["files"], 3)
+        self.assertEqual(listing["sections"]["export/theme"]["files"], 1)
+        entries = {entry["path"]: entry for entry in listing["entries"]}
+        self.assertEqual(entries["save/app/appdir/"]["files"], 2)
+        self.assertEqual(entries["save/app/app.conf"]["size"], len("key=1\n"))
+
+
+class StreamExportTest(KonsaveTestCase):
+    """konsave export --format tar.xz"""
+
+    def test_file_changed_while_exporting(self):
+        konsave("save", "first")
+        theme = os.path.join(self.themes, "mytheme", "theme.txt")
+        hash_ahead = stream._hash_ahead  # pylint: disable=protected-access
+
+        def change_after_hashing(member):
+            hashed = hash_ahead(member)
+            if member.path == theme:
+                # Same size: only the digest tells
+                write(theme, "THEME\n")
+            return hashed
+
+        archive = os.path.join(self.home, "first")
+        with mock.patch.object(stream, "_hash_ahead", change_after_hashing):
+            with self.assertRaises(AssertionError):
+                konsave("export", "first", "-o", archive, "--format", "tar.xz")
+        self.assertEqual(
+            [name for name in os.listdir(self.home) if "first" in name], []
+        )
+
+
+class FailedImportTest(KonsaveTestCase):
+    """An import that fails leaves the files it would replace as they were"""
+
+    def setUp(self):
+        super().setUp()
+        konsave("save", "first")
+        konsave("export", "first", "-o", os.path.join(self.home, "first"))
+        konsave("remove", "first")
+        self.archive = os.path.join(self.home, "first.knsv")
+        self.theme = os.path.join(self.themes, "mytheme", "theme.txt")
+        write(self.theme, "local\n")
+
+    def assert_nothing_imported(self):
+        """Check that no profile, object or staged file was left behind"""
+        self.assertFalse(os.path.exists(os.path.join(PROFILES_DIR, "first")))
+        self.assertEqual(os.listdir(OBJECTS_DIR), [])
+        self.assertEqual(os.listdir(os.path.dirname(self.theme)), ["theme.txt"])
+
+    def test_profile_not_placed(self):
+        replace = os.replace
+
+        def fail(src, dst):
+            if dst == os.path.join(PROFILES_DIR, "first"):
+                raise OSError("cannot place profile")
+            replace(src, dst)
+
+        with mock.patch.object(exchange.os, "replace", fail):
+            with self.assertRaises(OSError):
+                konsave("import", self.archive)
+        self.assertEqual(read(self.theme), "local\n")
+        self.assertNotIn("first", os.listdir(PROFILES_DIR))
+        self.assert_nothing_imported()
+
+    def test_commit_fails(self):
+        commit = Staging.commit
+
+        def fail(staging):
+            # Committed last, once the theme was replaced
+            staging.files.insert(0, (staging.files[0][0] + ".missing", self.theme))
+            commit(staging)
+
+        with mock.patch.object(Staging, "commit", fail):
+            with self.assertRaises(OSError):
+                konsave("import", self.archive)
+        # Cannot be brought back
+        self.assertEqual(read(self.theme), "theme\n")
+        self.assert_nothing_imported()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+"""Tests of konsave list"""
+
+import os
+import shutil
+import socket
+import unittest
+
+from konsave.consts import INDEX_FILE, PROFILES_DIR
+
+from tests import KonsaveTestCase, konsave, output, write
+
+
+class ListTest(KonsaveTestCase):
+    """konsave list, its sorting and filtering"""
+
+    def setUp(self):
+        super().setUp()
+        konsave("save", "big")
+        write(os.path.join(self.live, "appdir", "big.txt"), "x" * 4096)
+        konsave("save", "bigger")
+        shutil.rmtree(self.live)
+        konsave("save", "empty")
+
+    def listed(self, *argv) -> list:
+        """Return the names listed by konsave list, in order"""
+        # Title, headers and separator first
+        return [line.split()[1] for line in output("list", *argv).splitlines()[3:]]
+
+    def test_sort(self):
+        self.assertEqual(self.listed(), ["big", "bigger", "empty"])
+        self.assertEqual(self.listed("--sort", "size"), ["empty", "big", "bigger"])
+        self.assertEqual(self.listed("--sort", "files"), ["empty", "big", "bigger"])
+        self.assertEqual(
+            self.listed("--sort", "size", "--reverse"), ["bigger", "big", "empty"]
+        )
+        self.assertEqual(self.listed("--sort", "saved"), ["big", "bigger", "empty"])
+
+    def test_filter(self):
+        self.assertEqual(self.listed("--filter", "big*"), ["big", "bigger"])
+        self.assertEqual(self.listed("-f", "*y"), ["empty"])
+        with self.assertRaises(AssertionError):
+            konsave("list", "--filter", "none")
+
+    def test_host(self):
+        konsave("export", "big", "-o", os.path.join(self.home, "big"))
+        konsave("import", os.path.join(self.home, "big.knsv"), "-n", "imported")
+        self.assertEqual(
+            self.listed("--host", socket.gethostname()), ["big", "bigger", "empty"]
+        )
+        # Imported profiles have no host
+        self.assertEqual(self.listed("--sort", "host")[0], "imported")
+
+    def test_index_rebuilt(self):
+        os.remove(INDEX_FILE)
+        self.assertEqual(self.listed("--sort", "size"), ["empty", "big", "bigger"])
+        shutil.rmtree(os.path.join(PROFILES_DIR, "big"))
+        self.assertEqual(self.listed(), ["bigger", "empty"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+"""Tests of writing files from the object store (store.restore_file())"""
+
+import os
+import stat
+import unittest
+
+from konsave.store import (
+    new_section,
+    restore_file,
+    restore_homes,
+    store_entry,
+    store_file,
+)
+
+from tests import KonsaveTestCase, konsave, read, write
+
+
+class RestoreFileTest(KonsaveTestCase):
+    """restore_file() only writes files that differ, through a rename"""
+
+    def setUp(self):
+        super().setUp()
+        self.src = os.path.join(self.live, "app.conf")
+        os.chmod(self.src, 0o640)
+        self.record = store_file(self.src)
+        self.dest = os.path.join(self.home, "dest.conf")
+
+    def test_added(self):
+        self.assertEqual(restore_file(self.record, self.dest), "added")
+        st = os.stat(self.dest)
+        self.assertEqual(read(self.dest), "key=1\n")
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o640)
+        # So that the next apply skips it without hashing it
+        self.assertEqual(st.st_mtime_ns, self.record["mtime_ns"])
+        self.assertEqual(
+            [name for name in os.listdir(self.home) if name.startswith(".konsave")],
+            [],
+        )
+
+    def test_identical_is_skipped(self):
+        restore_file(self.record, self.dest)
+        before = os.stat(self.dest)
+        self.assertEqual(restore_file(self.record, self.dest), "skipped")
+        after = os.stat(self.dest)
+        self.assertEqual(after.st_ino, before.st_ino)
+        self.assertEqual(after.st_mtime_ns, before.st_mtime_ns)
+
+    def test_identical_with_other_mtime_is_skipped(self):
+        write(self.dest, "key=1\n", 0o640)
+        before = os.stat(self.dest)
+        self.assertEqual(restore_file(self.record, self.dest), "skipped")
+        after = os.stat(self.dest)
+        self.assertEqual(after.st_ino, before.st_ino)
+        self.assertEqual(after.st_mtime_ns, before.st_mtime_ns)
+
+    def test_changed_mode_is_fixed_in_place(self):
+        write(self.dest, "key=1\n", 0o600)
+        before = os.stat(self.dest)
+        self.assertEqual(restore_file(self.record, self.dest), "skipped")
+        after = os.stat(self.dest)
+        self.assertEqual(stat.S_IMODE(after.st_mode), 0o640)
+        self.assertEqual(after.st_ino, before.st_ino)
+        self.assertEqual(after.st_mtime_ns, before.st_mtime_ns)
+
+    def test_changed_content_is_replaced(self):
+        write(self.dest, "key=2\n", 0o600)
+        other = os.path.join(self.home, "other.conf")
+        os.link(self.dest, other)
+        before = os.stat(self.dest)
+
+        self.assertEqual(restore_file(self.record, self.dest), "changed")
+        after = os.stat(self.dest)
+        self.assertEqual(read(self.dest), "key=1\n")
+        self.assertEqual(stat.S_IMODE(after.st_mode), 0o640)
+        self.assertNotEqual(after.st_ino, before.st_ino)
+        # Renamed over, not written through: the old inode is untouched
+        self.assertEqual(read(other), "key=2\n")
+        self.assertEqual(stat.S_IMODE(os.stat(other).st_mode), 0o600)
+
+    def test_symlink_is_replaced(self):
+        target = os.path.join(self.home, "target.conf")
+        write(target, "key=2\n")
+        os.symlink(target, self.dest)
+
+        self.assertEqual(restore_file(self.record, self.dest), "changed")
+        self.assertFalse(os.path.islink(self.dest))
+        self.assertEqual(read(self.dest), "key=1\n")
+        self.assertEqual(read(target), "key=2\n")
+
+    @unittest.skipUnless(os.geteuid() == 0, "needs root to chown")
+    def test_owner(self):
+        write(self.dest, "key=2\n")
+        self.assertEqual(
+            restore_file(self.record, self.dest, owner=(1234, 4321)), "changed"
+        )
+        st = os.stat(self.dest)
+        self.assertEqual((st.st_uid, st.st_gid), (1234, 4321))
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o640)
+
+
+class ApplyOntoExistingTreeTest(KonsaveTestCase):
+    """konsave apply over the files it saved, some of them modified"""
+
+    def test_only_differing_files_are_written(self):
+        konsave("save", "first")
+        conf = os.path.join(self.live, "app.conf")
+        a_txt = os.path.join(self.live, "appdir", "a.txt")
+        b_txt = os.path.join(self.live, "appdir", "sub", "b.txt")
+        os.chmod(a_txt, 0o600)
+        write(b_txt, "changed\n", 0o600)
+        before = {path: os.stat(path) for path in (conf, a_txt, b_txt)}
+
+        konsave("apply", "first")
+        after = {path: os.stat(path) for path in (conf, a_txt, b_txt)}
+        # Identical: left alone
+        self.assertEqual(after[conf].st_ino, before[conf].st_ino)
+        self.assertEqual(after[conf].st_mtime_ns, before[conf].st_mtime_ns)
+        # Mode changed: fixed in place
+        self.assertEqual(stat.S_IMODE(after[a_txt].st_mode), 0o644)
+        self.assertEqual(after[a_txt].st_ino, before[a_txt].st_ino)
+        self.assertEqual(after[a_txt].st_mtime_ns, before[a_txt].st_mtime_ns)
+        # Content changed: replaced, with its saved mode
+        self.assertNotEqual(after[b_txt].st_ino, before[b_txt].st_ino)
+        self.assertEqual(read(b_txt), "b\n")
+        self.assertEqual(stat.S_IMODE(after[b_txt].st_mode), 0o600)
+
+
+@unittest.skipUnless(os.geteuid() == 0, "needs root to chown")
+class RestoreHomesTest(KonsaveTestCase):
+    """restore_homes() gives the files and directories it creates under a
+    home to the owner of that home (konsave apply --homes)"""
+
+    def test_owner_of_home(self):
+        section = new_section()
+        store_entry(os.path.join(self.live, "appdir"), "appdir", section)
+        user_home = os.path.join(self.home, "user")
+        os.makedirs(os.path.join(user_home, ".config"))
+        os.chown(user_home, 1234, 4321)
+        dest = os.path.join(user_home, ".config", "app")
+
+        results, errors = restore_homes(section, {user_home: dest})
+        self.assertEqual(errors, {})
+        self.assertEqual(results[user_home]["added"], 2)
+        for path in ("", "appdir", "appdir/sub", "appdir/a.txt", "appdir/sub/b.txt"):
+            st = os.stat(os.path.join(dest, path))
+            self.assertEqual((st.st_uid, st.st_gid), (1234, 4321), path)
+        # Existing directories keep their owner
+        self.assertEqual(os.stat(os.path.join(user_home, ".config")).st_uid, 0)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(os.path.join(dest, "appdir/sub/b.txt")).st_mode),
+            0o600,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
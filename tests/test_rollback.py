@@ -0,0 +1,164 @@
+"""Tests of undoing the last apply (konsave rollback)"""
+
+import os
+import shutil
+import unittest
+from unittest import mock
+
+from konsave.consts import ROLLBACK_DIR
+from konsave.rollback import JOURNAL_NAME, Journal, last_apply, rollback
+
+from tests import KonsaveTestCase, konsave, read, snapshot_tree, write
+
+
+class RollbackTest(KonsaveTestCase):
+    """konsave apply, then konsave rollback"""
+
+    def setUp(self):
+        super().setUp()
+        konsave("save", "first")
+        # Diverge from the profile in every way apply undoes
+        write(os.path.join(self.live, "app.conf"), "key=2\n", 0o600)
+        os.chmod(os.path.join(self.live, "appdir", "a.txt"), 0o600)
+        shutil.rmtree(os.path.join(self.live, "appdir", "sub"))
+        os.symlink("app.conf", os.path.join(self.live, "link.conf"))
+        self.before = snapshot_tree(self.live)
+
+    def test_rollback(self):
+        konsave("apply", "first")
+        self.assertNotEqual(snapshot_tree(self.live), self.before)
+        self.assertEqual(last_apply()["profile"], "first")
+
+        konsave("rollback")
+        self.assertEqual(snapshot_tree(self.live), self.before)
+        self.assertFalse(os.path.exists(ROLLBACK_DIR))
+
+    def test_rollback_of_removed_tree(self):
+        shutil.rmtree(self.live)
+        konsave("apply", "first")
+        konsave("rollback")
+        self.assertFalse(os.path.exists(self.live))
+
+    def test_directories_removed_children_first(self):
+        appdir = os.path.join(self.live, "appdir")
+        shutil.rmtree(appdir)
+        konsave("apply", "first")
+
+        with mock.patch("os.rmdir", wraps=os.rmdir) as rmdir:
+            rollback()
+        removed = [call.args[0] for call in rmdir.call_args_list]
+        self.assertEqual(
+            [path for path in removed if path.startswith(self.live)],
+            [os.path.join(appdir, "sub"), appdir],
+        )
+        self.assertFalse(os.path.exists(appdir))
+
+    def test_directory_with_new_files_is_kept(self):
+        konsave("apply", "first")
+        write(os.path.join(self.live, "appdir", "sub", "new.txt"), "new\n")
+        rollback()
+        self.assertEqual(
+            os.listdir(os.path.join(self.live, "appdir", "sub")), ["new.txt"]
+        )
+
+    def test_truncated_journal(self):
+        konsave("apply", "first")
+        # A crash while appending a change, before making it
+        change = '{"path": "%s", "backup": null}\n' % self.live
+        with open(
+            os.path.join(ROLLBACK_DIR, JOURNAL_NAME), "a", encoding="utf-8"
+        ) as dst:
+            dst.write(change[: len(change) // 2])
+
+        konsave("rollback")
+        self.assertEqual(snapshot_tree(self.live), self.before)
+
+    def test_truncated_first_change(self):
+        journal = Journal("first")
+        journal.backup(os.path.join(self.live, "new.conf"))
+        journal.close()
+        path = os.path.join(ROLLBACK_DIR, JOURNAL_NAME)
+        with open(path, encoding="utf-8") as src:
+            header, change = src.readlines()
+        with open(path, "w", encoding="utf-8") as dst:
+            dst.write(header + change[:10])
+
+        self.assertEqual(rollback(), {"restored": 0, "removed": 0})
+        self.assertEqual(snapshot_tree(self.live), self.before)
+        self.assertFalse(os.path.exists(ROLLBACK_DIR))
+
+    def test_noop_apply_keeps_rollback_point(self):
+        konsave("apply", "first")
+        applied = last_apply()
+        konsave("apply", "first")
+        self.assertEqual(last_apply(), applied)
+
+        konsave("rollback")
+        self.assertEqual(snapshot_tree(self.live), self.before)
+
+
+class JournalTest(KonsaveTestCase):
+    """The backups of Journal: hard links, else copies (and symlinks)"""
+
+    def setUp(self):
+        super().setUp()
+        self.conf = os.path.join(self.live, "app.conf")
+        os.chmod(self.conf, 0o600)
+        self.link = os.path.join(self.live, "link.conf")
+        os.symlink("app.conf", self.link)
+        self.before = snapshot_tree(self.live)
+
+    def replace(self, journal: Journal, path: str, content: str):
+        """Replace a file like apply does: backup, then rename over it"""
+        journal.backup(path)
+        tmp = os.path.join(self.live, ".tmp")
+        write(tmp, content)
+        os.replace(tmp, path)
+
+    def test_backups_are_links(self):
+        journal = Journal("first")
+        journal.backup(self.conf)
+        backup = os.path.join(journal.files_dir, "1")
+        self.assertTrue(os.path.samefile(backup, self.conf))
+        write(self.conf + ".tmp", "key=2\n")
+        os.replace(self.conf + ".tmp", self.conf)
+        journal.close()
+        self.assertEqual(read(backup), "key=1\n")
+
+        rollback()
+        self.assertEqual(snapshot_tree(self.live), self.before)
+
+    def test_backups_fall_back_to_copies(self):
+        journal = Journal("first")
+        with mock.patch("os.link", side_effect=OSError("cross-device link")):
+            self.replace(journal, self.conf, "key=2\n")
+            self.replace(journal, self.link, "link\n")
+        journal.close()
+        self.assertFalse(os.path.islink(os.path.join(journal.files_dir, "1")))
+        self.assertEqual(os.readlink(os.path.join(journal.files_dir, "2")), "app.conf")
+
+        rollback()
+        self.assertEqual(snapshot_tree(self.live), self.before)
+
+    def test_new_files_are_removed(self):
+        journal = Journal("first")
+        new = os.path.join(self.live, "new.conf")
+        self.replace(journal, new, "new\n")
+        journal.close()
+        self.assertEqual(rollback(), {"restored": 0, "removed": 1})
+        self.assertEqual(snapshot_tree(self.live), self.before)
+
+    def test_nothing_recorded_keeps_previous(self):
+        previous = Journal("first")
+        self.replace(previous, self.conf, "key=2\n")
+        previous.close()
+
+        journal = Journal("second")
+        journal.makedirs(self.live)
+        journal.close()
+        self.assertFalse(journal.started())
+        self.assertEqual(last_apply()["profile"], "first")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+"""Tests of saving to and applying from the object store"""
+
+import os
+import shutil
+import threading
+import unittest
+from unittest import mock
+
+from konsave import store
+from konsave import config, funcs
+from konsave.consts import KONSAVE_DIR, PROFILES_DIR
+from konsave.history import remove_version, versions
+from konsave.store import (
+    collect_garbage,
+    load_manifest,
+    object_path,
+    store_file,
+    store_lock,
+)
+
+from tests import KonsaveTestCase, konsave, output, read, snapshot_tree, write
+
+
+class SaveApplyTest(KonsaveTestCase):
+    """konsave save, then konsave apply"""
+
+    def test_round_trip(self):
+        saved = snapshot_tree(self.live)
+        konsave("save", "first")
+
+        shutil.rmtree(self.live)
+        konsave("apply", "first")
+        self.assertEqual(snapshot_tree(self.live), saved)
+
+    def test_apply_overwrites_changes(self):
+        konsave("save", "first")
+        write(os.path.join(self.live, "app.conf"), "key=2\n")
+        os.remove(os.path.join(self.live, "appdir", "a.txt"))
+
+        konsave("apply", "first")
+        self.assertEqual(read(os.path.join(self.live, "app.conf")), "key=1\n")
+        self.assertEqual(read(os.path.join(self.live, "appdir", "a.txt")), "a\n")
+
+
+class IncrementalSaveTest(KonsaveTestCase):
+    """Saving again only reads the files that changed since the last save"""
+
+    def hashed_files(self, hashed) -> list:
+        """Return the saved files hashed, leaving out the profile config"""
+        paths = [call.args[0] for call in hashed.call_args_list]
+        return [path for path in paths if path.startswith(self.live)]
+
+    def test_unchanged_files_are_not_hashed(self):
+        konsave("save", "first")
+        before = load_manifest(os.path.join(PROFILES_DIR, "first"))["sections"]
+        write(os.path.join(self.live, "app.conf"), "key=2\n")
+
+        with mock.patch.object(store, "hash_file", wraps=store.hash_file) as hashed:
+            konsave("save", "first", "--force")
+        self.assertEqual(
+            self.hashed_files(hashed), [os.path.join(self.live, "app.conf")]
+        )
+
+        after = load_manifest(os.path.join(PROFILES_DIR, "first"))["sections"]
+        old, new = before["app"]["files"], after["app"]["files"]
+        self.assertEqual(new["appdir/a.txt"], old["appdir/a.txt"])
+        self.assertEqual(new["appdir/sub/b.txt"], old["appdir/sub/b.txt"])
+        self.assertNotEqual(new["app.conf"]["digest"], old["app.conf"]["digest"])
+
+    def test_checksum_hashes_everything(self):
+        konsave("save", "first")
+        with mock.patch.object(store, "hash_file", wraps=store.hash_file) as hashed:
+            konsave("save", "first", "--force", "--checksum")
+        self.assertEqual(len(self.hashed_files(hashed)), 3)
+
+
+class SectionNamesTest(KonsaveTestCase):
+    """Config sections named like the files of a profile directory"""
+
+    def test_history_section(self):
+        section = (
+            "    history:\n"
+            '        location: "$HOME/live"\n'
+            "        entries:\n"
+            "            - app.conf\n"
+        )
+        conf = read(config.CONFIG_FILE)
+        write(config.CONFIG_FILE, conf.replace("save:\n", "save:\n" + section))
+        profile_dir = os.path.join(PROFILES_DIR, "first")
+        konsave("save", "first")
+        konsave("save", "first", "--force")
+        self.assertEqual(versions(profile_dir), [1, 2])
+        self.assertIn("history", load_manifest(profile_dir)["sections"])
+
+
+class IncompleteProfileTest(KonsaveTestCase):
+    """Profile directories without manifest nor conf.yaml"""
+
+    def test_ignored(self):
+        konsave("save", "first")
+        os.makedirs(os.path.join(PROFILES_DIR, "new"))
+        self.assertIn("first", output("list"))
+        self.assertEqual(collect_garbage(), (0, 0))
+        konsave("remove", "first")
+        self.assertEqual(os.listdir(PROFILES_DIR), ["new"])
+
+    def test_failed_first_save_leaves_nothing(self):
+        with mock.patch.object(funcs, "write_manifest", side_effect=OSError):
+            with self.assertRaises(OSError):
+                konsave("save", "first")
+        self.assertFalse(os.path.exists(os.path.join(PROFILES_DIR, "first")))
+        self.assertFalse(
+            [name for name in os.listdir(KONSAVE_DIR) if name.startswith(".save-")]
+        )
+
+
+class GarbageCollectionTest(KonsaveTestCase):
+    """collect_garbage() keeps the objects of every profile version"""
+
+    def test_keeps_objects_of_history(self):
+        profile_dir = os.path.join(PROFILES_DIR, "first")
+        konsave("save", "first")
+        old = load_manifest(profile_dir)["sections"]["app"]["files"]["app.conf"]
+        write(os.path.join(self.live, "app.conf"), "key=2\n")
+        konsave("save", "first", "--force")
+
+        # Only referenced by the first version now
+        self.assertEqual(collect_garbage(), (0, 0))
+        self.assertTrue(os.path.exists(object_path(old["digest"])))
+
+        remove_version(profile_dir, versions(profile_dir)[0])
+        self.assertEqual(collect_garbage(), (1, old["size"]))
+        self.assertFalse(os.path.exists(object_path(old["digest"])))
+
+    def test_waits_for_saves_in_progress(self):
+        with store_lock():
+            record = store_file(os.path.join(self.live, "app.conf"))
+            gc = threading.Thread(target=collect_garbage)
+            gc.start()
+            gc.join(0.2)
+            self.assertTrue(gc.is_alive())
+            self.assertTrue(os.path.exists(object_path(record["digest"])))
+        gc.join()
+        # Nothing refers to it: gone once the save is over
+        self.assertFalse(os.path.exists(object_path(record["digest"])))
+
+    def test_remove_frees_objects(self):
+        konsave("save", "first")
+        konsave("remove", "first")
+        self.assertEqual(collect_garbage(), (0, 0))
+        self.assertFalse(os.listdir(store.OBJECTS_DIR))
+
+
+if __name__ == "__main__":
+    unittest.main()